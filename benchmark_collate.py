@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the vectorized collate function (pykp.collate) against the original list-based implementation,
+on batches of a processed one2many dataset (e.g. kp20k). Checks that both return identical tensors.
+Usage:
+    python benchmark_collate.py -data data/kp20k/kp20k.valid.one2many.pt -vocab data/kp20k/kp20k.vocab.bin
+"""
+import argparse
+import itertools
+import time
+
+import numpy as np
+import torch
+from torch.utils.data.sampler import SequentialSampler
+
+from pykp.dataloader import One2ManyBatchSampler
+from pykp.io import KeyphraseDataset, BOS_WORD, EOS_WORD
+from pykp.vocab import load_vocab
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+
+def pad_legacy(x_raw, pad_id):
+    # np.asarray(x_raw) in the original, recent numpy refuses to build ragged arrays implicitly
+    x_raw = [np.asarray(x_) for x_ in x_raw]
+    x_lens = [len(x_) for x_ in x_raw]
+    max_length = max(x_lens)
+    x = np.array([np.concatenate((x_, [pad_id] * (max_length - len(x_)))) for x_ in x_raw])
+    x = torch.stack([torch.from_numpy(x_) for x_ in x], 0).type('torch.LongTensor')
+    x_mask = np.array([[1] * x_len + [0] * (max_length - x_len) for x_len in x_lens])
+    x_mask = torch.stack([torch.from_numpy(m_) for m_ in x_mask], 0)
+    return x, x_lens, x_mask
+
+
+def collate_fn_one2many_legacy(dataset, batches):
+    '''
+    The original KeyphraseDataset.collate_fn_one2many (without the original strings)
+    '''
+    word2id, pad_id = dataset.word2id, dataset.pad_id
+    src = [[word2id[BOS_WORD]] + b['src'] + [word2id[EOS_WORD]] for b in batches]
+    src_oov = [[word2id[BOS_WORD]] + b['src_oov'] + [word2id[EOS_WORD]] for b in batches]
+    trg = [[[word2id[BOS_WORD]] + t + [word2id[EOS_WORD]] for t in b['trg']] for b in batches]
+    trg_target = [[t + [word2id[EOS_WORD]] for t in b['trg']] for b in batches]
+    trg_copy_target = [[t + [word2id[EOS_WORD]] for t in b['trg_copy']] for b in batches]
+    oov_lists = [b['oov_list'] for b in batches]
+
+    src_len_order = np.argsort([len(s) for s in src])[::-1]
+    src = [src[i] for i in src_len_order]
+    src_oov = [src_oov[i] for i in src_len_order]
+    src = [s if len(s) < 1000 else s[:1000] for s in src]
+    src_oov = [s if len(s) < 1000 else s[:1000] for s in src_oov]
+    trg = [trg[i] for i in src_len_order]
+    trg_target = [trg_target[i] for i in src_len_order]
+    trg_copy_target = [trg_copy_target[i] for i in src_len_order]
+    oov_lists = [oov_lists[i] for i in src_len_order]
+
+    src_o2m, src_o2m_len, _ = pad_legacy(src, pad_id)
+    src_oov_o2m, _, _ = pad_legacy(src_oov, pad_id)
+    src_o2o, src_o2o_len, _ = pad_legacy(list(itertools.chain(*[[src[idx]] * len(t) for idx, t in enumerate(trg)])), pad_id)
+    src_oov_o2o, _, _ = pad_legacy(list(itertools.chain(*[[src_oov[idx]] * len(t) for idx, t in enumerate(trg)])), pad_id)
+    trg_o2o, _, _ = pad_legacy(list(itertools.chain(*[t for t in trg])), pad_id)
+    trg_target_o2o, _, _ = pad_legacy(list(itertools.chain(*[t for t in trg_target])), pad_id)
+    trg_copy_target_o2o, _, _ = pad_legacy(list(itertools.chain(*[t for t in trg_copy_target])), pad_id)
+    oov_lists_o2o = list(itertools.chain(*[[oov_lists[idx]] * len(t) for idx, t in enumerate(trg)]))
+
+    return (src_o2m, src_o2m_len, trg, None, trg_copy_target, src_oov_o2m, oov_lists), \
+           (src_o2o, src_o2o_len, trg_o2o, trg_target_o2o, trg_copy_target_o2o, src_oov_o2o, oov_lists_o2o)
+
+
+def assert_identical(x, y):
+    if torch.is_tensor(x) or isinstance(x, torch.autograd.Variable):
+        assert torch.is_tensor(y) or isinstance(y, torch.autograd.Variable)
+        x, y = x.data if hasattr(x, 'data') else x, y.data if hasattr(y, 'data') else y
+        assert x.type() == y.type() and x.size() == y.size() and torch.equal(x, y)
+    elif isinstance(x, (list, tuple)):
+        assert len(x) == len(y)
+        for x_, y_ in zip(x, y):
+            assert_identical(x_, y_)
+    else:
+        assert x == y
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark_collate.py', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-data', required=True, help='Path to a processed one2many dataset (.pt or .col)')
+    parser.add_argument('-vocab', required=True, help='Path to the vocab (.vocab.bin or .vocab.pt)')
+    parser.add_argument('-batch_size', type=int, default=64, help='Maximum number of one2one pairs in a batch')
+    parser.add_argument('-num_batches', type=int, default=200, help='Number of batches to collate')
+    opt = parser.parse_args()
+
+    word2id, id2word, vocab = load_vocab(opt.vocab)
+    dataset = KeyphraseDataset(opt.data, word2id=word2id, id2word=id2word, type='one2many')
+    batch_sampler = One2ManyBatchSampler(SequentialSampler(dataset), dataset.get_num_trgs(),
+                                         max_batch_example=1024, max_batch_pair=opt.batch_size, drop_last=False)
+    batches = [[dataset[i] for i in indices] for indices in itertools.islice(batch_sampler, opt.num_batches)]
+
+    for b in batches:
+        assert_identical(collate_fn_one2many_legacy(dataset, b), dataset.collate_fn_one2many(b))
+    print('%d batches checked, the tensors are identical' % len(batches))
+
+    for name, collate_fn in [('legacy', lambda b: collate_fn_one2many_legacy(dataset, b)),
+                             ('vectorized', dataset.collate_fn_one2many)]:
+        start_time = time.time()
+        for b in batches:
+            collate_fn(b)
+        elapsed_time = time.time() - start_time
+        print('%s collate: %.3f seconds, %.3f ms/batch' % (name, elapsed_time, 1000.0 * elapsed_time / max(len(batches), 1)))
+
+
+if __name__ == '__main__':
+    main()
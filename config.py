@@ -246,6 +246,16 @@ def preprocess_opts(parser):
                         help="Maximum number of unknown words the model supports (mainly for masking in loss).")
 
     parser.add_argument('-words_min_frequency', type=int, default=0)
+    parser.add_argument('-vocab_workers', type=int, default=1,
+                        help="Number of processes counting the tokens of the training data")
+    parser.add_argument('-vocab_max_entries', type=int, default=0,
+                        help="If > 0, bound the number of distinct tokens held while counting, by dropping the rarest "
+                             "ones whenever it's exceeded (the counts of rare words become approximate)")
+    parser.add_argument('-vocab_format', type=str, default='both',
+                        choices=['bin', 'pt', 'both'],
+                        help="Format of the saved vocab. 'bin' is a compact memory-mapped file (<dataset>.vocab.bin), "
+                             "'pt' the pickled dicts (<dataset>.vocab.pt). 'both' (the default) keeps writing the .pt "
+                             "file for the tools that torch.load it, pykp.vocab.load_vocab prefers the .bin file")
 
     # Length filter options
     parser.add_argument('-max_src_seq_length', type=int, default=300,
@@ -275,13 +285,32 @@ def preprocess_opts(parser):
     parser.add_argument('-dynamic_dict', default=True,
                         action='store_true', help="Create dynamic dictionaries (for copy)")
 
+    # Export options
+    parser.add_argument('-example_schema', type=str, default='full',
+                        choices=['slim', 'full'],
+                        help="'slim' examples keep the ids and a per-document table of oov words only, the original strings "
+                             "and oov_dict are rebuilt when loading. 'full' also stores the strings, oov_dict and the "
+                             "presence flags/order indices and the stemmed flags of the targets (the format of older datasets, "
+                             "read directly by some external scripts)")
+    parser.add_argument('-export_format', type=str, default='pt',
+                        choices=['pt', 'columnar', 'both'],
+                        help="Format of the exported one2many datasets. 'columnar' writes a directory "
+                             "(*.one2many.col) of flat token/offset arrays that is memory-mapped at loading time, 'both' writes "
+                             "the two of them (the loaders prefer the columnar one)")
+    parser.add_argument('-num_shards', type=int, default=0,
+                        help="Split the one2many training data into this number of shards of similar numbers of tokens, "
+                             "listed in <dataset>.train.one2many.manifest.json (0 or 1 means one file)")
+    parser.add_argument('-columnar_compression', type=str, default=None,
+                        choices=['zlib'],
+                        help="Compress the columnar data arrays in blocks (random access inflates only the touched blocks)")
+
 def train_opts(parser):
     # Model loading/saving options
     parser.add_argument('-data_path_prefix', required=True,
                         help="""Path prefix to the ".train.pt" and
                         ".valid.pt" file path from preprocess.py""")
     parser.add_argument('-vocab_path', required=True,
-                        help="""Path prefix to the ".vocab.pt"
+                        help="""Path prefix to the ".vocab.bin" (or ".vocab.pt")
                         file path from preprocess.py""")
 
     parser.add_argument('-save_model', default='model',
@@ -312,24 +341,56 @@ def train_opts(parser):
     parser.add_argument('-pre_word_vecs_enc',
                         help="""If a valid path is specified, then this will load
                         pretrained word embeddings on the encoder side.
-                        See README for specific formatting instructions.""")
+                        A text file of GloVe/word2vec/fastText vectors, converted at the first
+                        use into memory-mapped files next to it (see pykp/word_vectors.py).
+                        The vector size must be equal to -word_vec_size.""")
     parser.add_argument('-pre_word_vecs_dec',
                         help="""If a valid path is specified, then this will load
                         pretrained word embeddings on the decoder side.
-                        See README for specific formatting instructions.""")
+                        Encoder and decoder share the embedding, these vectors are loaded last.""")
     # Fixed word vectors
     parser.add_argument('-fix_word_vecs_enc',
                         action='store_true',
                         help="Fix word embeddings on the encoder side.")
     parser.add_argument('-fix_word_vecs_dec',
                         action='store_true',
-                        help="Fix word embeddings on the encoder side.")
+                        help="Fix word embeddings on the decoder side.")
 
     # Optimization options
     parser.add_argument('-batch_size', type=int, default=128,
                         help='Maximum batch size')
     parser.add_argument('-batch_workers', type=int, default=4,
                         help='Number of workers for generating batches')
+    parser.add_argument('-bucket_sampling', action='store_true',
+                        help='Group examples of similar source lengths into the same batch (for training and evaluation)')
+    parser.add_argument('-bucket_width', type=int, default=10,
+                        help='Width (in source tokens) of each length bucket')
+    parser.add_argument('-streaming', action='store_true',
+                        help='Stream the training data from the shards <data>.train.one2many.shard<k>.pt|.col '
+                             'instead of loading the whole training set')
+    parser.add_argument('-train_shard_ids', type=int, nargs='+', default=None,
+                        help='Stream the training data from these shards only (indices in the manifest of the training '
+                             'set, or in the shard files sorted by id). Implies -streaming')
+    parser.add_argument('-shuffle_buffer_size', type=int, default=10000,
+                        help='Number of examples in the shuffle buffer of streaming training')
+    parser.add_argument('-share_dataset_memory', action='store_true',
+                        help='Move the training examples into a memory-mapped columnar copy in /dev/shm before starting '
+                             'the batch workers, so that workers share the pages instead of copying the dataset')
+    parser.add_argument('-persistent_workers', action='store_true',
+                        help='Keep one pool of -batch_workers processes alive for the whole run, shared by the training, '
+                             'validation and test loaders, instead of starting new workers at every iteration')
+    parser.add_argument('-cache_eval_batches', action='store_true',
+                        help='Keep the collated batches of the validation and test sets after the first validation round')
+    parser.add_argument('-eval_cache_memory', type=int, default=1024,
+                        help='Memory (MB) of the cached batches of each validation/test set, '
+                             'further batches are spilled to a file in -eval_cache_dir')
+    parser.add_argument('-eval_cache_dir', type=str, default=None,
+                        help='Directory of the spilled batches, the system temporary directory by default')
+    parser.add_argument('-report_worker_memory', action='store_true',
+                        help='Print the RSS of each batch worker when it exits')
+    parser.add_argument('-max_batch_tokens', type=int, default=0,
+                        help='Budget of padded tokens in a batch (max_src_len * #docs + max_trg_len * #targets) '
+                             'when -bucket_sampling is on, 0 means no budget')
     parser.add_argument('-optim', default='adam',
                         choices=['sgd', 'adagrad', 'adadelta', 'adam'],
                         help="""Optimization method.""")
@@ -397,6 +458,21 @@ def train_opts(parser):
                         help="Run validation test at this interval (every run_valid_every batches)")
     parser.add_argument('-early_stop_tolerance', type=int, default=10,
                         help="Stop training if it doesn't improve any more for serveral rounds of validation")
+    parser.add_argument('-valid_budget_docs', type=int, default=2000,
+                        help="Validate (and test) during training on a fixed subset of this number of documents per dataset, "
+                             "stratified by source length. The full datasets are evaluated at the end of training. 0 uses the "
+                             "full datasets in every round (with beam search, it may take longer than the training between two rounds)")
+    parser.add_argument('-valid_budget_seconds', type=float, default=0,
+                        help="Stop the validation of a dataset during training after this number of seconds, 0 means no limit. "
+                             "The batches are shuffled, so that the documents validated are of all the lengths")
+    parser.add_argument('-valid_ci_width', type=float, default=0,
+                        help="Stop the validation of a dataset during training once the 95%% bootstrap confidence interval "
+                             "of the first -report_score_names is narrower than this, 0 means no limit")
+    parser.add_argument('-valid_bootstrap_samples', type=int, default=1000,
+                        help="Number of bootstrap resamples of the confidence intervals of the validation scores")
+    parser.add_argument('-async_valid', action='store_true',
+                        help="Validate snapshots of the model in a separate process while training goes on. The scores "
+                             "drive early stopping and checkpoint selection one round of validation later")
 
     timemark = time.strftime('%Y%m%d-%H%M%S', time.localtime(time.time()))
 
@@ -446,6 +522,20 @@ def predict_opts(parser):
                         default=[],
                         help='(Set later) Name of each test dataset, also the name of folder from which we load processed test dataset.')
 
+    parser.add_argument('-prediction_format', type=str, default='store', choices=['store', 'files'],
+                        help='How the predictions of each evaluation round are saved: "store" writes sharded JSONL files '
+                             '(<title>_predictions/, see pykp.prediction_store), "files" writes three files per document '
+                             '(<title>_detail/)')
+    parser.add_argument('-prediction_shard_size', type=int, default=10000,
+                        help='Number of documents per shard of the prediction store')
+    parser.add_argument('-prediction_compress', action='store_true',
+                        help='Gzip the shards of the prediction store')
+    parser.add_argument('-eval_scorer_workers', type=int, default=0,
+                        help='Number of processes filtering and matching the predictions during evaluation, '
+                             'while the next batches are decoded. 0 scores them in the evaluating process')
+    parser.add_argument('-eval_pipeline_depth', type=int, default=2,
+                        help='Maximum number of decoded batches waiting for the scorer processes')
+
     # parser.add_argument('-num_oneword_seq', type=int, default=10000,
     #                     help='Source sequence to decode (one line per sequence)')
     # parser.add_argument('-report_score_names', type=str, nargs='+', default=['f_score@5#oneword=-1', 'f_score@10#oneword=-1', 'f_score@5#oneword=1', 'f_score@10#oneword=1'], help="""Default measure to report""")
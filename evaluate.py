@@ -1,7 +1,10 @@
+import collections
 import json
 import math
 import logging
+import multiprocessing
 import string
+import time
 
 import nltk
 import scipy
@@ -17,10 +20,18 @@ from torch.autograd import Variable
 import config
 import pykp
 from utils import Progbar
-from pykp.metric.bleu import bleu
+from pykp.metric.bleu import BleuScorer
+from pykp.metric.keyphrase import MetricAccumulator, bootstrap_interval, compute_metrics, match_matrix
+from pykp.phrase_match import NgramIndex
+from pykp.prediction_store import PredictionStoreWriter
 
 stemmer = PorterStemmer()
 
+# the confidence interval of a budgeted validation isn't checked before this number of documents
+CI_MIN_DOCS = 50
+# weights of the uni/bi/tri-gram precisions of the BLEU match score
+BLEU_WEIGHTS = [0.1, 0.3, 0.6]
+
 def process_predseqs(pred_seqs, oov, id2word, opt):
     '''
     :param pred_seqs:
@@ -101,29 +112,18 @@ def if_present_phrase(src_str_tokens, phrase_str_tokens):
 
     :param src_str_tokens: a list of strings (words) of source text
     :param phrase_str_tokens: a list of strings (words) of a phrase
-    :return:
+    :return: whether the phrase appears in the source, and its first position (-1 if absent)
     """
-    match_pos_idx = -1
-    for src_start_idx in range(len(src_str_tokens) - len(phrase_str_tokens) + 1):
-        match_flag = True
-        # iterate each word in target, if one word does not match, set match=False and break
-        for seq_idx, seq_w in enumerate(phrase_str_tokens):
-            src_w = src_str_tokens[src_start_idx + seq_idx]
-            if src_w != seq_w:
-                match_flag = False
-                break
-        if match_flag:
-            match_pos_idx = src_start_idx
-            break
-
-    return match_flag, match_pos_idx
+    match_pos_idx = NgramIndex(src_str_tokens).find(phrase_str_tokens)
+    return match_pos_idx >= 0, match_pos_idx
 
 
-def if_present_duplicate_phrases(src_str, trgs_str, do_stemming=True, check_duplicate=True):
-    if do_stemming:
-        src_to_match = stem_word_list(src_str)
-    else:
-        src_to_match = src_str
+def if_present_duplicate_phrases(src_str, trgs_str, do_stemming=True, check_duplicate=True, src_index=None):
+    '''
+    :param src_index: a pykp.phrase_match.NgramIndex of the source (of stem_key_list(src_str) if do_stemming), to share between calls
+    '''
+    if src_index is None:
+        src_index = NgramIndex(stem_key_list(src_str) if do_stemming else src_str)
 
     present_indices = []
     present_flags = []
@@ -131,16 +131,16 @@ def if_present_duplicate_phrases(src_str, trgs_str, do_stemming=True, check_dupl
 
     for trg_str in trgs_str:
         if do_stemming:
-            trg_to_match = stem_word_list(trg_str)
+            trg_to_match = stem_key_list(trg_str)
         else:
-            trg_to_match = trg_str
+            trg_to_match = tuple(trg_str)
 
-        # check if the phrase appears in source text
-        # iterate each word in source
-        match_flag, match_pos_idx = if_present_phrase(src_to_match, trg_to_match)
+        # check if the phrase appears in source text, a lookup in the n-gram index of the source
+        match_pos_idx = src_index.find(trg_to_match)
+        match_flag = match_pos_idx >= 0
 
         # check if it is duplicate, if true then ignore it
-        if check_duplicate and '_'.join(trg_to_match) in phrase_set:
+        if check_duplicate and trg_to_match in phrase_set:
             present_flags.append(False)
             present_indices.append(match_pos_idx)
             continue
@@ -149,21 +149,27 @@ def if_present_duplicate_phrases(src_str, trgs_str, do_stemming=True, check_dupl
             present_flags.append(match_flag)
             present_indices.append(match_pos_idx)
 
-        phrase_set.add('_'.join(trg_to_match))
+        phrase_set.add(trg_to_match)
 
     assert len(present_flags) == len(present_indices)
 
     return present_flags, present_indices
 
 
-def evaluate_multiple_datasets(generator, data_loaders, opt, title='', epoch=1, predict_save_path=None):
+def evaluate_multiple_datasets(generator, data_loaders, opt, title='', epoch=1, predict_save_path=None, budgeted=False):
+    '''
+    :param budgeted: stop the evaluation of each dataset at the limits of the validation budget (-valid_budget_seconds,
+        -valid_ci_width), the loaders are usually over fixed subsets of the datasets (-valid_budget_docs)
+    '''
     # return the scores of all examples in multiple datasets
     datasets_score_dict = {}
     for dataset_name, data_loader in zip(opt.test_dataset_names, data_loaders):
         logging.getLogger().info('Evaluating %s' % dataset_name)
         score_dict = evaluate_beam_search(generator, data_loader, opt,
                                                title=dataset_name + '.' + title, epoch=epoch,
-                                               predict_save_path=os.path.join(predict_save_path, dataset_name))
+                                               predict_save_path=os.path.join(predict_save_path, dataset_name),
+                                               max_seconds=opt.valid_budget_seconds if budgeted else 0,
+                                               ci_width=opt.valid_ci_width if budgeted else 0)
 
         # write the scores into file
         score_json_path = os.path.join(predict_save_path, dataset_name, 'detailed_score.json')
@@ -173,8 +179,10 @@ def evaluate_multiple_datasets(generator, data_loaders, opt, title='', epoch=1,
         # return a dict, key is dataset name and value is another dict of scores
         datasets_score_dict[dataset_name] = score_dict
 
-        # empty dataset to free memory
+        # empty dataset to free memory, the cached batches (if any) are kept for the next round
         data_loader.dataset.offload_dataset()
+        if getattr(data_loader, 'batch_cache', None) is not None:
+            logging.getLogger().info('Cached batches of %s: %s' % (dataset_name, str(data_loader.batch_cache)))
 
     # create a new tuple (key='all_datasets') by merging all results
     merged_score_dict = {}
@@ -184,154 +192,276 @@ def evaluate_multiple_datasets(generator, data_loaders, opt, title='', epoch=1,
             merged_score_values.extend(score_values)
             merged_score_dict[score_name] = merged_score_values
     datasets_score_dict['all_datasets'] = merged_score_dict
+    log_score_intervals(logging.getLogger(), 'all_datasets.' + title, merged_score_dict, opt)
 
     return datasets_score_dict
 
 
-def evaluate_beam_search(generator, data_loader, opt, title='', epoch=1, predict_save_path=None):
-    logger = config.init_logging(title, predict_save_path + '/%s.log' % title, redirect_to_stdout=False)
-    progbar = Progbar(logger=logger, title=title, target=len(data_loader), batch_size=data_loader.batch_size,
-                      total_examples=len(data_loader.dataset))
+def log_score_intervals(logger, title, score_dict, opt):
+    '''
+    Log the average of each reported score (-report_score_names) with its 95% bootstrap confidence interval
+    '''
+    for score_name in opt.report_score_names:
+        if score_name not in score_dict:
+            continue
+        average, lower, upper = bootstrap_interval(score_dict[score_name], num_samples=getattr(opt, 'valid_bootstrap_samples', 1000))
+        logger.info('%s: %s=%.4f, 95%% CI=[%.4f, %.4f], #(docs)=%d' % (title, score_name, average, lower, upper, len(score_dict[score_name])))
 
-    topk_range = [5, 10]
-    score_names = ['precision', 'recall', 'f_score']
 
-    example_idx = 0
-    score_dict = {}  # {'precision@5':[],'recall@5':[],'f1score@5':[], 'precision@10':[],'recall@10':[],'f1score@10':[]}
+class DecodedSequence(object):
+    """
+    The word ids and the score of a beam search Sequence, without its tensors, so that it can be sent to a scorer process
+    """
+    __slots__ = ['sentence', 'score']
 
-    for i, batch in enumerate(data_loader):
-        if i > 5:
-            break
+    def __init__(self, sentence, score):
+        self.sentence = sentence
+        self.score = score
 
-        one2many_batch, one2one_batch = batch
-        src_list, src_len, trg_list, _, trg_copy_target_list, src_oov_map_list, oov_list, src_str_list, trg_str_list = one2many_batch
 
-        if torch.cuda.is_available():
-            src_list = src_list.cuda()
-            src_oov_map_list = src_oov_map_list.cuda()
+def score_example(example, opt):
+    '''
+    Filter the predictions of one example and match them with the targets, everything of evaluate_beam_search that
+    doesn't depend on the other examples
+    :param example: (src ids, src_str, trg, trg_str_seqs, trg_copy, predictions (DecodedSequence), oov list,
+        entry of the evaluation index (source keys, target keys, target presence flags) or None)
+    :return: a dict of the print-out (without the scores), the predictions, the record of the prediction store and the
+        match lists. If the example has no present target (with opt.must_appear_in_src), it's not scored and the dict
+        only has the record (skipped=True), the raw predictions are kept for rescoring with other filters (rescore.py)
+    '''
+    src, src_str, trg, trg_str_seqs, trg_copy, pred_seq, oov, eval_entry = example
+    print_out = ''
+    print_out += '[Source][%d]: %s \n' % (len(src_str), ' '.join(src_str))
+    print_out += '\nSource Input: \n %s\n' % (' '.join([opt.id2word[x] for x in src[:len(src_str) + 5]]))
+    print_out += 'Real Target String [%d] \n\t\t%s \n' % (len(trg_str_seqs), trg_str_seqs)
+    print_out += 'Real Target Input:  \n\t\t%s \n' % str([[opt.id2word[x] for x in t] for t in trg])
+    print_out += 'Real Target Copy:   \n\t\t%s \n' % str([[opt.id2word[x] if x < opt.vocab_size else oov[x - opt.vocab_size] for x in t] for t in trg_copy])
+    # the stemmed source is indexed once for the targets and the predictions
+    if eval_entry is not None:
+        src_keys, trg_keys, trg_str_is_present_flags = eval_entry
+        src_index = NgramIndex(src_keys)
+    else:
+        src_index = NgramIndex(stem_key_list(src_str))
+        trg_keys = [stem_key_list(t) for t in trg_str_seqs]
+        trg_str_is_present_flags, _ = if_present_duplicate_phrases(src_str, trg_str_seqs, src_index=src_index)
+
+    # ignore the cases that there's no present phrases
+    if opt.must_appear_in_src and np.sum(trg_str_is_present_flags) == 0:
+        pred_is_valid_flags, _, processed_pred_str_seqs, processed_pred_score = process_predseqs(pred_seq, oov, opt.id2word, opt)
+        pred_is_present_flags, _ = if_present_duplicate_phrases(src_str, processed_pred_str_seqs, src_index=src_index)
+        out_dict = prediction_record(src_str, trg_str_seqs, trg_str_is_present_flags, processed_pred_str_seqs,
+                                     processed_pred_score, pred_is_present_flags, pred_is_valid_flags,
+                                     [0.] * len(processed_pred_str_seqs))
+        return {'skipped': True, 'out_dict': out_dict}
+
+    print_out += '[GROUND-TRUTH] #(present)/#(all targets)=%d/%d\n' % (sum(trg_str_is_present_flags), len(trg_str_is_present_flags))
+    print_out += '\n'.join(['\t\t[%s]' % ' '.join(phrase) if is_present else '\t\t%s' % ' '.join(phrase) for phrase, is_present in zip(trg_str_seqs, trg_str_is_present_flags)])
+    print_out += '\noov_list:   \n\t\t%s \n' % str(oov)
+
+    # 1st filtering
+    pred_is_valid_flags, processed_pred_seqs, processed_pred_str_seqs, processed_pred_score = process_predseqs(pred_seq, oov, opt.id2word, opt)
+    # 2nd filtering: if filter out phrases that don't appear in text, and keep unique ones after stemming
+    if opt.must_appear_in_src:
+        pred_is_present_flags, _ = if_present_duplicate_phrases(src_str, processed_pred_str_seqs, src_index=src_index)
+        filtered_trg_str_seqs = np.asarray(trg_str_seqs)[trg_str_is_present_flags]
+        filtered_trg_keys = [k for k, is_present in zip(trg_keys, trg_str_is_present_flags) if is_present]
+    else:
+        pred_is_present_flags = [True] * len(processed_pred_str_seqs)
+        filtered_trg_str_seqs = trg_str_seqs
+        filtered_trg_keys = trg_keys
 
-        print("batch size - %s" % str(src_list.size(0)))
-        print("src size - %s" % str(src_list.size()))
-        print("target size - %s" % len(trg_copy_target_list))
+    valid_and_present = np.asarray(pred_is_valid_flags) * np.asarray(pred_is_present_flags)
+    match_list = get_match_result(true_seqs=filtered_trg_str_seqs, pred_seqs=processed_pred_str_seqs, true_keys=filtered_trg_keys)
+    print_out += '[PREDICTION] #(valid)=%d, #(present)=%d, #(retained&present)=%d, #(all)=%d\n' % (sum(pred_is_valid_flags), sum(pred_is_present_flags), sum(valid_and_present), len(pred_seq))
+    print_out += ''
 
-        try:
-            pred_seq_list = generator.beam_search(src_list, src_len, src_oov_map_list, oov_list, opt.word2id)
-        except RuntimeError as re:
-            logging.exception('Encountered OOM RuntimeError, now trying to predict one by one')
-            raise re
+    '''
+    Iterate every prediction, print and export predictions
+    '''
+    preds_out = ''
+    for p_id, (seq, word, score, match, is_valid, is_present) in enumerate(
+            zip(processed_pred_seqs, processed_pred_str_seqs, processed_pred_score, match_list, pred_is_valid_flags, pred_is_present_flags)):
+        # if p_id > 5:
+        #     break
+        preds_out += '%s\n' % (' '.join(word))
+        if is_present:
+            print_phrase = '[%s]' % ' '.join(word)
+        else:
+            print_phrase = ' '.join(word)
 
-        '''
-        process each example in current batch
-        '''
-        for src, src_str, trg, trg_str_seqs, trg_copy, pred_seq, oov in zip(src_list, src_str_list, trg_list, trg_str_list, trg_copy_target_list, pred_seq_list, oov_list):
-            logger.info('======================  %d =========================' % (i))
-            print_out = ''
-            print_out += '[Source][%d]: %s \n' % (len(src_str), ' '.join(src_str))
-            src = src.cpu().data.numpy() if torch.cuda.is_available() else src.data.numpy()
-            print_out += '\nSource Input: \n %s\n' % (' '.join([opt.id2word[x] for x in src[:len(src_str) + 5]]))
-            print_out += 'Real Target String [%d] \n\t\t%s \n' % (len(trg_str_seqs), trg_str_seqs)
-            print_out += 'Real Target Input:  \n\t\t%s \n' % str([[opt.id2word[x] for x in t] for t in trg])
-            print_out += 'Real Target Copy:   \n\t\t%s \n' % str([[opt.id2word[x] if x < opt.vocab_size else oov[x - opt.vocab_size] for x in t] for t in trg_copy])
-            trg_str_is_present_flags, _ = if_present_duplicate_phrases(src_str, trg_str_seqs)
-
-            # ignore the cases that there's no present phrases
-            if opt.must_appear_in_src and np.sum(trg_str_is_present_flags) == 0:
-                logger.error('found no present targets')
-                continue
+        if is_valid:
+            print_phrase = '*%s' % print_phrase
 
-            print_out += '[GROUND-TRUTH] #(present)/#(all targets)=%d/%d\n' % (sum(trg_str_is_present_flags), len(trg_str_is_present_flags))
-            print_out += '\n'.join(['\t\t[%s]' % ' '.join(phrase) if is_present else '\t\t%s' % ' '.join(phrase) for phrase, is_present in zip(trg_str_seqs, trg_str_is_present_flags)])
-            print_out += '\noov_list:   \n\t\t%s \n' % str(oov)
+        if match == 1.0:
+            correct_str = '[correct!]'
+        else:
+            correct_str = ''
+        if any([t >= opt.vocab_size for t in seq.sentence]):
+            copy_str = '[copied!]'
+        else:
+            copy_str = ''
 
-            # 1st filtering
-            pred_is_valid_flags, processed_pred_seqs, processed_pred_str_seqs, processed_pred_score = process_predseqs(pred_seq, oov, opt.id2word, opt)
-            # 2nd filtering: if filter out phrases that don't appear in text, and keep unique ones after stemming
-            if opt.must_appear_in_src:
-                pred_is_present_flags, _ = if_present_duplicate_phrases(src_str, processed_pred_str_seqs)
-                filtered_trg_str_seqs = np.asarray(trg_str_seqs)[trg_str_is_present_flags]
-            else:
-                pred_is_present_flags = [True] * len(processed_pred_str_seqs)
+        print_out += '\t\t[%.4f]\t%s \t %s %s%s\n' % (-score, print_phrase, str(seq.sentence), correct_str, copy_str)
 
-            valid_and_present = np.asarray(pred_is_valid_flags) * np.asarray(pred_is_present_flags)
-            match_list = get_match_result(true_seqs=filtered_trg_str_seqs, pred_seqs=processed_pred_str_seqs)
-            print_out += '[PREDICTION] #(valid)=%d, #(present)=%d, #(retained&present)=%d, #(all)=%d\n' % (sum(pred_is_valid_flags), sum(pred_is_present_flags), sum(valid_and_present), len(pred_seq))
-            print_out += ''
+    '''
+    Evaluate predictions w.r.t different filterings and metrics
+    '''
+    processed_pred_seqs = np.asarray(processed_pred_seqs)[valid_and_present]
+    filtered_processed_pred_str_seqs = np.asarray(processed_pred_str_seqs)[valid_and_present]
+    filtered_processed_pred_score = np.asarray(processed_pred_score)[valid_and_present]
 
-            '''
-            Iterate every prediction, print and export predictions
-            '''
-            preds_out = ''
-            for p_id, (seq, word, score, match, is_valid, is_present) in enumerate(
-                    zip(processed_pred_seqs, processed_pred_str_seqs, processed_pred_score, match_list, pred_is_valid_flags, pred_is_present_flags)):
-                # if p_id > 5:
-                #     break
-                preds_out += '%s\n' % (' '.join(word))
-                if is_present:
-                    print_phrase = '[%s]' % ' '.join(word)
-                else:
-                    print_phrase = ' '.join(word)
-
-                if is_valid:
-                    print_phrase = '*%s' % print_phrase
-
-                if match == 1.0:
-                    correct_str = '[correct!]'
-                else:
-                    correct_str = ''
-                if any([t >= opt.vocab_size for t in seq.sentence]):
-                    copy_str = '[copied!]'
-                else:
-                    copy_str = ''
-
-                print_out += '\t\t[%.4f]\t%s \t %s %s%s\n' % (-score, print_phrase, str(seq.sentence), correct_str, copy_str)
+    # 3rd round filtering (one-word phrases)
+    num_oneword_seq = -1
+    filtered_pred_seq, filtered_pred_str_seqs, filtered_pred_score = post_process_predseqs((processed_pred_seqs, filtered_processed_pred_str_seqs, filtered_processed_pred_score), num_oneword_seq)
 
-            '''
-            Evaluate predictions w.r.t different filterings and metrics
-            '''
-            processed_pred_seqs = np.asarray(processed_pred_seqs)[valid_and_present]
-            filtered_processed_pred_str_seqs = np.asarray(processed_pred_str_seqs)[valid_and_present]
-            filtered_processed_pred_score = np.asarray(processed_pred_score)[valid_and_present]
+    match_list_exact = get_match_result(true_seqs=filtered_trg_str_seqs, pred_seqs=filtered_pred_str_seqs, type='exact', true_keys=filtered_trg_keys)
+    match_list_soft = get_match_result(true_seqs=filtered_trg_str_seqs, pred_seqs=filtered_pred_str_seqs, type='partial', true_keys=filtered_trg_keys)
 
-            # 3rd round filtering (one-word phrases)
-            num_oneword_seq = -1
-            filtered_pred_seq, filtered_pred_str_seqs, filtered_pred_score = post_process_predseqs((processed_pred_seqs, filtered_processed_pred_str_seqs, filtered_processed_pred_score), num_oneword_seq)
+    assert len(filtered_pred_seq) == len(filtered_pred_str_seqs) == len(filtered_pred_score) == len(match_list_exact) == len(match_list_soft)
 
-            match_list_exact = get_match_result(true_seqs=filtered_trg_str_seqs, pred_seqs=filtered_pred_str_seqs, type='exact')
-            match_list_soft = get_match_result(true_seqs=filtered_trg_str_seqs, pred_seqs=filtered_pred_str_seqs, type='partial')
+    print_out += "\n ======================================================="
+    print_pred_str_seqs = [" ".join(item) for item in filtered_pred_str_seqs]
+    print_trg_str_seqs = [" ".join(item) for item in filtered_trg_str_seqs]
+    # print_out += "\n PREDICTION: " + " / ".join(print_pred_str_seqs)
+    # print_out += "\n GROUND TRUTH: " + " / ".join(print_trg_str_seqs)
 
-            assert len(filtered_pred_seq) == len(filtered_pred_str_seqs) == len(filtered_pred_score) == len(match_list_exact) == len(match_list_soft)
+    out_dict = prediction_record(src_str, trg_str_seqs, trg_str_is_present_flags, processed_pred_str_seqs,
+                                 processed_pred_score, pred_is_present_flags, pred_is_valid_flags, match_list)
 
-            print_out += "\n ======================================================="
-            print_pred_str_seqs = [" ".join(item) for item in filtered_pred_str_seqs]
-            print_trg_str_seqs = [" ".join(item) for item in filtered_trg_str_seqs]
-            # print_out += "\n PREDICTION: " + " / ".join(print_pred_str_seqs)
-            # print_out += "\n GROUND TRUTH: " + " / ".join(print_trg_str_seqs)
-
-            for topk in topk_range:
-                results_exact = evaluate(match_list_exact, filtered_pred_str_seqs, filtered_trg_str_seqs, topk=topk)
-                for k, v in zip(score_names, results_exact):
-                    if '%s@%d_exact' % (k, topk) not in score_dict:
-                        score_dict['%s@%d_exact' % (k, topk)] = []
-                    score_dict['%s@%d_exact' % (k, topk)].append(v)
-                
-                print_out += "\n ------------------------------------------------- EXACT, k=%d" % (topk)
-                print_out += "\n --- batch precision, recall, fscore: " + str(results_exact[0]) + " , " + str(results_exact[1]) + " , " + str(results_exact[2])
-                print_out += "\n --- total precision, recall, fscore: " + str(np.average(score_dict['precision@%d_exact' % (topk)])) + " , " +\
-                            str(np.average(score_dict['recall@%d_exact' % (topk)])) + " , " +\
-                            str(np.average(score_dict['f_score@%d_exact' % (topk)]))
-
-            for topk in topk_range:
-                results_soft = evaluate(match_list_soft, filtered_pred_str_seqs, filtered_trg_str_seqs, topk=topk)
-                for k, v in zip(score_names, results_soft):
-                    if '%s@%d_soft' % (k, topk) not in score_dict:
-                        score_dict['%s@%d_soft' % (k, topk)] = []
-                    score_dict['%s@%d_soft' % (k, topk)].append(v)
-                
-                print_out += "\n ------------------------------------------------- SOFT, k=%d" % (topk)
-                print_out += "\n --- batch precision, recall, fscore: " + str(results_soft[0]) + " , " + str(results_soft[1]) + " , " + str(results_soft[2])
-                print_out += "\n --- total precision, recall, fscore: " + str(np.average(score_dict['precision@%d_soft' % (topk)])) + " , " +\
-                            str(np.average(score_dict['recall@%d_soft' % (topk)])) + " , " +\
-                            str(np.average(score_dict['f_score@%d_soft' % (topk)]))
+    return {'skipped': False, 'print_out': print_out, 'preds_out': preds_out, 'out_dict': out_dict,
+            'match_list_exact': match_list_exact, 'match_list_soft': match_list_soft,
+            'num_targets': len(filtered_trg_str_seqs)}
+
+
+def prediction_record(src_str, trg_str_seqs, trg_str_is_present_flags, pred_str_seqs, pred_scores, pred_is_present_flags,
+                      pred_is_valid_flags, match_list):
+    '''
+    The json record of an example: all the predictions of the beam search in their rank order, with their scores and
+    flags, enough to score them again with other filters (rescore.py)
+    '''
+    out_dict = {}
+    out_dict['src_str'] = src_str
+    out_dict['trg_str'] = trg_str_seqs
+    out_dict['trg_present_flag'] = trg_str_is_present_flags
+    out_dict['pred_str'] = pred_str_seqs
+    out_dict['pred_score'] = [float(s) for s in pred_scores]
+    out_dict['present_flag'] = pred_is_present_flags
+    out_dict['valid_flag'] = pred_is_valid_flags
+    out_dict['match_flag'] = [float(m) for m in match_list]
+
+    for k,v in out_dict.items():
+        out_dict[k] = list(v)
+        # print('len(%s) = %d' % (k, len(v)))
+
+    assert len(out_dict['trg_str']) == len(out_dict['trg_present_flag'])
+    assert len(out_dict['pred_str']) == len(out_dict['present_flag']) \
+           == len(out_dict['valid_flag']) == len(out_dict['match_flag']) == len(out_dict['pred_score'])
+    return out_dict
+
+
+# options of the scorer processes, inherited from the evaluating process when the pool is forked
+scorer_opt = None
+
+
+def _init_scorer(opt):
+    global scorer_opt
+    scorer_opt = opt
+
+
+def score_batch(examples, opt=None):
+    '''
+    :return: (results of score_example, seconds spent)
+    '''
+    start_time = time.time()
+    opt = opt if opt is not None else scorer_opt
+    return [score_example(e, opt) for e in examples], time.time() - start_time
+
+
+class InlineResult(object):
+    "The result of a batch scored in the evaluating process, same interface as multiprocessing's AsyncResult"
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+def evaluate_beam_search(generator, data_loader, opt, title='', epoch=1, predict_save_path=None, max_seconds=0, ci_width=0):
+    '''
+    :param max_seconds: stop decoding new batches after this time, 0 means no limit
+    :param ci_width: stop decoding new batches once the 95% bootstrap interval of the first reported score
+        (-report_score_names) is narrower than this, 0 means no limit
+    '''
+    logger = config.init_logging(title, predict_save_path + '/%s.log' % title, redirect_to_stdout=False)
+    progbar = Progbar(logger=logger, title=title, target=len(data_loader), batch_size=data_loader.batch_size,
+                      total_examples=len(data_loader.dataset))
+
+    topk_range = [5, 10]
+    score_names = ['precision', 'recall', 'f_score']
+
+    example_idx = 0
+    doc_idx = 0
+    score_dict = {}  # {'precision@5':[],'recall@5':[],'f1score@5':[], 'precision@10':[],'recall@10':[],'f1score@10':[]}
+    # per-document scores and their running sums, the precision is over the predictions in the top k
+    accumulators = {'exact': MetricAccumulator(topk_range), 'soft': MetricAccumulator(topk_range)}
+
+    # the stemmed sources and targets and the presence of targets don't change between rounds, they're read from the
+    # evaluation index of the dataset. The loader isn't shuffled, its batch sampler gives the example ids of each batch,
+    # in the order of the collated batch
+    eval_index = data_loader.dataset.get_eval_index() if hasattr(data_loader.dataset, 'get_eval_index') else None
+    if eval_index is not None:
+        if eval_index.stem_table is not stem_table:
+            eval_index.bind(stem_table)
+        batch_indices = iter(data_loader.batch_sampler)
+
+    # the predictions of all the documents go to one store, unless the legacy files per document are asked
+    prediction_writer = None
+    if predict_save_path and getattr(opt, 'prediction_format', 'store') == 'store':
+        prediction_writer = PredictionStoreWriter(os.path.join(predict_save_path, title + '_predictions'),
+                                                  shard_size=opt.prediction_shard_size,
+                                                  compress=opt.prediction_compress)
+
+    # decoding and scoring are pipelined: the predictions of a batch are scored by a pool of processes while the next
+    # batches are decoded, at most eval_pipeline_depth batches wait for their scores
+    num_scorers = getattr(opt, 'eval_scorer_workers', 0)
+    pipeline_depth = max(getattr(opt, 'eval_pipeline_depth', 1), 1)
+    scorer_pool = None
+    if num_scorers > 0:
+        scorer_pool = multiprocessing.get_context('fork').Pool(num_scorers, initializer=_init_scorer, initargs=(opt,))
+    pending_batches = collections.deque()
+    # seconds spent in each stage of the pipeline
+    timing = collections.OrderedDict((stage, 0.) for stage in ['load', 'decode', 'score', 'wait', 'report'])
+
+    def report_batch(batch_i, async_result):
+        '''
+        Accumulate the scores, print and write the predictions of a scored batch, in the order of the examples
+        '''
+        nonlocal example_idx, doc_idx
+        wait_start = time.time()
+        results, score_time = async_result.get()
+        report_start = time.time()
+        timing['wait'] += report_start - wait_start
+        timing['score'] += score_time
+
+        for result in results:
+            logger.info('======================  %d =========================' % (batch_i))
+            # the store keeps every decoded document (doc_idx), including the ones that are not scored
+            doc_idx += 1
+            if result['skipped']:
+                logger.error('found no present targets')
+                if prediction_writer is not None:
+                    prediction_writer.write(doc_idx - 1, result['out_dict'])
+                continue
+
+            print_out = result['print_out']
+            for mode in ['exact', 'soft']:
+                accumulator = accumulators[mode]
+                doc_scores = accumulator.document(accumulator.add(result['match_list_%s' % mode], result['num_targets']))
+                for topk in topk_range:
+                    print_out += "\n ------------------------------------------------- %s, k=%d" % (mode.upper(), topk)
+                    print_out += "\n --- batch precision, recall, fscore: " + " , ".join([str(doc_scores['%s@%d' % (k, topk)]) for k in score_names])
+                    print_out += "\n --- total precision, recall, fscore: " + " , ".join([str(accumulator.macro('%s@%d' % (k, topk))) for k in score_names])
 
             print_out += "\n ======================================================="
             logger.info(print_out)
@@ -339,7 +469,12 @@ def evaluate_beam_search(generator, data_loader, opt, title='', epoch=1, predict
             '''
             write predictions to disk
             '''
-            if predict_save_path:
+            out_dict = result['out_dict']
+            if prediction_writer is not None:
+                # the print-out and the predictions (pred_str) are kept in the record
+                out_dict['print_out'] = print_out
+                prediction_writer.write(doc_idx - 1, out_dict)
+            elif predict_save_path:
                 if not os.path.exists(os.path.join(predict_save_path, title + '_detail')):
                     os.makedirs(os.path.join(predict_save_path, title + '_detail'))
                 # write print-out
@@ -347,37 +482,101 @@ def evaluate_beam_search(generator, data_loader, opt, title='', epoch=1, predict
                     f_.write(print_out)
                 # write original predictions
                 with open(os.path.join(predict_save_path, title + '_detail', str(example_idx) + '_prediction.txt'), 'w') as f_:
-                    f_.write(preds_out)
+                    f_.write(result['preds_out'])
+
+                with open(os.path.join(predict_save_path, title + '_detail', str(example_idx) + '.json'), 'w') as f_:
+                    f_.write(json.dumps(out_dict))
 
-                out_dict = {}
-                out_dict['src_str'] = src_str
-                out_dict['trg_str'] = trg_str_seqs
-                out_dict['trg_present_flag'] = trg_str_is_present_flags
-                out_dict['pred_str'] = processed_pred_str_seqs
-                out_dict['pred_score'] = [float(s) for s in processed_pred_score]
-                out_dict['present_flag'] = pred_is_present_flags
-                out_dict['valid_flag'] = pred_is_valid_flags
-                out_dict['match_flag'] = [float(m) for m in match_list]
+            progbar.update(epoch, example_idx, [('f_score@5_exact', accumulators['exact'].macro('f_score@5')),
+                                                ('f_score@5_soft', accumulators['soft'].macro('f_score@5')),
+                                                ('f_score@10_exact', accumulators['exact'].macro('f_score@10')),
+                                                ('f_score@10_soft', accumulators['soft'].macro('f_score@10')),])
 
-                for k,v in out_dict.items():
-                    out_dict[k] = list(v)
-                    # print('len(%s) = %d' % (k, len(v)))
+            example_idx += 1
+        timing['report'] += time.time() - report_start
+
+    # the score whose confidence interval stops a budgeted evaluation, e.g. f_score@5_exact
+    if ci_width > 0:
+        ci_score, ci_mode = opt.report_score_names[0].rsplit('_', 1)
+    start_time = time.time()
+
+    try:
+        load_start = time.time()
+        for i, batch in enumerate(data_loader):
+            if max_seconds > 0 and time.time() - start_time >= max_seconds:
+                logger.info('Stop evaluating %s after %.1f seconds, %d/%d batches decoded' % (title, time.time() - start_time, i, len(data_loader)))
+                break
+            if ci_width > 0 and len(accumulators[ci_mode]) >= CI_MIN_DOCS:
+                _, lower, upper = bootstrap_interval(accumulators[ci_mode].scores()[ci_score], num_samples=getattr(opt, 'valid_bootstrap_samples', 1000))
+                if upper - lower <= ci_width:
+                    logger.info('Stop evaluating %s, the 95%% CI of %s is [%.4f, %.4f] after %d documents, %d/%d batches decoded' % (
+                        title, opt.report_score_names[0], lower, upper, len(accumulators[ci_mode]), i, len(data_loader)))
+                    break
+            decode_start = time.time()
+            timing['load'] += decode_start - load_start
 
-                # print(out_dict)
+            one2many_batch, one2one_batch = batch
+            src_list, src_len, trg_list, _, trg_copy_target_list, src_oov_map_list, oov_list, src_str_list, trg_str_list = one2many_batch
+            example_ids = data_loader.dataset.collated_order(next(batch_indices)) if eval_index is not None else [None] * len(src_str_list)
+            assert len(example_ids) == len(src_str_list)
 
-                assert len(out_dict['trg_str']) == len(out_dict['trg_present_flag'])
-                assert len(out_dict['pred_str']) == len(out_dict['present_flag']) \
-                       == len(out_dict['valid_flag']) == len(out_dict['match_flag']) == len(out_dict['pred_score'])
+            if torch.cuda.is_available():
+                src_list = src_list.cuda()
+                src_oov_map_list = src_oov_map_list.cuda()
 
-                with open(os.path.join(predict_save_path, title + '_detail', str(example_idx) + '.json'), 'w') as f_:
-                    f_.write(json.dumps(out_dict))
+            print("batch size - %s" % str(src_list.size(0)))
+            print("src size - %s" % str(src_list.size()))
+            print("target size - %s" % len(trg_copy_target_list))
 
-            progbar.update(epoch, example_idx, [('f_score@5_exact', np.average(score_dict['f_score@5_exact'])),
-                                                ('f_score@5_soft', np.average(score_dict['f_score@5_soft'])),
-                                                ('f_score@10_exact', np.average(score_dict['f_score@10_exact'])),
-                                                ('f_score@10_soft', np.average(score_dict['f_score@10_soft'])),])
+            try:
+                pred_seq_list = generator.beam_search(src_list, src_len, src_oov_map_list, oov_list, opt.word2id)
+            except RuntimeError as re:
+                logging.exception('Encountered OOM RuntimeError, now trying to predict one by one')
+                raise re
 
-            example_idx += 1
+            '''
+            process each example in current batch, by the scorers
+            '''
+            src_ids = src_list.cpu().data.numpy() if torch.cuda.is_available() else src_list.data.numpy()
+            examples = []
+            for src, src_str, trg, trg_str_seqs, trg_copy, pred_seq, oov, example_id in zip(src_ids, src_str_list, trg_list, trg_str_list, trg_copy_target_list, pred_seq_list, oov_list, example_ids):
+                eval_entry = None
+                if example_id is not None:
+                    eval_entry = (eval_index.source_keys(example_id), eval_index.target_keys(example_id),
+                                  eval_index.target_present_flags(example_id))
+                decoded = [DecodedSequence(list(seq.sentence), float(seq.score)) for seq in pred_seq]
+                examples.append((src[:len(src_str) + 5].tolist(), src_str, trg, trg_str_seqs, trg_copy, decoded, oov, eval_entry))
+            timing['decode'] += time.time() - decode_start
+
+            if scorer_pool is not None:
+                pending_batches.append((i, scorer_pool.apply_async(score_batch, (examples,))))
+            else:
+                pending_batches.append((i, InlineResult(score_batch(examples, opt))))
+            while len(pending_batches) > (pipeline_depth if scorer_pool is not None else 0):
+                report_batch(*pending_batches.popleft())
+            load_start = time.time()
+
+        while len(pending_batches) > 0:
+            report_batch(*pending_batches.popleft())
+    finally:
+        if scorer_pool is not None:
+            scorer_pool.terminate()
+            scorer_pool.join()
+
+    if prediction_writer is not None:
+        prediction_writer.close()
+
+    logger.info('Timing of %s (seconds): %s, with %d scorer processes' % (
+        title, ', '.join(['%s=%.2f' % (stage, t) for stage, t in timing.items()]), num_scorers))
+
+    # the per-document scores, as lists for json
+    for mode, accumulator in accumulators.items():
+        doc_scores = accumulator.scores()
+        for topk in topk_range:
+            for k in score_names:
+                score_dict['%s@%d_%s' % (k, topk, mode)] = doc_scores['%s@%d' % (k, topk)].tolist() if len(doc_scores) > 0 else []
+        for topk in topk_range:
+            logger.info('Micro@%d_%s: precision=%f, recall=%f, f_score=%f' % ((topk, mode) + accumulator.micro(topk)))
 
     logger.info('#(f_score@5_exact)=%d, sum=%f' % (len(score_dict['f_score@5_exact']), sum(score_dict['f_score@5_exact'])))
     logger.info('#(f_score@10_exact)=%d, sum=%f' % (len(score_dict['f_score@10_exact']), sum(score_dict['f_score@10_exact'])))
@@ -403,6 +602,7 @@ def evaluate_beam_search(generator, data_loader, opt, title='', epoch=1, predict
 
     for k,v in score_dict.items():
         logger.info('#(%s) = %d' % (k, len(v)))
+    log_score_intervals(logger, title, score_dict, opt)
 
     return score_dict
 
@@ -454,6 +654,24 @@ def stem_word_list(word_list):
     return [stemmer.stem(w.strip().lower()) for w in word_list]
 
 
+# stems of the vocab words (a pykp.stem_table.StemTable), set once the vocab is loaded
+stem_table = None
+
+
+def set_stem_table(table):
+    global stem_table
+    stem_table = table
+
+
+def stem_key_list(word_list):
+    '''
+    The stems of words as a tuple of keys that compare like the stems: stem ids with a stem table, strings otherwise
+    '''
+    if stem_table is not None:
+        return stem_table.stem_keys(word_list)
+    return tuple(stem_word_list(word_list))
+
+
 def macro_averaged_score(precisionlist, recalllist):
     precision = np.average(precisionlist)
     recall = np.average(recalllist)
@@ -463,13 +681,14 @@ def macro_averaged_score(precisionlist, recalllist):
     return precision, recall, f_score
 
 
-def get_match_result(true_seqs, pred_seqs, do_stem=True, type='exact'):
+def get_match_result(true_seqs, pred_seqs, do_stem=True, type='exact', true_keys=None):
     '''
     :param true_seqs:
     :param pred_seqs:
     :param do_stem:
     :param topn:
     :param type: 'exact' or 'partial'
+    :param true_keys: stem_key_list of each of true_seqs if already known (e.g. from the evaluation index of the dataset)
     :return:
     '''
     micro_metrics = []
@@ -484,8 +703,12 @@ def get_match_result(true_seqs, pred_seqs, do_stem=True, type='exact'):
 
     # convert target index into string
     if do_stem:
-        true_seqs = [stem_word_list(seq) for seq in true_seqs]
-        pred_seqs = [stem_word_list(seq) for seq in pred_seqs]
+        true_seqs = true_keys if true_keys is not None else [stem_key_list(seq) for seq in true_seqs]
+        pred_seqs = [stem_key_list(seq) for seq in pred_seqs]
+
+    if type == 'bleu':
+        # the n-grams of the targets are counted once for all the predictions
+        bleu_scorer = BleuScorer(true_seqs, BLEU_WEIGHTS)
 
     for pred_id, pred_seq in enumerate(pred_seqs):
         if type == 'exact':
@@ -516,27 +739,38 @@ def get_match_result(true_seqs, pred_seqs, do_stem=True, type='exact'):
 
         elif type == 'bleu':
             # account for the match of subsequences, like n-gram-based (BLEU) or LCS-based
-            match_score[pred_id] = bleu(pred_seq, true_seqs, [0.1, 0.3, 0.6])
+            match_score[pred_id] = bleu_scorer.score(pred_seq)
 
     return match_score
 
 
-def evaluate(match_list, predicted_list, true_list, topk=5):
-    if len(match_list) > topk:
-        match_list = match_list[:topk]
-    if len(predicted_list) > topk:
-        predicted_list = predicted_list[:topk]
+def get_bleu_result(true_seqs, pred_seqs_list, do_stem=True):
+    '''
+    The BLEU match scores (as get_match_result(type='bleu')) of several lists of predictions of the same targets,
+    e.g. the baseline and the sampled sequences of a document in RL training. The targets are stemmed and their n-grams
+    are counted once, each distinct prediction is scored once
+    :param pred_seqs_list: a list of lists of predictions
+    :return: a list of arrays of match scores, one per list of predictions
+    '''
+    if do_stem:
+        true_seqs = [stem_key_list(seq) for seq in true_seqs]
+    bleu_scorer = BleuScorer(true_seqs, BLEU_WEIGHTS)
 
-    # Micro-Averaged  Method
-    micropk = float(sum(match_list)) / float(len(predicted_list)) if len(predicted_list) > 0 else 0.0
-    micrork = float(sum(match_list)) / float(len(true_list)) if len(true_list) > 0 else 0.0
+    results = []
+    for pred_seqs in pred_seqs_list:
+        if do_stem:
+            pred_seqs = [stem_key_list(seq) for seq in pred_seqs]
+        results.append(np.asarray(bleu_scorer.score_all(pred_seqs), dtype='float32'))
+    return results
 
-    if micropk + micrork > 0:
-        microf1 = float(2 * (micropk * micrork)) / (micropk + micrork)
-    else:
-        microf1 = 0.0
 
-    return micropk, micrork, microf1
+def evaluate(match_list, predicted_list, true_list, topk=5):
+    '''
+    Precision, recall and F-score at topk of one document, see pykp.metric.keyphrase for a batch of documents
+    '''
+    matches, _ = match_matrix([match_list], topk)
+    scores = compute_metrics(matches, [len(predicted_list)], [len(true_list)], topk_range=[topk])
+    return float(scores['precision@%d' % topk][0]), float(scores['recall@%d' % topk][0]), float(scores['f_score@%d' % topk][0])
 
 
 def f1_score(prediction, ground_truth):
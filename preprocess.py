@@ -12,7 +12,10 @@ import os
 import torch
 
 import config
+import pykp.dedup
 import pykp.io
+import pykp.vocab
+from pykp.shards import manifest_path, subset_manifest, write_manifest
 
 parser = argparse.ArgumentParser(
     description='preprocess.py',
@@ -83,27 +86,43 @@ def main():
                                                        opt=opt,
                                                        valid_check=valid_check)
 
+    print("Indexing the title hashes of all the documents (for deduplicating appended documents)...")
+    title_hashes = pykp.dedup.build_title_hashes(
+        sum([pykp.dedup.load_json_titles(f, src_fields[0]) for f in [opt.source_train_file, opt.source_valid_file, opt.source_test_file]], []))
+    pykp.dedup.save_title_hashes(pykp.dedup.title_hash_path(opt.output_path, opt.dataset_name), title_hashes)
+
     print("Building Vocab...")
-    word2id, id2word, vocab = pykp.io.build_vocab(tokenized_train_pairs, opt)
+    word2id, id2word, vocab, approximate_counts = pykp.io.build_vocab(tokenized_train_pairs, opt)
     print('Vocab size = %d' % len(vocab))
+    if approximate_counts:
+        print('[Warning] the counts of rare words are approximate (-vocab_max_entries=%d)' % opt.vocab_max_entries)
     if opt.vocab_size > len(vocab):
         opt.vocab_size = len(vocab)
         print('Reset vocab size to %d' % opt.vocab_size)
 
     print("Dumping dict to disk")
-    opt.vocab_path = os.path.join(opt.subset_output_path, opt.dataset_name + '.vocab.pt')
-    torch.save([word2id, id2word, vocab], open(opt.vocab_path, 'wb'))
-    opt.vocab_path = os.path.join(opt.output_path, opt.dataset_name + '.vocab.pt')
-    torch.save([word2id, id2word, vocab], open(opt.vocab_path, 'wb'))
+    for output_path in [opt.subset_output_path, opt.output_path]:
+        if opt.vocab_format in ['bin', 'both']:
+            opt.vocab_path = os.path.join(output_path, opt.dataset_name + pykp.vocab.VOCAB_SUFFIX)
+            pykp.vocab.save_vocab(opt.vocab_path, [id2word[i] for i in range(len(id2word))],
+                                  [vocab.get(id2word[i], 0) for i in range(len(id2word))],
+                                  min_freq=opt.words_min_frequency, approximate=approximate_counts)
+        if opt.vocab_format in ['pt', 'both']:
+            opt.vocab_path = os.path.join(output_path, opt.dataset_name + pykp.vocab.LEGACY_VOCAB_SUFFIX)
+            torch.save([word2id, id2word, vocab], open(opt.vocab_path, 'wb'))
 
     print("Exporting a small dataset to %s (for debugging), "
           "size of train/valid/test is 20000" % opt.subset_output_path)
-    pykp.io.process_and_export_dataset(tokenized_train_pairs[:20000],
-                                       word2id, id2word,
-                                       opt,
-                                       opt.subset_output_path,
-                                       dataset_name=opt.dataset_name,
-                                       data_type='train')
+    if opt.num_shards > 1:
+        # the small training set is the manifest of the first shards of the complete one, see below
+        pass
+    else:
+        pykp.io.process_and_export_dataset(tokenized_train_pairs[:20000],
+                                           word2id, id2word,
+                                           opt,
+                                           opt.subset_output_path,
+                                           dataset_name=opt.dataset_name,
+                                           data_type='train')
 
     pykp.io.process_and_export_dataset(tokenized_valid_pairs,
                                        word2id, id2word,
@@ -122,12 +141,20 @@ def main():
                                        include_original=True)
 
     print("Exporting complete dataset to %s" % opt.output_path)
-    pykp.io.process_and_export_dataset(tokenized_train_pairs,
-                                       word2id, id2word,
-                                       opt,
-                                       opt.output_path,
-                                       dataset_name=opt.dataset_name,
-                                       data_type='train')
+    # a shard starts at the 20000th example, so that the small training set is made of whole shards
+    train_manifest = pykp.io.process_and_export_dataset(tokenized_train_pairs,
+                                                        word2id, id2word,
+                                                        opt,
+                                                        opt.output_path,
+                                                        dataset_name=opt.dataset_name,
+                                                        data_type='train',
+                                                        shard_boundaries=[20000])
+    if train_manifest is not None:
+        small_shards = subset_manifest(train_manifest, max_examples=20000)
+        small_manifest_path = manifest_path(os.path.join(opt.subset_output_path, opt.dataset_name + '.train.one2many'))
+        print("Exporting the manifest of the small training set (%d shards, %d examples): %s"
+              % (len(small_shards), sum([s['num_examples'] for s in small_shards]), small_manifest_path))
+        write_manifest(small_manifest_path, small_shards)
 
     pykp.io.process_and_export_dataset(tokenized_valid_pairs,
                                        word2id, id2word,
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Append new documents (raw json, one document per line) to a dataset processed by preprocess.py, without rebuilding it.
+The existing vocab (<dataset>.vocab.bin or .vocab.pt) is reused as is, only the new documents are tokenized and processed,
+and documents whose title is already in the dataset (any split) or repeated in the new file are skipped.
+"""
+import argparse
+import os
+
+import numpy as np
+
+import config
+import pykp.dedup
+import pykp.io
+import pykp.vocab
+
+parser = argparse.ArgumentParser(
+    description='preprocess_append.py',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+# **Preprocess Options**
+parser.add_argument('-dataset_name', required=True,
+                    help="Name of dataset")
+parser.add_argument('-source_file', required=True,
+                    help="The raw json file of the new documents")
+parser.add_argument('-data_type', default='train', choices=['train', 'valid', 'test'],
+                    help="The split the new documents are appended to")
+parser.add_argument('-output_path_prefix', default='data',
+                    help="Root of the processed datasets")
+parser.add_argument('-source_dataset_dir', default=None,
+                    help="The path to the original raw json files, used to build the title index if it doesn't exist")
+parser.add_argument('-skip_dedup', action='store_true',
+                    help="Append all the new documents without checking their titles")
+
+config.preprocess_opts(parser)
+opt = parser.parse_args()
+
+opt.output_path = os.path.join(opt.output_path_prefix, opt.dataset_name)
+opt.vocab_path = os.path.join(opt.output_path, opt.dataset_name + pykp.vocab.VOCAB_SUFFIX)
+
+
+def main():
+    if opt.dataset_name == 'kp20k':
+        src_fields = ['title', 'abstract']
+        trg_fields = ['keyword']
+        valid_check=True
+    elif opt.dataset_name == 'stackexchange':
+        src_fields = ['title', 'question']
+        trg_fields = ['tags']
+        valid_check=True
+    elif opt.dataset_name == 'twacg':
+        src_fields = ['observation']
+        trg_fields = ['admissible_commands']
+        valid_check=False
+    else:
+        raise Exception('Unsupported dataset name=%s' % opt.dataset_name)
+
+    print("Loading Vocab from %s..." % opt.vocab_path)
+    word2id, id2word, vocab = pykp.vocab.load_vocab(opt.vocab_path)
+    print('Vocab size = %d' % len(vocab))
+
+    print("Loading new data from %s..." % opt.source_file)
+    src_trgs_pairs = pykp.io.load_json_data(opt.source_file, opt.dataset_name,
+                                            src_fields=src_fields, trg_fields=trg_fields, trg_delimiter=';')
+
+    if not opt.skip_dedup:
+        hash_path = pykp.dedup.title_hash_path(opt.output_path, opt.dataset_name)
+        title_hashes = pykp.dedup.load_title_hashes(hash_path)
+        if title_hashes is None and opt.source_dataset_dir is not None:
+            print("Building the title index from %s..." % opt.source_dataset_dir)
+            source_files = [os.path.join(opt.source_dataset_dir, '%s_%s.json' % (opt.dataset_name, split))
+                            for split in ['training', 'validation', 'testing']]
+            title_hashes = pykp.dedup.build_title_hashes(
+                sum([pykp.dedup.load_json_titles(f, src_fields[0]) for f in source_files if os.path.exists(f)], []))
+        elif title_hashes is None:
+            print("[Warning] No title index in %s, only the new documents are deduplicated against each other" % opt.output_path)
+
+        titles = pykp.dedup.load_json_titles(opt.source_file, src_fields[0])
+        duplicated = pykp.dedup.find_duplicates(titles, title_hashes)
+        print("#(new documents)=%d, #(duplicated)=%d" % (len(titles), sum(duplicated)))
+        src_trgs_pairs = [pair for pair, dup in zip(src_trgs_pairs, duplicated) if not dup]
+        titles = [t for t, dup in zip(titles, duplicated) if not dup]
+
+    tokenized_pairs = pykp.io.tokenize_filter_data(src_trgs_pairs,
+                                                   tokenize_fn=pykp.io.copyseq_tokenize,
+                                                   opt=opt,
+                                                   valid_check=valid_check)
+
+    num_examples = pykp.io.append_and_export_dataset(tokenized_pairs,
+                                                     word2id, id2word,
+                                                     opt,
+                                                     opt.output_path,
+                                                     dataset_name=opt.dataset_name,
+                                                     data_type=opt.data_type,
+                                                     include_original=(opt.data_type != 'train'))
+    print("#(%s examples) after appending = %s" % (opt.data_type, str(num_examples)))
+
+    # the index is updated only once the documents are appended
+    if not opt.skip_dedup:
+        if title_hashes is None:
+            title_hashes = np.empty(0, dtype=np.uint64)
+        title_hashes = pykp.dedup.save_title_hashes(hash_path, np.concatenate([title_hashes, pykp.dedup.build_title_hashes(titles)]))
+        print("Updated the title index %s, #(titles)=%d" % (hash_path, len(title_hashes)))
+
+
+if __name__ == "__main__":
+    main()
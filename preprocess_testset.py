@@ -10,6 +10,7 @@ import torch
 
 import config
 import pykp.io
+import pykp.vocab
 
 
 parser = argparse.ArgumentParser(
@@ -35,7 +36,7 @@ def main():
     print("Loading Vocab...")
     opt.vocab_path = os.path.join(opt.output_path_prefix, 'kp20k', 'kp20k.vocab.pt')
     print(os.path.abspath(opt.vocab_path))
-    word2id, id2word, vocab = torch.load(opt.vocab_path, 'rb')
+    word2id, id2word, vocab = pykp.vocab.load_vocab(opt.vocab_path)
     print('Vocab size = %d' % len(vocab))
 
     for test_dataset_name in test_dataset_names:
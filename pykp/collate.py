@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized padding for the collate functions of pykp.io.KeyphraseDataset.
+Each field is padded in one pass: the tokens of all the sequences are concatenated into a flat array and scattered
+into a preallocated (reused) int64 buffer with a mask derived from the lengths. BOS/EOS are written in place,
+so the callers don't need to build [BOS] + seq + [EOS] lists.
+"""
+import itertools
+
+import numpy as np
+import torch
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+
+def length_mask(lens, width):
+    '''
+    :return: a (len(lens), width) int64 array, 1 for the real tokens and 0 for the padding
+    '''
+    return (np.arange(width)[None, :] < np.asarray(lens, dtype=np.int64)[:, None]).astype(np.int64)
+
+
+class Padder(object):
+    '''
+    Pads lists of sequences into LongTensors, the scratch buffer is kept across batches and grows on demand.
+    Returned tensors are copies, so they stay valid after the buffer is reused for the next field/batch.
+    '''
+
+    def __init__(self, pad_id):
+        self.pad_id = pad_id
+        self._buffer = np.empty(0, dtype=np.int64)
+
+    def __getstate__(self):
+        # don't send the scratch buffer to the worker processes
+        return {'pad_id': self.pad_id, '_buffer': np.empty(0, dtype=np.int64)}
+
+    def _get_buffer(self, num_rows, width):
+        size = num_rows * width
+        if size > len(self._buffer):
+            self._buffer = np.empty(max(size, 2 * len(self._buffer)), dtype=np.int64)
+        buffer = self._buffer[:size].reshape(num_rows, width)
+        buffer.fill(self.pad_id)
+        return buffer
+
+    def pad(self, seqs, bos=None, eos=None, max_length=None):
+        '''
+        Equivalent to pykp.io.KeyphraseDataset._pad([([bos] + s + [eos])[:max_length] for s in seqs])
+        :param seqs: a list of sequences of token ids (lists or 1-d arrays)
+        :param bos: id written before each sequence, None for no BOS
+        :param eos: id written after each sequence, None for no EOS
+        :param max_length: truncate the sequences (including BOS/EOS) to max_length
+        :return: (padded LongTensor, list of lengths, LongTensor mask)
+        '''
+        seq_lens = np.fromiter((len(s) for s in seqs), dtype=np.int64, count=len(seqs))
+        offset = 0 if bos is None else 1
+        full_lens = seq_lens + offset + (0 if eos is None else 1)
+        width = int(full_lens.max()) if len(seqs) > 0 else 0
+
+        x = self._get_buffer(len(seqs), width)
+        if bos is not None:
+            x[:, 0] = bos
+        # scatter all the tokens at once, row by row the mask selects positions [offset, offset + len)
+        tokens = np.fromiter(itertools.chain.from_iterable(seqs), dtype=np.int64, count=int(seq_lens.sum()))
+        positions = np.arange(width)[None, :]
+        x[(positions >= offset) & (positions < (seq_lens + offset)[:, None])] = tokens
+        if eos is not None:
+            x[np.arange(len(seqs)), seq_lens + offset] = eos
+
+        if max_length is not None and width > max_length:
+            width = max_length
+            full_lens = np.minimum(full_lens, max_length)
+            x = x[:, :width]
+
+        x_lens = full_lens.tolist()
+        return torch.from_numpy(x.copy()), x_lens, torch.from_numpy(length_mask(x_lens, width))
+
+    def select(self, x, x_lens, rows):
+        '''
+        Equivalent to padding [seqs[i] for i in rows] again, given x, x_lens = pad(seqs).
+        Used for unfolding one2many batches into one2one pairs without building the repeated lists
+        '''
+        lens = [x_lens[i] for i in rows]
+        width = max(lens) if len(lens) > 0 else 0
+        selected = x.index_select(0, torch.LongTensor(rows))[:, :width].contiguous()
+        return selected, lens, torch.from_numpy(length_mask(lens, width))
+
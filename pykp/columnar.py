@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar, memory-mappable storage for processed keyphrase datasets.
+
+A dataset is a directory holding one meta.json plus raw binary files. Every field is stored as a
+ragged column: a flat data array (int32 token ids, or uint8 utf-8 bytes for strings) and one int64
+offset array per nesting level. E.g. 'src' (list of ids) has 1 level, 'trg' (list of list of ids)
+has 2 levels, 'oov_list' (list of strings) has 2 levels (the last one indexes bytes) and 'trg_str'
+(list of list of strings) has 3 levels.
+
+    <path>/meta.json
+    <path>/<column>.data.bin        flat values (or <column>.data.z if block-compressed)
+    <path>/<column>.blocks.bin      byte offsets of each compressed block (only if compressed)
+    <path>/<column>.offsets<d>.bin  offsets of level d, len = #(items of level d-1) + 1
+
+All the arrays are opened with numpy.memmap, so fetching the i-th example only touches the bytes of
+that example (plus the two offsets that delimit it).
+"""
+import json
+import os
+import zlib
+
+import numpy as np
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+FORMAT_NAME = 'kp-columnar'
+FORMAT_VERSION = 1
+META_FILE = 'meta.json'
+
+DATA_DTYPE = {'int': np.int32, 'str': np.uint8}
+OFFSET_DTYPE = np.int64
+
+# column name -> (value type, number of nesting levels) for the one2many examples from pykp.io.process_data_examples
+ONE2MANY_COLUMNS = {
+    'src': ('int', 1),
+    'src_oov': ('int', 1),
+    'trg': ('int', 2),
+    'trg_copy': ('int', 2),
+    'oov_list': ('str', 2),
+    'src_str': ('str', 2),
+    'trg_str': ('str', 3),
+    'src_unk_words': ('str', 2),
+    'trg_unk_words': ('str', 3),
+}
+
+
+def is_columnar(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, META_FILE))
+
+
+def _flatten(value, levels, offsets, kind):
+    '''
+    Append the offsets of a nested value to `offsets` (one list per level) and return its flat leaves
+    '''
+    if levels == 1:
+        if kind == 'str':
+            value = value.encode('utf-8')
+        offsets[0].append(offsets[0][-1] + len(value))
+        return [value]
+
+    offsets[0].append(offsets[0][-1] + len(value))
+    leaves = []
+    for item in value:
+        leaves.extend(_flatten(item, levels - 1, offsets[1:], kind))
+    return leaves
+
+
+class _BlockCompressor(object):
+    '''
+    Compress a stream of values in fixed-size blocks with zlib, so that random access only inflates the touched blocks
+    '''
+    def __init__(self, data_file, block_file, dtype, block_size):
+        self.data_file = data_file
+        self.block_file = block_file
+        self.dtype = dtype
+        self.block_size = block_size
+        self.buffer = []
+        self.buffered = 0
+        self.written = 0
+        self.block_file.write(np.asarray([0], dtype=OFFSET_DTYPE).tobytes())
+
+    def write(self, values):
+        self.buffer.append(values)
+        self.buffered += len(values)
+        while self.buffered >= self.block_size:
+            self._flush_block(self.block_size)
+
+    def _flush_block(self, size):
+        values = np.concatenate(self.buffer)
+        blob = zlib.compress(values[:size].tobytes())
+        self.data_file.write(blob)
+        self.written += len(blob)
+        self.block_file.write(np.asarray([self.written], dtype=OFFSET_DTYPE).tobytes())
+        self.buffer = [values[size:]]
+        self.buffered = len(values) - size
+
+    def close(self):
+        if self.buffered > 0:
+            self._flush_block(self.buffered)
+
+
+class ColumnarWriter(object):
+    '''
+    Stream examples (dicts) into a columnar dataset directory.
+    :param columns: dict of column name -> (kind, levels), kind is 'int' or 'str'
+    :param compression: None or 'zlib'
+    :param block_size: number of values in each compressed block
+    :param attrs: extra attributes kept in meta.json, e.g. vocab_size
+    '''
+    def __init__(self, path, columns=ONE2MANY_COLUMNS, compression=None, block_size=1 << 16, attrs=None):
+        assert compression in [None, 'zlib']
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        self.path = path
+        self.columns = dict(columns)
+        self.compression = compression
+        self.block_size = block_size
+        self.attrs = attrs or {}
+        self.num_examples = 0
+
+        self._offsets = {}
+        self._data_files = {}
+        self._block_files = {}
+        self._compressors = {}
+
+        for name, (kind, levels) in self.columns.items():
+            self._offsets[name] = [[0] for _ in range(levels)]
+            if compression:
+                self._data_files[name] = open(os.path.join(path, '%s.data.z' % name), 'wb')
+                self._block_files[name] = open(os.path.join(path, '%s.blocks.bin' % name), 'wb')
+                self._compressors[name] = _BlockCompressor(self._data_files[name], self._block_files[name],
+                                                           DATA_DTYPE[kind], block_size)
+            else:
+                self._data_files[name] = open(os.path.join(path, '%s.data.bin' % name), 'wb')
+
+    def append(self, example):
+        for name, (kind, levels) in self.columns.items():
+            leaves = _flatten(example[name], levels, self._offsets[name], kind)
+            if kind == 'str':
+                values = np.frombuffer(b''.join(leaves), dtype=np.uint8)
+            else:
+                values = np.asarray([w for leaf in leaves for w in leaf], dtype=np.int32)
+
+            if self.compression:
+                self._compressors[name].write(values)
+            else:
+                self._data_files[name].write(values.tobytes())
+
+        self.num_examples += 1
+
+    def close(self):
+        for name in self.columns:
+            if self.compression:
+                self._compressors[name].close()
+                self._block_files[name].close()
+            self._data_files[name].close()
+            for level, offsets in enumerate(self._offsets[name]):
+                np.asarray(offsets, dtype=OFFSET_DTYPE).tofile(os.path.join(self.path, '%s.offsets%d.bin' % (name, level)))
+
+        meta = {
+            'format': FORMAT_NAME,
+            'version': FORMAT_VERSION,
+            'num_examples': self.num_examples,
+            'compression': self.compression,
+            'block_size': self.block_size,
+            'columns': dict((name, {'kind': kind, 'levels': levels}) for name, (kind, levels) in self.columns.items()),
+            'attrs': self.attrs,
+        }
+        with open(os.path.join(self.path, META_FILE), 'w') as meta_file:
+            json.dump(meta, meta_file, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def export_columnar(examples, path, columns=ONE2MANY_COLUMNS, compression=None, attrs=None):
+    '''
+    Dump a list of example dicts (e.g. the output of process_data_examples) into a columnar dataset.
+    Columns missing from the examples (e.g. src_str for training data) are skipped.
+    '''
+    if len(examples) > 0:
+        columns = dict((k, v) for k, v in columns.items() if k in examples[0])
+    with ColumnarWriter(path, columns=columns, compression=compression, attrs=attrs) as writer:
+        for e in examples:
+            writer.append(e)
+    return writer.num_examples
+
+
+def append_columnar(examples, path):
+    '''
+    Append examples to an existing uncompressed columnar dataset in place: data files are extended, offset files are
+    rewritten and meta.json (thus the number of examples visible to new readers) is updated last.
+    Compressed datasets can't be extended, export the new examples as a new shard instead.
+    :return: the number of examples after appending
+    '''
+    with open(os.path.join(path, META_FILE), 'r') as meta_file:
+        meta = json.load(meta_file)
+    if meta['compression']:
+        raise ValueError('Cannot append to a compressed columnar dataset: %s' % path)
+
+    for name, column in meta['columns'].items():
+        kind, levels = column['kind'], column['levels']
+        old_offsets = [np.fromfile(os.path.join(path, '%s.offsets%d.bin' % (name, level)), dtype=OFFSET_DTYPE)
+                       for level in range(levels)]
+        # continue from the last offset of each level
+        offsets = [[int(o[-1])] for o in old_offsets]
+        with open(os.path.join(path, '%s.data.bin' % name), 'ab') as data_file:
+            for e in examples:
+                leaves = _flatten(e[name], levels, offsets, kind)
+                if kind == 'str':
+                    data_file.write(b''.join(leaves))
+                else:
+                    data_file.write(np.asarray([w for leaf in leaves for w in leaf], dtype=np.int32).tobytes())
+        for level in range(levels):
+            np.concatenate([old_offsets[level], np.asarray(offsets[level][1:], dtype=OFFSET_DTYPE)]).tofile(
+                os.path.join(path, '%s.offsets%d.bin' % (name, level)))
+
+    meta['num_examples'] += len(examples)
+    tmp_path = os.path.join(path, META_FILE + '.tmp')
+    with open(tmp_path, 'w') as meta_file:
+        json.dump(meta, meta_file, indent=2)
+    os.replace(tmp_path, os.path.join(path, META_FILE))
+    return meta['num_examples']
+
+
+class ColumnarReader(object):
+    '''
+    O(1) random access to a columnar dataset. Files are memory-mapped on first use,
+    so a reader is cheap to create, to pickle and to fork.
+    '''
+    def __init__(self, path, columns=None, cache_blocks=8):
+        with open(os.path.join(path, META_FILE), 'r') as meta_file:
+            meta = json.load(meta_file)
+        assert meta['format'] == FORMAT_NAME, 'Not a columnar dataset: %s' % path
+
+        self.path = path
+        self.meta = meta
+        self.attrs = meta.get('attrs', {})
+        self.num_examples = meta['num_examples']
+        self.compression = meta['compression']
+        self.block_size = meta['block_size']
+        self.column_specs = dict((name, (spec['kind'], spec['levels'])) for name, spec in meta['columns'].items())
+        self.columns = [c for c in (columns or self.column_specs.keys()) if c in self.column_specs]
+        self.cache_blocks = cache_blocks
+
+        self._maps = None
+        self._block_cache = {}
+
+    def _open(self):
+        maps = {}
+        for name, (kind, levels) in self.column_specs.items():
+            offsets = [self._memmap('%s.offsets%d.bin' % (name, level), OFFSET_DTYPE) for level in range(levels)]
+            if self.compression:
+                data = self._memmap('%s.data.z' % name, np.uint8)
+                blocks = self._memmap('%s.blocks.bin' % name, OFFSET_DTYPE)
+            else:
+                data = self._memmap('%s.data.bin' % name, DATA_DTYPE[kind])
+                blocks = None
+            maps[name] = (offsets, data, blocks)
+        self._maps = maps
+
+    def _memmap(self, file_name, dtype):
+        file_path = os.path.join(self.path, file_name)
+        # np.memmap refuses to map empty files
+        if os.path.getsize(file_path) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(file_path, dtype=dtype, mode='r')
+
+    def close(self):
+        self._maps = None
+        self._block_cache = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_maps'] = None
+        state['_block_cache'] = {}
+        return state
+
+    def __len__(self):
+        return self.num_examples
+
+    def offsets(self, column, level=0):
+        if self._maps is None:
+            self._open()
+        return self._maps[column][0][level]
+
+    def lengths(self, column, level=0):
+        '''
+        Vectorized length of every item at the given level, e.g. lengths('trg') is the number of targets per example
+        '''
+        return np.diff(self.offsets(column, level))
+
+    def _data(self, column, start, end):
+        kind, _ = self.column_specs[column]
+        _, data, blocks = self._maps[column]
+        if not self.compression:
+            return data[start:end]
+
+        dtype = DATA_DTYPE[kind]
+        if end <= start:
+            return np.zeros(0, dtype=dtype)
+        first_block, last_block = start // self.block_size, (end - 1) // self.block_size
+        values = []
+        for b in range(first_block, last_block + 1):
+            key = (column, b)
+            if key not in self._block_cache:
+                if len(self._block_cache) >= self.cache_blocks:
+                    self._block_cache.pop(next(iter(self._block_cache)))
+                self._block_cache[key] = np.frombuffer(zlib.decompress(data[blocks[b]: blocks[b + 1]].tobytes()), dtype=dtype)
+            values.append(self._block_cache[key])
+        values = values[0] if len(values) == 1 else np.concatenate(values)
+        base = first_block * self.block_size
+        return values[start - base: end - base]
+
+    def _unflatten(self, column, kind, offsets, level, start, end):
+        '''
+        Rebuild the nested python value of items [start, end) at `level`
+        '''
+        if level == len(offsets) - 1:
+            # the last level indexes the flat data directly
+            data = self._data(column, int(offsets[level][start]), int(offsets[level][end]))
+            bounds = (offsets[level][start: end + 1] - offsets[level][start]).tolist()
+            if kind == 'str':
+                data = data.tobytes()
+                return [data[bounds[i]: bounds[i + 1]].decode('utf-8') for i in range(end - start)]
+            data = data.tolist()
+            return [data[bounds[i]: bounds[i + 1]] for i in range(end - start)]
+
+        bounds = offsets[level][start: end + 1]
+        children = self._unflatten(column, kind, offsets, level + 1, int(bounds[0]), int(bounds[-1]))
+        bounds = (bounds - bounds[0]).tolist()
+        return [children[bounds[i]: bounds[i + 1]] for i in range(end - start)]
+
+    def get(self, index, columns=None):
+        if self._maps is None:
+            self._open()
+        if index < 0:
+            index += self.num_examples
+        if index < 0 or index >= self.num_examples:
+            raise IndexError('index %d out of range of %d examples' % (index, self.num_examples))
+
+        example = {}
+        for name in (columns or self.columns):
+            kind, _ = self.column_specs[name]
+            offsets = self._maps[name][0]
+            example[name] = self._unflatten(name, kind, offsets, 0, index, index + 1)[0]
+        return example
+
+    def __getitem__(self, index):
+        return self.get(index)
+
+    def __iter__(self):
+        for i in range(self.num_examples):
+            yield self.get(i)
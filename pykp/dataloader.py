@@ -3,19 +3,26 @@
 Large chunk borrowed from PyTorch DataLoader
 """
 
+import atexit
 import os
+import tempfile
 
 __author__ = "Rui Meng"
 __email__ = "rui.meng@pitt.edu"
 
+import numpy as np
 import torch
 import torch.multiprocessing as multiprocessing
 from torch.utils.data.sampler import SequentialSampler, RandomSampler, BatchSampler
 import collections
+import io
+import itertools
+import pickle
 import re
 import sys
 import traceback
 import threading
+import weakref
 
 if sys.version_info[0] == 2:
     string_classes = basestring
@@ -40,16 +47,36 @@ class ExceptionWrapper(object):
         self.exc_msg = "".join(traceback.format_exception(*exc_info))
 
 
-def _worker_loop(dataset, index_queue, data_queue, collate_fn):
+def memory_usage():
+    '''
+    Memory of the current process in MB from /proc/self/smaps_rollup: (RSS, private, shared).
+    Private pages include the copy-on-write pages a forked worker has duplicated from the parent,
+    shared pages include the memory-mapped dataset. None if not available (non-Linux or old kernels)
+    '''
+    try:
+        with open('/proc/self/smaps_rollup') as smaps_file:
+            smaps = dict(line.split(':', 1) for line in smaps_file if ':' in line and not line[0].isdigit())
+        smaps = dict((k, int(v.split()[0]) / 1024.0) for k, v in smaps.items())
+        return (smaps['Rss'], smaps['Private_Clean'] + smaps['Private_Dirty'], smaps['Shared_Clean'] + smaps['Shared_Dirty'])
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def _worker_loop(dataset, index_queue, data_queue, collate_fn, worker_id=0, report_memory=False):
     global _use_shared_memory
     _use_shared_memory = True
 
     torch.set_num_threads(1)
+    num_batches = 0
     while True:
         r = index_queue.get()
         if r is None:
+            if report_memory and memory_usage() is not None:
+                print('[DataLoader worker %d] #(batches)=%d, RSS=%.1fMB (private=%.1fMB, shared=%.1fMB)'
+                      % ((worker_id, num_batches) + memory_usage()))
             data_queue.put(None)
             break
+        num_batches += 1
         idx, batch_indices = r
         try:
             samples = collate_fn([dataset[i] for i in batch_indices])
@@ -148,17 +175,18 @@ def pin_memory_batch(batch):
 
 
 class DataLoaderIter(object):
-    "Iterates once over the DataLoader's dataset, as specified by the sampler"
+    "Iterates once over the DataLoader's dataset, as specified by the sampler, starting from the batch `start`"
 
-    def __init__(self, loader):
+    def __init__(self, loader, start=0):
         self.dataset = loader.dataset
         self.collate_fn = loader.collate_fn
         self.batch_sampler = loader.batch_sampler
         self.num_workers = loader.num_workers
         self.pin_memory = loader.pin_memory
+        self.report_worker_memory = loader.report_worker_memory
         self.done_event = threading.Event()
 
-        self.sample_iter = iter(self.batch_sampler)
+        self.sample_iter = itertools.islice(iter(self.batch_sampler), start, None)
 
         if self.num_workers > 0:
             self.index_queue = multiprocessing.SimpleQueue()
@@ -172,8 +200,8 @@ class DataLoaderIter(object):
             self.workers = [
                 multiprocessing.Process(
                     target=_worker_loop,
-                    args=(self.dataset, self.index_queue, self.data_queue, self.collate_fn))
-                for _ in range(self.num_workers)]
+                    args=(self.dataset, self.index_queue, self.data_queue, self.collate_fn, i, self.report_worker_memory))
+                for i in range(self.num_workers)]
 
             for w in self.workers:
                 w.daemon = True  # ensure that the worker exits on process exit
@@ -262,6 +290,356 @@ class DataLoaderIter(object):
             self._shutdown_workers()
 
 
+def _pool_worker_loop(datasets, index_queue, data_queue, worker_id=0, report_memory=False):
+    global _use_shared_memory
+    _use_shared_memory = True
+
+    torch.set_num_threads(1)
+    num_batches = 0
+    while True:
+        r = index_queue.get()
+        if r is None:
+            if report_memory and memory_usage() is not None:
+                print('[DataLoader worker %d] #(batches)=%d, RSS=%.1fMB (private=%.1fMB, shared=%.1fMB)'
+                      % ((worker_id, num_batches) + memory_usage()))
+            break
+        if r[0] == 'register':
+            # a loader registered after the pool was started
+            _, key, dataset, collate_fn = r
+            datasets[key] = (dataset, collate_fn)
+            continue
+
+        num_batches += 1
+        _, iter_id, idx, key, batch_indices = r
+        try:
+            dataset, collate_fn = datasets[key]
+            samples = collate_fn([dataset[i] for i in batch_indices])
+        except Exception:
+            data_queue.put((iter_id, idx, ExceptionWrapper(sys.exc_info())))
+        else:
+            data_queue.put((iter_id, idx, samples))
+
+
+class WorkerPool(object):
+    """
+    A pool of worker processes kept alive across epochs and evaluations, shared by several KeyphraseDataLoaders.
+    The workers are forked at the first iteration, so the datasets registered before (usually all of them)
+    are inherited rather than pickled. Each worker has its own index queue, results of all the workers come back
+    through one data queue, tagged by the iterator that requested them.
+    Workers are shut down by shutdown(), at exit, or when any of them dies.
+
+    Arguments:
+        num_workers (int): number of worker processes
+        report_memory (bool): print the RSS of each worker when it exits
+        timeout (float): seconds between two liveness checks of the workers while waiting for a batch
+    """
+
+    def __init__(self, num_workers, report_memory=False, timeout=5.0):
+        self.num_workers    = num_workers
+        self.report_memory  = report_memory
+        self.timeout        = timeout
+        self.datasets       = {}
+        self.workers        = []
+        self.index_queues   = []
+        self.data_queue     = None
+        self.started        = False
+        self.closed         = False
+
+        # results received for other iterators, {iter_id: {idx: batch}}
+        self.pending        = {}
+        # number of outstanding batches of each live iterator
+        self.outstanding    = {}
+        self.next_iter_id   = 0
+        self.next_worker    = 0
+        atexit.register(self.shutdown)
+
+    def register(self, dataset, collate_fn):
+        key = len(self.datasets)
+        self.datasets[key] = (dataset, collate_fn)
+        for index_queue in self.index_queues:
+            index_queue.put(('register', key, dataset, collate_fn))
+        return key
+
+    def start(self):
+        if self.started:
+            return
+        if self.closed:
+            raise RuntimeError('The worker pool has been shut down')
+        self.data_queue = multiprocessing.Queue()
+        for i in range(self.num_workers):
+            index_queue = multiprocessing.Queue()
+            w = multiprocessing.Process(
+                target=_pool_worker_loop,
+                args=(self.datasets, index_queue, self.data_queue, i, self.report_memory))
+            w.daemon = True  # ensure that the worker exits on process exit
+            w.start()
+            self.workers.append(w)
+            self.index_queues.append(index_queue)
+        self.started = True
+
+    def new_iterator(self):
+        self.start()
+        iter_id = self.next_iter_id
+        self.next_iter_id += 1
+        self.pending[iter_id] = {}
+        self.outstanding[iter_id] = 0
+        return iter_id
+
+    def close_iterator(self, iter_id):
+        # results still in flight are dropped when they arrive
+        self.pending.pop(iter_id, None)
+        if self.outstanding.get(iter_id, 0) == 0:
+            self.outstanding.pop(iter_id, None)
+
+    def put(self, iter_id, idx, key, indices):
+        self.index_queues[self.next_worker].put(('batch', iter_id, idx, key, indices))
+        self.next_worker = (self.next_worker + 1) % self.num_workers
+        self.outstanding[iter_id] += 1
+
+    def get(self, iter_id, idx):
+        '''
+        Wait for the batch idx of iterator iter_id, keeping the batches of the other iterators aside
+        '''
+        while idx not in self.pending[iter_id]:
+            try:
+                r_iter_id, r_idx, batch = self.data_queue.get(timeout=self.timeout)
+            except queue.Empty:
+                if any(not w.is_alive() for w in self.workers):
+                    self.shutdown()
+                    raise RuntimeError('DataLoader worker exited unexpectedly')
+                continue
+            self.outstanding[r_iter_id] -= 1
+            if r_iter_id in self.pending:
+                self.pending[r_iter_id][r_idx] = batch
+            elif self.outstanding[r_iter_id] == 0:
+                self.outstanding.pop(r_iter_id)
+        return self.pending[iter_id].pop(idx)
+
+    def shutdown(self):
+        if self.closed:
+            return
+        self.closed = True
+        if not self.started:
+            return
+        for index_queue in self.index_queues:
+            index_queue.put(None)
+        for w in self.workers:
+            w.join(timeout=self.timeout)
+            if w.is_alive():
+                w.terminate()
+        self.data_queue.cancel_join_thread()
+        for index_queue in self.index_queues:
+            index_queue.cancel_join_thread()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+
+class PooledDataLoaderIter(object):
+    "Iterates once over the DataLoader's dataset with the workers of a WorkerPool, starting from the batch `start`"
+
+    def __init__(self, loader, start=0):
+        self.pool = loader.worker_pool
+        self.key = loader.pool_key
+        self.pin_memory = loader.pin_memory
+        self.batch_sampler = loader.batch_sampler
+        self.sample_iter = itertools.islice(iter(self.batch_sampler), start, None)
+
+        self.iter_id = self.pool.new_iterator()
+        self.send_idx = 0
+        self.rcvd_idx = 0
+        self.closed = False
+
+        # prime the prefetch loop
+        for _ in range(2 * self.pool.num_workers):
+            self._put_indices()
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __next__(self):
+        if self.rcvd_idx == self.send_idx:
+            self.close()
+            raise StopIteration
+
+        try:
+            batch = self.pool.get(self.iter_id, self.rcvd_idx)
+        except BaseException:
+            self.close()
+            raise
+        self.rcvd_idx += 1
+        self._put_indices()
+        if isinstance(batch, ExceptionWrapper):
+            self.close()
+            raise batch.exc_type(batch.exc_msg)
+        if self.pin_memory:
+            batch = pin_memory_batch(batch)
+        return batch
+
+    next = __next__  # Python 2 compatibility
+
+    def __iter__(self):
+        return self
+
+    def _put_indices(self):
+        indices = next(self.sample_iter, None)
+        if indices is None:
+            return
+        self.pool.put(self.iter_id, self.send_idx, self.key, indices)
+        self.send_idx += 1
+
+    def __getstate__(self):
+        raise NotImplementedError("DataLoaderIterator cannot be pickled")
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.pool.close_iterator(self.iter_id)
+
+    def __del__(self):
+        self.close()
+
+
+class _OnDisk(object):
+    "Position of a batch spilled into the blob file of a BatchCache"
+
+    def __init__(self, offset, length):
+        self.offset = offset
+        self.length = length
+
+
+def _batch_nbytes(batch):
+    '''
+    Rough memory footprint of a collated batch: size of the tensors plus a few bytes per python object
+    '''
+    if torch.is_tensor(batch):
+        return batch.numel() * batch.element_size()
+    elif hasattr(batch, 'data') and torch.is_tensor(batch.data):  # Variable
+        return _batch_nbytes(batch.data)
+    elif isinstance(batch, string_classes):
+        return len(batch) + 48
+    elif isinstance(batch, (list, tuple)):
+        return sum([_batch_nbytes(b) for b in batch]) + 8 * len(batch) + 56
+    elif isinstance(batch, dict):
+        return sum([_batch_nbytes(k) + _batch_nbytes(v) for k, v in batch.items()]) + 100
+    return 28
+
+
+# the caches with a blob file, weakly referenced so that the cleanup at exit doesn't keep them alive
+_spilled_caches = weakref.WeakSet()
+
+
+@atexit.register
+def _clear_spilled_caches():
+    for cache in list(_spilled_caches):
+        cache.clear()
+
+
+class BatchCache(object):
+    """
+    Keeps the collated batches of a loader whose batches never change (e.g. validation and test sets, not shuffled),
+    so that later iterations don't load the dataset nor collate again.
+    Batches are kept in memory up to max_memory_mb, the following ones are pickled into a blob file in cache_dir
+    (the system temporary directory by default), which is removed by clear(), when the cache is released or at exit.
+    The cache is filled while iterating, and is complete once an iteration reached the end of the loader.
+    """
+
+    def __init__(self, max_memory_mb=1024, cache_dir=None):
+        self.max_memory     = max_memory_mb * 1024 * 1024
+        self.cache_dir      = cache_dir
+        # batch objects, or _OnDisk positions in the blob file
+        self.batches        = []
+        self.memory_size    = 0
+        self.disk_size      = 0
+        self.blob_path      = None
+        self.blob_file      = None
+        self.complete       = False
+
+    def __len__(self):
+        return len(self.batches)
+
+    def append(self, batch):
+        nbytes = _batch_nbytes(batch)
+        if self.memory_size + nbytes <= self.max_memory:
+            self.batches.append(batch)
+            self.memory_size += nbytes
+            return
+
+        if self.blob_file is None:
+            fd, self.blob_path = tempfile.mkstemp(prefix='batch_cache_', suffix='.bin', dir=self.cache_dir)
+            self.blob_file = os.fdopen(fd, 'w+b')
+            _spilled_caches.add(self)
+        data = pickle.dumps(batch, protocol=pickle.HIGHEST_PROTOCOL)
+        self.blob_file.seek(0, os.SEEK_END)
+        self.batches.append(_OnDisk(self.blob_file.tell(), len(data)))
+        self.blob_file.write(data)
+        self.disk_size += len(data)
+
+    def get(self, idx):
+        batch = self.batches[idx]
+        if isinstance(batch, _OnDisk):
+            self.blob_file.flush()
+            self.blob_file.seek(batch.offset)
+            batch = pickle.load(io.BytesIO(self.blob_file.read(batch.length)))
+        return batch
+
+    def clear(self):
+        self.batches = []
+        self.memory_size, self.disk_size = 0, 0
+        self.complete = False
+        if self.blob_file is not None:
+            self.blob_file.close()
+            self.blob_file = None
+            if os.path.exists(self.blob_path):
+                os.remove(self.blob_path)
+            _spilled_caches.discard(self)
+
+    def __del__(self):
+        self.clear()
+
+    def __str__(self):
+        return '#(batches)=%d, complete=%s, memory=%.1fMB, disk=%.1fMB' % \
+               (len(self.batches), self.complete, self.memory_size / 1048576.0, self.disk_size / 1048576.0)
+
+
+class CachedDataLoaderIter(object):
+    "Serves the batches kept by the loader's BatchCache, and collates (and caches) the ones after them"
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.cache = loader.batch_cache
+        self.idx = 0
+        self.iterator = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __next__(self):
+        if self.idx < len(self.cache):
+            batch = self.cache.get(self.idx)
+        elif self.cache.complete:
+            raise StopIteration
+        else:
+            if self.iterator is None:
+                self.iterator = self.loader._iter_batches(start=self.idx)
+            try:
+                batch = next(self.iterator)
+            except StopIteration:
+                self.cache.complete = True
+                raise
+            self.cache.append(batch)
+        self.idx += 1
+        return batch
+
+    next = __next__  # Python 2 compatibility
+
+    def __iter__(self):
+        return self
+
+
 class KeyphraseDataLoader(object):
     """
     Data loader. Combines a dataset and a sampler, and provides
@@ -288,19 +666,30 @@ class KeyphraseDataLoader(object):
             if the dataset size is not divisible by the batch size. If ``False`` and
             the size of dataset is not divisible by the batch size, then the last batch
             will be smaller. (default: False)
+        worker_pool (WorkerPool, optional): persistent workers shared with other loaders,
+            they are not restarted at every iteration. Overrides num_workers.
+        batch_cache (BatchCache, optional): keep the collated batches across iterations,
+            only for loaders that always yield the same batches (shuffle must be False).
     """
 
     def __init__(self, dataset, max_batch_example=5, max_batch_pair=1, shuffle=False, sampler=None, batch_sampler=None,
-                 num_workers=0, collate_fn=default_collate, pin_memory=False, drop_last=False):
+                 num_workers=0, collate_fn=default_collate, pin_memory=False, drop_last=False,
+                 bucket_sampling=False, bucket_width=10, max_batch_tokens=0, seed=9527, report_worker_memory=False,
+                 worker_pool=None, batch_cache=None):
         self.dataset            = dataset
         # used for generating one2many batches
-        self.num_trgs           = [len(e['trg']) for e in dataset.get_examples()]
+        self.num_trgs           = dataset.get_num_trgs()
         self.batch_size         = max_batch_pair
         self.max_example_number = max_batch_example
         self.num_workers        = num_workers
         self.collate_fn         = collate_fn
         self.pin_memory         = pin_memory
         self.drop_last          = drop_last
+        # print the RSS of each worker when it exits
+        self.report_worker_memory = report_worker_memory
+        # persistent workers shared with other loaders, num_workers is ignored if given
+        self.worker_pool        = worker_pool
+        self.pool_key           = worker_pool.register(dataset, collate_fn) if worker_pool is not None else None
 
         if batch_sampler is not None:
             if max_batch_pair > 1 or shuffle or sampler is not None or drop_last:
@@ -310,20 +699,45 @@ class KeyphraseDataLoader(object):
         if sampler is not None and shuffle:
             raise ValueError('sampler is mutually exclusive with shuffle')
 
+        if batch_cache is not None and shuffle:
+            raise ValueError('batch_cache is mutually exclusive with shuffle')
+        self.batch_cache        = batch_cache
+
         if batch_sampler is None:
             if sampler is None:
                 if shuffle:
-                    sampler = RandomSampler(dataset)
+                    sampler = EpochRandomSampler(dataset, seed=seed)
                 else:
                     sampler = SequentialSampler(dataset)
 
-        batch_sampler = One2ManyBatchSampler(sampler, self.num_trgs, max_batch_example=max_batch_example, max_batch_pair=max_batch_pair, drop_last=drop_last)
+        if batch_sampler is None:
+            if bucket_sampling:
+                batch_sampler = BucketBatchSampler(dataset.get_metadata(), max_batch_example=max_batch_example,
+                                                   max_batch_pair=max_batch_pair, max_batch_tokens=max_batch_tokens,
+                                                   bucket_width=bucket_width, shuffle=shuffle, drop_last=drop_last, seed=seed)
+            else:
+                batch_sampler = One2ManyBatchSampler(sampler, self.num_trgs, max_batch_example=max_batch_example, max_batch_pair=max_batch_pair, drop_last=drop_last)
 
         self.sampler = sampler
         self.batch_sampler = batch_sampler
 
     def __iter__(self):
-        return DataLoaderIter(self)
+        if self.batch_cache is not None:
+            return CachedDataLoaderIter(self)
+        return self._iter_batches()
+
+    def iter_from(self, start):
+        '''
+        Iterate over the batches of the epoch from the batch start, e.g. to resume a training in the middle of an epoch
+        '''
+        if self.batch_cache is not None:
+            return itertools.islice(iter(self), start, None)
+        return self._iter_batches(start)
+
+    def _iter_batches(self, start=0):
+        if self.worker_pool is not None:
+            return PooledDataLoaderIter(self, start)
+        return DataLoaderIter(self, start)
 
     def __len__(self):
         return len(self.batch_sampler)
@@ -331,13 +745,85 @@ class KeyphraseDataLoader(object):
     def one2one_number(self):
         return sum(self.num_trgs)
 
+    def padding_statistics(self):
+        '''
+        (#real tokens, #padded tokens) of the current batches, computed from the dataset metadata
+        '''
+        return padding_statistics(self.batch_sampler, self.dataset.get_metadata())
+
+def estimate_num_batches(num_trgs, max_batch_example, max_batch_pair):
+    '''
+    Estimate the number of batches of split_one2many_batches from the average number of targets, without batching
+    :param num_trgs: number of targets of each example
+    '''
+    num_examples = len(num_trgs)
+    if num_examples == 0:
+        return 0
+    avg_trgs = float(sum(num_trgs)) / num_examples
+    examples_per_batch = min(max_batch_example, max((max_batch_pair - 1) / max(avg_trgs, 1.0), 1.0))
+    return int(np.ceil(num_examples / examples_per_batch))
+
+
+def split_one2many_batches(items, num_trgs, max_batch_example, max_batch_pair, drop_last=False):
+    '''
+    Group a stream of one2many items (indices or examples) into batches, with running counters of the number of
+    examples and the number of targets (num_trgs(item)) of the current batch.
+    A batch is closed before it reaches max_batch_example examples or max_batch_pair targets,
+    an item exceeding the limits on its own forms a batch.
+    '''
+    batch = []
+    number_trgs = 0
+    for item in items:
+        item_trgs = num_trgs(item)
+        if len(batch) < max_batch_example and number_trgs + item_trgs < max_batch_pair:
+            batch.append(item)
+            number_trgs += item_trgs
+        elif len(batch) == 0: # if the batch_size is very small, return a batch of only one data sample
+            yield [item]
+        else:
+            yield batch
+            batch = [item]
+            number_trgs = item_trgs
+
+    if len(batch) > 0 and not drop_last:
+        yield batch
+
+
+class EpochRandomSampler(object):
+    """Samples elements randomly without replacement, the permutation is determined by (seed + epoch).
+    Unlike torch's RandomSampler, the order of an epoch can be reproduced (e.g. when resuming a training).
+
+    Arguments:
+        data_source (Dataset): dataset to sample from
+        seed (int): base random seed, the permutation of epoch i is drawn with seed + i
+    """
+
+    def __init__(self, data_source, seed=9527):
+        self.data_source = data_source
+        self.seed        = seed
+        self.epoch       = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        return iter(np.random.RandomState(self.seed + self.epoch).permutation(len(self.data_source)).tolist())
+
+    def __len__(self):
+        return len(self.data_source)
+
+
 class One2ManyBatchSampler(object):
     """Wraps another sampler to yield a mini-batch of indices.
     Return batches of one2many pairs of which the sum of target sequences should not exceed the batch_size
     For example, if batch_size is 20 and a list of 7 examples whose number of targets are [7,5,7,6,9,7,12]
         then they are split into 4 batches: [7, 5], [7, 6], [9, 7], [12], sum of each is smaller than 20
 
-    Original implementation is lazy loading, which cannot give the final length. Modified to load at once
+    Batches are generated lazily from the order given by the sampler at every iteration, with running counters of
+    #(examples) and #(targets) of the current batch. If the sampler has set_epoch() (e.g. EpochRandomSampler),
+    call set_epoch() before each epoch to get a new permutation.
+    The length is either exact (one pass over the sampler order with the same counters, cached per epoch)
+    or estimated from the average number of targets when exact_len=False.
 
     Args:
         sampler (Sampler): Base sampler.
@@ -345,6 +831,7 @@ class One2ManyBatchSampler(object):
         batch_size (int): Size of mini-batch.
         drop_last (bool): If ``True``, the sampler will drop the last batch if
             its size would be less than ``batch_size``
+        exact_len (bool): If ``False``, __len__ returns an estimation without iterating the sampler
 
     Example:
         >>> list(BatchSampler(range(10), batch_size=3, drop_last=False))
@@ -353,40 +840,169 @@ class One2ManyBatchSampler(object):
         [[0, 1, 2], [3, 4, 5], [6, 7, 8]]
     """
 
-    def __init__(self, sampler, num_trgs, max_batch_example, max_batch_pair, drop_last):
+    def __init__(self, sampler, num_trgs, max_batch_example, max_batch_pair, drop_last, exact_len=True):
         self.sampler            = sampler
         self.num_trgs           = num_trgs
         self.max_batch_pair     = max_batch_pair
         self.max_batch_example  = max_batch_example
         self.drop_last          = drop_last
+        self.exact_len          = exact_len
+        self.epoch              = 0
+
+        # number of batches of the current epoch, computed on demand
+        self.final_num_batch    = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+            self.final_num_batch = None
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'seed': getattr(self.sampler, 'seed', None)}
+
+    def load_state_dict(self, state):
+        if state.get('seed') is not None and hasattr(self.sampler, 'seed'):
+            self.sampler.seed = state['seed']
+        self.set_epoch(state['epoch'])
+
+    def _generate_batches(self):
+        return split_one2many_batches(self.sampler, lambda idx: self.num_trgs[idx], self.max_batch_example,
+                                      self.max_batch_pair, self.drop_last)
+
+    def __iter__(self):
+        num_batch = 0
+        for batch in self._generate_batches():
+            num_batch += 1
+            yield batch
+        self.final_num_batch = num_batch
+
+    def __len__(self):
+        if self.final_num_batch is None:
+            if not self.exact_len:
+                return estimate_num_batches(self.num_trgs, self.max_batch_example, self.max_batch_pair)
+            self.final_num_batch = sum(1 for _ in self._generate_batches())
+        return self.final_num_batch
+
+
+def padding_statistics(batches, metadata):
+    """
+    Count the real and the padded number of tokens of a list of batches (lists of example indices).
+    Sources are padded to the longest source of the batch and targets to the longest target, both with BOS/EOS.
+    Returns (#real tokens, #padded tokens)
+    """
+    src_lens = metadata['src_len'].astype(np.int64) + 2
+    trg_lens = metadata['max_trg_len'].astype(np.int64) + 2
+    num_trgs = metadata['num_trgs'].astype(np.int64)
+
+    real_tokens, padded_tokens = 0, 0
+    for batch in batches:
+        batch = np.asarray(batch)
+        real_tokens += src_lens[batch].sum() + (num_trgs[batch] * trg_lens[batch]).sum()
+        padded_tokens += src_lens[batch].max() * len(batch) + trg_lens[batch].max() * num_trgs[batch].sum()
+    return int(real_tokens), int(padded_tokens)
+
+
+def stratified_subset(src_lens, num_docs, num_strata=10, seed=9527):
+    '''
+    A fixed random subset of num_docs examples, stratified by source length: the examples are split into num_strata
+    groups of similar lengths (of equal sizes), and each group contributes in proportion to its size.
+    :return: the sorted indices of the subset, all the examples if num_docs >= len(src_lens)
+    '''
+    src_lens = np.asarray(src_lens)
+    if num_docs >= len(src_lens):
+        return np.arange(len(src_lens))
+    rng = np.random.RandomState(seed)
+    # equal-sized strata of the examples sorted by length (ties broken randomly)
+    strata = np.array_split(np.lexsort((rng.permutation(len(src_lens)), src_lens)), max(1, min(num_strata, num_docs)))
+    # the number of examples drawn from each stratum, rounded on the cumulative counts so that they sum to num_docs
+    quotas = np.diff(np.round(np.cumsum([0] + [len(stratum) for stratum in strata]) * float(num_docs) / len(src_lens)).astype(np.int64))
+    subset = [rng.choice(stratum, quota, replace=False) for stratum, quota in zip(strata, quotas)]
+    return np.sort(np.concatenate(subset))
+
+
+class BucketBatchSampler(object):
+    """Yield one2many batches of examples with similar source lengths.
+    Examples are grouped into buckets of width `bucket_width` (in source tokens). If shuffle, the examples in each bucket
+    and the order of batches are shuffled at every epoch, so the randomness is kept at the bucket level.
+    A batch is closed when any of the limits would be exceeded:
+        #(docs) >= max_batch_example, #(targets) >= max_batch_pair, or
+        #(padded tokens) = max_src_len * #(docs) + max_trg_len * #(targets) > max_batch_tokens (0 means no token budget)
+    A single example exceeding the limits forms a batch on its own.
+
+    Args:
+        metadata (dict): per-example metadata of the dataset, see pykp.metadata
+        indices (list of int, optional): batch only these examples (e.g. a validation subset, see stratified_subset)
+    """
+
+    def __init__(self, metadata, max_batch_example, max_batch_pair, max_batch_tokens=0,
+                 bucket_width=10, shuffle=False, drop_last=False, seed=9527, indices=None):
+        self.src_lens           = metadata['src_len'].astype(np.int64) + 2
+        self.trg_lens           = metadata['max_trg_len'].astype(np.int64) + 2
+        self.num_trgs           = metadata['num_trgs'].astype(np.int64)
+        self.metadata           = metadata
+        self.max_batch_example  = max_batch_example
+        self.max_batch_pair     = max_batch_pair
+        self.max_batch_tokens   = max_batch_tokens
+        self.bucket_width       = bucket_width
+        self.shuffle            = shuffle
+        self.drop_last          = drop_last
+        self.seed               = seed
+        self.epoch              = 0
+        self.indices            = np.asarray(indices, dtype=np.int64) if indices is not None else None
+
+        self.batches            = self._build_batches()
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.batches = self._build_batches()
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'seed': self.seed}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.set_epoch(state['epoch'])
+
+    def _build_batches(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        bucket_ids = self.src_lens // max(self.bucket_width, 1)
+        # sort by bucket, and inside a bucket either randomly or by the exact length
+        tie_breaker = rng.permutation(len(bucket_ids)) if self.shuffle else self.src_lens
+        order = np.lexsort((tie_breaker, bucket_ids))
+        if self.indices is not None:
+            order = order[np.isin(order, self.indices)]
 
         batches = []
-        batch = []
-        for idx in self.sampler:
-            # number of targets sequences in current batch
-            number_trgs = sum([self.num_trgs[id] for id in batch])
-            if len(batch) < self.max_batch_example and number_trgs + self.num_trgs[idx] < self.max_batch_pair:
-                batch.append(idx)
-            elif len(batch) == 0: # if the batch_size is very small, return a batch of only one data sample
-                batch.append(idx)
-                batches.append(batch)
-                # print('batch %d: #(src)=%d, #(trg)=%d \t\t %s' % (len(batches), len(batch), number_trgs, str(batch)))
-                batch = []
-            else:
+        batch, max_src, max_trg, number_trgs = [], 0, 0, 0
+        for idx in order.tolist():
+            new_max_src = max(max_src, self.src_lens[idx])
+            new_max_trg = max(max_trg, self.trg_lens[idx])
+            new_number_trgs = number_trgs + self.num_trgs[idx]
+            padded_tokens = new_max_src * (len(batch) + 1) + new_max_trg * new_number_trgs
+
+            if len(batch) > 0 and (len(batch) >= self.max_batch_example
+                                   or new_number_trgs >= self.max_batch_pair
+                                   or (self.max_batch_tokens > 0 and padded_tokens > self.max_batch_tokens)):
                 batches.append(batch)
-                # print('batch %d: #(src)=%d, #(trg)=%d \t\t %s' % (len(batches), len(batch), number_trgs, str(batch)))
-                batch = []
-                batch.append(idx)
+                batch, max_src, max_trg, number_trgs = [], 0, 0, 0
+                new_max_src, new_max_trg, new_number_trgs = self.src_lens[idx], self.trg_lens[idx], self.num_trgs[idx]
+
+            batch.append(idx)
+            max_src, max_trg, number_trgs = new_max_src, new_max_trg, new_number_trgs
 
         if len(batch) > 0 and not self.drop_last:
             batches.append(batch)
 
-        self.batches         = batches
-        self.final_num_batch = len(batches)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def padding_statistics(self):
+        return padding_statistics(self.batches, self.metadata)
 
     def __iter__(self):
         return self.batches.__iter__()
 
     def __len__(self):
-        return self.final_num_batch
-
+        return len(self.batches)
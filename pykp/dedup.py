@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Title hashes of the documents of a processed dataset, used to skip documents that are already in it when appending.
+The index is a sorted array of unique uint64 hashes, <output_path>/<dataset>.title_hashes.npy, covering all the splits
+(so that new training documents can't leak documents of the validation/test sets).
+"""
+import codecs
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+
+def title_hash_path(output_path, dataset_name):
+    return os.path.join(output_path, '%s.title_hashes.npy' % dataset_name)
+
+
+def title_hash(title):
+    '''
+    64-bit hash of a title, insensitive to case, punctuation and spacing
+    '''
+    normalized = ' '.join(re.findall(r'\w+', title.lower(), re.UNICODE))
+    return int(hashlib.md5(normalized.encode('utf-8')).hexdigest()[:16], 16)
+
+
+def load_json_titles(path, title_field='title'):
+    '''
+    Titles of a json file (one document per line), in the order of pykp.io.load_json_data
+    '''
+    titles = []
+    with codecs.open(path, "r", "utf-8") as corpus_file:
+        for line in corpus_file:
+            titles.append(json.loads(line)[title_field])
+    return titles
+
+
+def build_title_hashes(titles):
+    return np.unique(np.asarray([title_hash(t) for t in titles], dtype=np.uint64))
+
+
+def load_title_hashes(path):
+    if not os.path.exists(path):
+        return None
+    return np.load(path)
+
+
+def save_title_hashes(path, hashes):
+    hashes = np.unique(np.asarray(hashes, dtype=np.uint64))
+    # np.save appends .npy to paths without it, keep the suffix on the temporary file
+    tmp_path = path[:-len('.npy')] + '.tmp.npy'
+    np.save(tmp_path, hashes)
+    os.replace(tmp_path, path)
+    return hashes
+
+
+def find_duplicates(titles, existing_hashes=None):
+    '''
+    :return: a list of flags, True for the titles in existing_hashes or seen earlier in titles
+    '''
+    hashes = np.asarray([title_hash(t) for t in titles], dtype=np.uint64)
+    duplicated = np.zeros(len(titles), dtype=bool)
+    if existing_hashes is not None and len(existing_hashes) > 0:
+        duplicated |= np.isin(hashes, existing_hashes)
+    # keep the first occurrence of the titles repeated in the new documents
+    _, first_index = np.unique(hashes, return_index=True)
+    repeated = np.ones(len(titles), dtype=bool)
+    repeated[first_index] = False
+    return (duplicated | repeated).tolist()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Evaluation index of a one2many dataset: the ground truth facts that evaluate_beam_search needs at every validation
+round, computed once instead of re-stemming every source and target at every round.
+A .npz file next to the dataset (<dataset>.<split>.one2many.evalidx.npz), one entry per example in dataset order:
+    stemmed source      stem ids of the source words, the n-gram index of the source (pykp.phrase_match) is built on it
+    stemmed targets     stem ids of the words of each target
+    presence flags      whether each target appears in the stemmed source, stem-duplicated targets are absent
+                        (as evaluate.if_present_duplicate_phrases with stemming and check_duplicate)
+    target hashes       64-bit hash of each stemmed target (phrase_hash), independent of the vocab
+Stem ids are local to the index (the stems are stored with it), bind() maps them to the keys of a pykp.stem_table.StemTable.
+"""
+import hashlib
+import os
+
+import numpy as np
+
+from pykp.phrase_match import NgramIndex
+from pykp.stem_table import stem_word
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+EVAL_INDEX_SUFFIX = '.evalidx.npz'
+
+
+def eval_index_path(data_path):
+    '''
+    x.one2many.pt and x.one2many.col share the same index x.one2many.evalidx.npz
+    '''
+    for suffix in ['.pt', '.col']:
+        if data_path.endswith(suffix):
+            data_path = data_path[:-len(suffix)]
+            break
+    return data_path + EVAL_INDEX_SUFFIX
+
+
+def phrase_hash(stems):
+    '''
+    :param stems: the stems of the words of a phrase
+    :return: the first 8 bytes of the md5 of the stems, as an unsigned 64-bit integer
+    '''
+    return int(hashlib.md5(' '.join(stems).encode('utf-8')).hexdigest()[:16], 16)
+
+
+def _offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    return offsets
+
+
+def build_eval_index(examples):
+    '''
+    :param examples: an iterable of examples with src_str and trg_str (e.g. a KeyphraseDataset with include_original)
+    :return: a dict of arrays
+    '''
+    stem2id, word2stem = {}, {}
+
+    def stem_ids(words):
+        ids = []
+        for w in words:
+            if w not in word2stem:
+                word2stem[w] = stem2id.setdefault(stem_word(w), len(stem2id))
+            ids.append(word2stem[w])
+        return ids
+
+    src_ids, src_lens = [], []
+    trg_ids, trg_lens, num_trgs, trg_present = [], [], [], []
+    for e in examples:
+        src = stem_ids(e['src_str'])
+        src_ids.extend(src)
+        src_lens.append(len(src))
+        src_index = NgramIndex(src)
+        phrase_set = set()
+        num_trgs.append(len(e['trg_str']))
+        for trg_str in e['trg_str']:
+            trg = tuple(stem_ids(trg_str))
+            trg_ids.extend(trg)
+            trg_lens.append(len(trg))
+            trg_present.append(src_index.find(trg) >= 0 and trg not in phrase_set)
+            phrase_set.add(trg)
+
+    stems = [s for s, _ in sorted(stem2id.items(), key=lambda x: x[1])]
+    encoded = [s.encode('utf-8') for s in stems]
+    trg_len_offsets = _offsets(trg_lens)
+    trg_hashes = [phrase_hash([stems[s] for s in trg_ids[trg_len_offsets[i]: trg_len_offsets[i + 1]]])
+                  for i in range(len(trg_lens))]
+    return {'stem_offsets': _offsets([len(s) for s in encoded]),
+            'stem_bytes': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+            'src_stem_ids': np.asarray(src_ids, dtype=np.int32),
+            'src_offsets': _offsets(src_lens),
+            'trg_stem_ids': np.asarray(trg_ids, dtype=np.int32),
+            'trg_len_offsets': trg_len_offsets,
+            'trg_offsets': _offsets(num_trgs),
+            'trg_present': np.asarray(trg_present, dtype=np.bool_),
+            'trg_hashes': np.asarray(trg_hashes, dtype=np.uint64)}
+
+
+class EvalIndex(object):
+    """
+    Arguments:
+        arrays (dict): output of build_eval_index, or the content of an index file
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        offsets, data = arrays['stem_offsets'], arrays['stem_bytes'].tobytes()
+        self.stems = [data[offsets[i]: offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+        self.bind(None)
+
+    def __len__(self):
+        return len(self.arrays['src_offsets']) - 1
+
+    def bind(self, stem_table):
+        '''
+        Map the local stem ids to the keys of stem_table (evaluate.stem_key_list), or to the stems themselves if None
+        '''
+        self.stem_table = stem_table
+        if stem_table is None:
+            self._keys = self.stems
+        else:
+            self._keys = [stem_table.stem2id.get(s, s) for s in self.stems]
+
+    def _key_tuple(self, ids):
+        keys = self._keys
+        return tuple(keys[i] for i in ids.tolist())
+
+    def source_keys(self, index):
+        start, end = self.arrays['src_offsets'][index], self.arrays['src_offsets'][index + 1]
+        return self._key_tuple(self.arrays['src_stem_ids'][start: end])
+
+    def _target_range(self, index):
+        return self.arrays['trg_offsets'][index], self.arrays['trg_offsets'][index + 1]
+
+    def target_keys(self, index):
+        start, end = self._target_range(index)
+        len_offsets, ids = self.arrays['trg_len_offsets'], self.arrays['trg_stem_ids']
+        return [self._key_tuple(ids[len_offsets[t]: len_offsets[t + 1]]) for t in range(start, end)]
+
+    def target_present_flags(self, index):
+        start, end = self._target_range(index)
+        return self.arrays['trg_present'][start: end].tolist()
+
+    def target_hashes(self, index):
+        start, end = self._target_range(index)
+        return self.arrays['trg_hashes'][start: end]
+
+
+def save_eval_index(path, eval_index):
+    # write to a temporary file first, readers never see a half-written index
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **eval_index.arrays)
+    os.replace(tmp_path, path)
+
+
+def load_eval_index(path):
+    with np.load(path) as npz:
+        return EvalIndex(dict((k, npz[k]) for k in npz.files))
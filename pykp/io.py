@@ -2,6 +2,7 @@
 """
 Python File Template 
 """
+import atexit
 import codecs
 import inspect
 import itertools
@@ -10,12 +11,21 @@ import pickle
 import re
 import os
 import copy
+import shutil
+import tempfile
 from collections import Counter
 from collections import defaultdict
 import numpy as np
 from torch.autograd import Variable
 
 from evaluate import if_present_duplicate_phrases, if_present_phrase
+from pykp.collate import Padder
+from pykp.columnar import ColumnarReader, append_columnar, export_columnar, is_columnar
+from pykp.eval_index import EvalIndex, build_eval_index, eval_index_path, load_eval_index, save_eval_index
+from pykp.metadata import build_metadata, build_metadata_from_columnar, example_costs, load_metadata, metadata_path, \
+    print_metadata_statistics, save_metadata
+from pykp.shards import load_manifest, manifest_path, shard_prefix, split_by_tokens, write_manifest
+from pykp.vocab import SPECIAL_WORDS, count_tokens_parallel, sorted_words
 
 __author__ = "Rui Meng"
 __email__ = "rui.meng@pitt.edu"
@@ -44,6 +54,13 @@ torchtext.vocab.Vocab.__getstate__ = __getstate__
 torchtext.vocab.Vocab.__setstate__ = __setstate__
 
 
+def src_len_order(src_lens):
+    '''
+    Order of the examples in a one2many batch, by decreasing source length
+    '''
+    return np.argsort([l + 2 for l in src_lens])[::-1]
+
+
 class KeyphraseDataset(torch.utils.data.Dataset):
     def __init__(self, data_path, word2id, id2word,
                  type='one2many',
@@ -58,6 +75,12 @@ class KeyphraseDataset(torch.utils.data.Dataset):
         self.include_original = include_original
 
         self._examples = None
+        # columnar datasets (see pykp.columnar) are memory-mapped and read example by example
+        self._reader = None
+        self.columnar = is_columnar(data_path)
+        self._columnar_path = data_path
+        self._metadata = None
+        self._eval_index = None
         if self.lazy_load:
             print('Data will be loaded while needed from %s' % data_path)
         else:
@@ -66,19 +89,25 @@ class KeyphraseDataset(torch.utils.data.Dataset):
 
     def _load_examples(self):
         print(self.data_path)
+        if self.columnar:
+            self._get_reader()
+            return
+
         one2many_examples = torch.load(self.data_path, 'rb')
         # keys of matter. `src_oov_map` is for mapping pointed word to dict, `oov_dict` is for determining the dim of predicted logit: dim=vocab_size+max_oov_dict_in_batch
+        # oov_dict and the original strings are only stored by the full schema, slim examples are restored in __getitem__
         keys = ['src', 'trg', 'trg_copy', 'src_oov', 'oov_dict', 'oov_list']
 
         if self.include_original:
-            keys = keys + ['src_str', 'trg_str']
+            keys = keys + ['src_str', 'trg_str', 'src_unk_words', 'trg_unk_words']
 
         filtered_examples = []
 
         for e in one2many_examples:
             filtered_example = {}
             for k in keys:
-                filtered_example[k] = e[k]
+                if k in e:
+                    filtered_example[k] = e[k]
 
             # truncate long source text
             if len(e['src']) > 1000:
@@ -94,70 +123,180 @@ class KeyphraseDataset(torch.utils.data.Dataset):
         self._examples = filtered_examples
 
 
+    def _get_reader(self):
+        if self._reader is None:
+            keys = ['src', 'trg', 'trg_copy', 'src_oov', 'oov_list']
+            if self.include_original:
+                # the columns that don't exist are skipped, older datasets have the strings, slim ones the unk words
+                keys = keys + ['src_str', 'trg_str', 'src_unk_words', 'trg_unk_words']
+            self._reader = ColumnarReader(self._columnar_path, columns=keys)
+        return self._reader
+
+    def _get_columnar_example(self, index):
+        reader = self._get_reader()
+        # oov_dict is not stored, it's determined by the order of oov_list
+        return restore_example(reader.get(index), self.id2word, self.word2id[UNK_WORD],
+                               include_original=self.include_original, vocab_size=reader.attrs.get('vocab_size'))
+
     def get_examples(self):
+        """
+        Materialize all the examples in memory. Avoid it for columnar datasets, use __getitem__ or get_num_trgs() instead
+        """
+        if self.columnar:
+            if self._examples is None:
+                self._examples = [self._get_columnar_example(i) for i in range(len(self))]
+            return self._examples
+
         if self._examples == None:
             self._load_examples()
         return self._examples
 
+    def get_metadata(self):
+        """
+        Per-example metadata (see pykp.metadata), read from the sidecar index exported by preprocessing.
+        Without a sidecar, it's derived from the columnar offsets, or computed from the examples and cached to disk
+        """
+        if self._metadata is None:
+            meta_path = metadata_path(self.data_path)
+            if os.path.exists(meta_path):
+                self._metadata = load_metadata(meta_path)
+            elif self.columnar:
+                self._metadata = build_metadata_from_columnar(self._get_reader())
+            else:
+                self._metadata = build_metadata(self.get_examples())
+                try:
+                    save_metadata(meta_path, self._metadata)
+                except (IOError, OSError):
+                    pass
+        return self._metadata
+
+    def get_eval_index(self):
+        """
+        The evaluation index of the dataset (see pykp.eval_index), only for datasets loaded with include_original.
+        It's read from the sidecar next to the dataset, or built at the first call and cached to disk.
+        An index older than the dataset (e.g. after appending documents) or of another size is rebuilt
+        """
+        if not self.include_original:
+            return None
+        if self._eval_index is None:
+            index_path = eval_index_path(self.data_path)
+            if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(self.data_path):
+                self._eval_index = load_eval_index(index_path)
+                if len(self._eval_index) != len(self):
+                    self._eval_index = None
+            if self._eval_index is None:
+                print('Building the evaluation index of %s' % self.data_path)
+                self._eval_index = EvalIndex(build_eval_index(self[i] for i in range(len(self))))
+                try:
+                    save_eval_index(index_path, self._eval_index)
+                except (IOError, OSError):
+                    pass
+        return self._eval_index
+
+    def collated_order(self, indices):
+        """
+        The example ids of a batch of indices in the order of collate_fn_one2many, computed from the metadata
+        """
+        src_lens = self.get_metadata()['src_len']
+        return [indices[i] for i in src_len_order([src_lens[idx] for idx in indices])]
+
+    def get_num_trgs(self):
+        """
+        Number of targets of each example, never deserializes the examples if the metadata index exists
+        """
+        return self.get_metadata()['num_trgs']
+
+    def share_memory(self, vocab_size, shared_dir=None):
+        """
+        Move the examples of a .pt dataset into a columnar copy under shared_dir (/dev/shm by default) and serve them from there.
+        DataLoader workers memory-map the same pages instead of touching the parent's list of dicts, whose refcount
+        updates would make every forked worker end up with a private copy of the dataset. The copy is removed at exit.
+        :param vocab_size: the vocab_size used in preprocessing, oov ids of the examples start from it
+        """
+        if self.columnar:
+            return self._columnar_path
+
+        # metadata are computed from the examples before releasing them
+        self.get_metadata()
+        if shared_dir is None and os.path.isdir('/dev/shm'):
+            shared_dir = '/dev/shm'
+        tmp_dir = tempfile.mkdtemp(prefix='keyphrase_dataset_', dir=shared_dir)
+        atexit.register(shutil.rmtree, tmp_dir, True)
+
+        columnar_path = os.path.join(tmp_dir, os.path.basename(self.data_path) + '.col')
+        print('Moving dataset %s to shared memory: %s' % (self.data_path, columnar_path))
+        export_columnar(self.get_examples(), columnar_path, attrs={'vocab_size': vocab_size})
+
+        self._examples = None
+        self._reader = None
+        self._columnar_path = columnar_path
+        self.columnar = True
+        return columnar_path
+
     def offload_dataset(self):
         # print('Offloading dataset %s:' % self.data_path)
         self._examples = None
+        # columnar datasets are only unmapped, the OS page cache keeps them warm for the next round
+        if self._reader is not None:
+            self._reader.close()
 
     def __getitem__(self, index):
-        return self.get_examples()[index]
+        if self.columnar:
+            return self._get_columnar_example(index)
+        return restore_example(self.get_examples()[index], self.id2word, self.word2id[UNK_WORD],
+                               include_original=self.include_original)
 
     def __len__(self):
+        if self.columnar:
+            return len(self._get_reader())
+        # don't reload an offloaded dataset just for its size
+        if self._examples is None and os.path.exists(metadata_path(self.data_path)):
+            return len(self.get_num_trgs())
         return len(self.get_examples())
 
-    def _pad(self, x_raw):
-        x_raw = np.asarray(x_raw)
-        x_lens = [len(x_) for x_ in x_raw]
-        max_length = max(x_lens)  # (deprecated) + 1 to ensure at least one padding appears in the end
-        # x_lens = [x_len + 1 for x_len in x_lens]
-        x = np.array([np.concatenate((x_, [self.pad_id] * (max_length - len(x_)))) for x_ in x_raw])
-        x = Variable(torch.stack([torch.from_numpy(x_) for x_ in x], 0)).type('torch.LongTensor')
-        x_mask = np.array([[1] * x_len + [0] * (max_length - x_len) for x_len in x_lens])
-        x_mask = Variable(torch.stack([torch.from_numpy(m_) for m_ in x_mask], 0))
+    def _get_padder(self):
+        if getattr(self, '_padder', None) is None:
+            self._padder = Padder(self.pad_id)
+        return self._padder
 
-        assert x.size(1) == max_length
+    def _pad(self, x_raw, bos=None, eos=None, max_length=None):
+        x, x_lens, x_mask = self._get_padder().pad(x_raw, bos=bos, eos=eos, max_length=max_length)
+        return Variable(x), x_lens, Variable(x_mask)
 
-        return x, x_lens, x_mask
+    def _select(self, x, x_lens, rows):
+        x, x_lens, x_mask = self._get_padder().select(x.data, x_lens, rows)
+        return Variable(x), x_lens, Variable(x_mask)
 
     def collate_fn_one2one(self, batches):
         '''
         Puts each data field into a tensor with outer dimension batch size"
         '''
-        src = [[self.word2id[BOS_WORD]] + b['src'] + [self.word2id[EOS_WORD]] for b in batches]
+        bos, eos = self.word2id[BOS_WORD], self.word2id[EOS_WORD]
+        # source with BOS/EOS
+        src, src_lens, src_mask = self._pad([b['src'] for b in batches], bos=bos, eos=eos)
         # target_input: input to decoder, starts with BOS and oovs are replaced with <unk>
-        trg = [[self.word2id[BOS_WORD]] + b['trg'] + [self.word2id[EOS_WORD]] for b in batches]
+        trg, _, _ = self._pad([b['trg'] for b in batches], bos=bos, eos=eos)
 
         # target_for_loss: input to criterion, if it's copy model, oovs are replaced with temporary idx, e.g. 50000, 50001 etc.)
-        trg_target = [b['trg'] + [self.word2id[EOS_WORD]] for b in batches]
-        trg_copy_target = [b['trg_copy'] + [self.word2id[EOS_WORD]] for b in batches]
+        trg_target, _, _ = self._pad([b['trg'] for b in batches], eos=eos)
+        trg_copy_target, _, _ = self._pad([b['trg_copy'] for b in batches], eos=eos)
         # extended src (unk words are replaced with temporary idx, e.g. 50000, 50001 etc.)
-        src_ext = [[self.word2id[BOS_WORD]] + b['src_oov'] + [self.word2id[EOS_WORD]] for b in batches]
-        src, src_lens, src_mask = self._pad(src)
-        trg, _, _ = self._pad(trg)
-        trg_target, _, _ = self._pad(trg_target)
-        trg_copy_target, _, _ = self._pad(trg_copy_target)
-        src_ext, src_ext_lens, src_ext_mask = self._pad(src_ext)
+        src_ext, src_ext_lens, src_ext_mask = self._pad([b['src_oov'] for b in batches], bos=bos, eos=eos)
 
         oov_lists = [b['oov_list'] for b in batches]
 
         return src, trg, trg_target, trg_copy_target, src_ext, oov_lists
 
     def collate_fn_one2many(self, batches):
-        # source with oov words replaced by <unk>
-        src = [[self.word2id[BOS_WORD]] + b['src'] + [self.word2id[EOS_WORD]] for b in batches]
-        # extended src (oov words are replaced with temporary idx, e.g. 50000, 50001 etc.)
-        src_oov = [[self.word2id[BOS_WORD]] + b['src_oov'] + [self.word2id[EOS_WORD]] for b in batches]
-        # target_input: input to decoder, starts with BOS and oovs are replaced with <unk>
-        trg = [[[self.word2id[BOS_WORD]] + t + [self.word2id[EOS_WORD]] for t in b['trg']] for b in batches]
+        bos, eos = self.word2id[BOS_WORD], self.word2id[EOS_WORD]
+
+        # sort all the examples in the order of source lengths, to meet the requirement of pack_padded_sequence
+        batches = [batches[i] for i in src_len_order([len(b['src']) for b in batches])]
 
-        # target_for_loss: input to criterion
-        trg_target = [[t + [self.word2id[EOS_WORD]] for t in b['trg']] for b in batches]
+        # target_input: input to decoder, starts with BOS and oovs are replaced with <unk>
+        trg = [[[bos] + t + [eos] for t in b['trg']] for b in batches]
         # target for copy model, oovs are replaced with temporary idx, e.g. 50000, 50001 etc.)
-        trg_copy_target = [[t + [self.word2id[EOS_WORD]] for t in b['trg_copy']] for b in batches]
+        trg_copy_target = [[t + [eos] for t in b['trg_copy']] for b in batches]
         oov_lists = [b['oov_list'] for b in batches]
 
         # for training, the trg_copy_target_o2o and trg_copy_target_o2m is the final target (no way to uncover really unseen words). for evaluation, the trg_str is the final target.
@@ -165,63 +304,30 @@ class KeyphraseDataset(torch.utils.data.Dataset):
             src_str = [b['src_str'] for b in batches]
             trg_str = [b['trg_str'] for b in batches]
 
-        # sort all the sequences in the order of source lengths, to meet the requirement of pack_padded_sequence
-        src_len_order = np.argsort([len(s) for s in src])[::-1]
-        src = [src[i] for i in src_len_order]
-        src_oov = [src_oov[i] for i in src_len_order]
-
-        # !TODO a temp workaround for OOM problem, truncate src length
-        src = [s if len(s) < 1000 else s[:1000] for s in src]
-        src_oov = [s if len(s) < 1000 else s[:1000] for s in src_oov]
-
-        trg = [trg[i] for i in src_len_order]
-        trg_target = [trg_target[i] for i in src_len_order]
-        trg_copy_target = [trg_copy_target[i] for i in src_len_order]
-        oov_lists = [oov_lists[i] for i in src_len_order]
-        if self.include_original:
-            src_str = [src_str[i] for i in src_len_order]
-            trg_str = [trg_str[i] for i in src_len_order]
-
         # pad the one2many variables
-        src_o2m, src_o2m_len, _ = self._pad(src)
+        # source with oov words replaced by <unk>, and extended src (oov words are replaced with temporary idx, e.g. 50000, 50001 etc.)
+        # !TODO a temp workaround for OOM problem, truncate src length
+        src_o2m, src_o2m_len, _ = self._pad([b['src'] for b in batches], bos=bos, eos=eos, max_length=1000)
+        src_oov_o2m, _, _ = self._pad([b['src_oov'] for b in batches], bos=bos, eos=eos, max_length=1000)
         trg_o2m = trg
-        src_oov_o2m, _, _ = self._pad(src_oov)
-        # trg_target_o2m, _, _      = self._pad(trg_target)
         trg_copy_target_o2m = trg_copy_target
         oov_lists_o2m = oov_lists
 
-        # unfold the one2many pairs and pad the one2one variables
-        src_o2o, src_o2o_len, _ = self._pad(list(itertools.chain(*[[src[idx]] * len(t) for idx, t in enumerate(trg)])))
-        src_oov_o2o, _, _ = self._pad(list(itertools.chain(*[[src_oov[idx]] * len(t) for idx, t in enumerate(trg)])))
-        trg_o2o, _, _ = self._pad(list(itertools.chain(*[t for t in trg])))
-        trg_target_o2o, _, _ = self._pad(list(itertools.chain(*[t for t in trg_target])))
-        trg_copy_target_o2o, _, _ = self._pad(list(itertools.chain(*[t for t in trg_copy_target])))
-        oov_lists_o2o = list(itertools.chain(*[[oov_lists[idx]] * len(t) for idx, t in enumerate(trg)]))
+        # unfold the one2many pairs and pad the one2one variables, sources are selected from the one2many tensors
+        o2o_rows = list(itertools.chain(*[[idx] * len(b['trg']) for idx, b in enumerate(batches)]))
+        src_o2o, src_o2o_len, _ = self._select(src_o2m, src_o2m_len, o2o_rows)
+        src_oov_o2o, _, _ = self._select(src_oov_o2m, src_o2m_len, o2o_rows)
+        trg_o2o, _, _ = self._pad(list(itertools.chain(*[b['trg'] for b in batches])), bos=bos, eos=eos)
+        trg_target_o2o, _, _ = self._pad(list(itertools.chain(*[b['trg'] for b in batches])), eos=eos)
+        trg_copy_target_o2o, _, _ = self._pad(list(itertools.chain(*[b['trg_copy'] for b in batches])), eos=eos)
+        oov_lists_o2o = [oov_lists[idx] for idx in o2o_rows]
 
-        assert (len(src) == len(src_o2m) == len(src_oov_o2m) == len(trg_copy_target_o2m) == len(oov_lists_o2m))
+        assert (len(batches) == len(src_o2m) == len(src_oov_o2m) == len(trg_copy_target_o2m) == len(oov_lists_o2m))
         assert (sum([len(t) for t in trg]) == len(src_o2o) == len(src_oov_o2o) == len(trg_copy_target_o2o) == len(oov_lists_o2o))
         assert (src_o2m.size() == src_oov_o2m.size())
         assert (src_o2o.size() == src_oov_o2o.size())
         assert ([trg_o2o.size(0), trg_o2o.size(1) - 1] == list(trg_target_o2o.size()) == list(trg_copy_target_o2o.size()))
 
-        '''
-        for s, s_o2m, t, s_str, t_str in zip(src, src_o2m.data.numpy(), trg, src_str, trg_str):
-            print('=' * 30)
-            print('[Source Str] %s' % s_str)
-            print('[Target Str] %s' % str(t_str))
-            print('[Source]     %s' % str([self.id2word[w] for w in s]))
-            print('[Source O2M] %s' % str([self.id2word[w] for w in s_o2m]))
-            print('[Targets]    %s' % str([[self.id2word[w] for w in tt] for tt in t]))
-
-
-        for s, s_o2o, t, t_o2o in zip(list(itertools.chain(*[[src[idx]]*len(t) for idx,t in enumerate(trg)])), src_o2o.data.numpy(), list(itertools.chain(*[t for t in trg])), trg_o2o.data.numpy()):
-            print('=' * 30)
-            print('[Source]        %s' % str([self.id2word[w] for w in s]))
-            print('[Target]        %s' % str([self.id2word[w] for w in t]))
-            print('[Source O2O]    %s' % str([self.id2word[w] for w in s_o2o]))
-            print('[Target O2O]    %s' % str([self.id2word[w] for w in t_o2o]))
-        '''
-
         # return two tuples, 1st for one2many and 2nd for one2one (src, src_oov, trg, trg_target, trg_copy_target, oov_lists)
         if self.include_original:
             return (src_o2m, src_o2m_len, trg_o2m, None, trg_copy_target_o2m, src_oov_o2m, oov_lists_o2m, src_str, trg_str), (src_o2o, src_o2o_len, trg_o2o, trg_target_o2o, trg_copy_target_o2o, src_oov_o2o, oov_lists_o2o)
@@ -253,6 +359,24 @@ class KeyphraseDatasetTorchText(torchtext.data.Dataset):
         super(KeyphraseDatasetTorchText, self).__init__(examples, fields, **kwargs)
 
 
+def resolve_dataset_path(data_path):
+    """
+    Prefer the columnar version (*.one2many.col) of a processed dataset if it has been exported next to the .pt file
+    """
+    if data_path.endswith('.pt') and is_columnar(data_path[:-len('.pt')] + '.col'):
+        return data_path[:-len('.pt')] + '.col'
+    return data_path
+
+
+def convert_to_columnar(data_path, columnar_path, vocab_size, max_unk_words, compression=None):
+    """
+    Convert an existing one2many dataset (a torch.save-d list of dicts) into the columnar format
+    """
+    examples = torch.load(data_path, 'rb')
+    return export_columnar(examples, columnar_path, compression=compression,
+                           attrs={'vocab_size': vocab_size, 'max_unk_words': max_unk_words})
+
+
 def load_json_data(path, name='kp20k', src_fields=['title', 'abstract'], trg_fields=['keyword'], trg_delimiter=';'):
     '''
     To load keyphrase data from file, generate src by concatenating the contents in src_fields
@@ -412,6 +536,9 @@ def process_data_examples(src_trgs_pairs, word2id, id2word, opt, mode='one2one',
     :param include_original: keep the original texts of source and target
     :return:
     '''
+    # the slim schema keeps the ids and the oov_list only, src_str/trg_str/oov_dict are rebuilt by restore_example
+    slim = getattr(opt, 'example_schema', 'full') == 'slim'
+    unk_id = word2id[UNK_WORD]
     return_example_list = []
     count_oov_in_targets = 0
     max_oov_num_in_src = 0
@@ -438,13 +565,14 @@ def process_data_examples(src_trgs_pairs, word2id, id2word, opt, mode='one2one',
             Note that do not use copy.deepcopy() as it forcibly creates new object and consumes too much disk
             '''
             one2one_example = {}
-            if include_original:
+            if include_original and not slim:
                 one2one_example['src_str'] = source_str
                 one2one_example['trg_str'] = target_str
 
             one2one_example['src'] = src_unk
             one2one_example['src_oov'] = src_copy
-            one2one_example['oov_dict'] = oov_dict
+            if not slim:
+                one2one_example['oov_dict'] = oov_dict
             one2one_example['oov_list'] = oov_list
             if len(oov_list) > max_oov_num_in_src:
                 max_oov_num_in_src = len(oov_list)
@@ -466,6 +594,9 @@ def process_data_examples(src_trgs_pairs, word2id, id2word, opt, mode='one2one',
                     w_id = oov_dict[w]
                 trg_copy.append(w_id)
             one2one_example['trg_copy'] = trg_copy
+            if include_original and slim:
+                one2one_example['src_unk_words'] = unk_words(source_str, src_copy, unk_id)
+                one2one_example['trg_unk_words'] = unk_words(target_str, trg_copy, unk_id)
 
             if any([w >= opt.vocab_size for w in trg_copy]):
                 find_oov_in_targets= True
@@ -498,17 +629,34 @@ def process_data_examples(src_trgs_pairs, word2id, id2word, opt, mode='one2one',
         # if it is one2many mode, merge multiple one2one examples to one
         if mode == 'one2many':
             one2many_example = {}
-            if include_original:
+            if include_original and not slim:
                 one2many_example['src_str'] = source_str
                 one2many_example['trg_str'] = target_strs
 
             one2many_example['src'] = src_unk
             one2many_example['src_oov'] = src_copy
-            one2many_example['oov_dict'] = oov_dict
+            if not slim:
+                one2many_example['oov_dict'] = oov_dict
             one2many_example['oov_list'] = oov_list
             one2many_example['trg'] = [e['trg'] for e in one2one_example_list]
             one2many_example['trg_copy'] = [e['trg_copy'] for e in one2one_example_list]
 
+            if slim:
+                if include_original:
+                    one2many_example['src_unk_words'] = one2one_example_list[0]['src_unk_words']
+                    one2many_example['trg_unk_words'] = [e['trg_unk_words'] for e in one2one_example_list]
+                # only the number of present targets is kept, for the metadata index
+                one2many_example['present_trg_count'] = int(sum(if_present_duplicate_phrases(
+                    source_str, target_strs, do_stemming=False, check_duplicate=False)[0]))
+                # check the example as it will be read, the strings must be restored exactly
+                restored_example = restore_example(one2many_example, id2word, unk_id, include_original, vocab_size=opt.vocab_size)
+                check_one2many_example(restored_example, include_original)
+                if include_original:
+                    assert restored_example['src_str'] == source_str
+                    assert restored_example['trg_str'] == target_strs
+                return_example_list.append(one2many_example)
+                continue
+
             # store the location of each target in source text if present. if it's absent, return -1
             one2many_example['trg_present_flag'], one2many_example['trg_present_pos_index'] \
                 = if_present_duplicate_phrases(source_str, target_strs,
@@ -544,17 +692,7 @@ def process_data_examples(src_trgs_pairs, word2id, id2word, opt, mode='one2one',
                 one2many_example['trg_alpha_order_index'] = []
                 one2many_example['trg_vocab_order_index'] = []
 
-            if include_original:
-                assert len(one2many_example['src']) == len(one2many_example['src_oov']) == len(one2many_example['src_str'])
-                assert len(one2many_example['oov_dict']) == len(one2many_example['oov_list'])
-                assert len(one2many_example['trg']) == len(one2many_example['trg_copy']) == len(one2many_example['trg_str'])
-            else:
-                assert len(one2many_example['src']) == len(one2many_example['src_oov'])
-                assert len(one2many_example['oov_dict']) == len(one2many_example['oov_list'])
-                assert len(one2many_example['trg']) == len(one2many_example['trg_copy'])
-
-            for t, tc in zip(one2many_example['trg'], one2many_example['trg_copy']):
-                assert len(t) == len(tc)
+            check_one2many_example(one2many_example, include_original)
 
             return_example_list.append(one2many_example)
         else:
@@ -604,6 +742,85 @@ def extend_vocab_OOV(source_words, word2id, vocab_size, max_oov_words):
     return src_ext, oov_dict, oov_list
 
 
+def unk_words(words, ids, unk_id):
+    '''
+    The words mapped to <unk> in ids (not in the vocab and not copyable), in order. With the ids and the oov_list,
+    they are enough to restore the original text (see restore_words)
+    '''
+    return [w for w, w_id in zip(words, ids) if w_id == unk_id]
+
+
+def oov_base(example):
+    '''
+    The id of the first oov word of an example (vocab_size at preprocessing time), None if the source has no oov word.
+    oov ids are given in the order of first appearance, so it's the extended id of the first word that differs from src
+    '''
+    for w_id, ext_id in zip(example['src'], example['src_oov']):
+        if w_id != ext_id:
+            return ext_id
+    return None
+
+
+def restore_words(ids, ext_ids, oov_list, base, unk_word_list, id2word, unk_id):
+    '''
+    Words of a sequence from its ids (oovs replaced with <unk>) and its extended ids (oovs replaced with oov ids)
+    '''
+    unk_word_iter = iter(unk_word_list)
+    words = []
+    for w_id, ext_id in zip(ids, ext_ids):
+        if w_id != ext_id:
+            words.append(oov_list[ext_id - base])
+        elif ext_id == unk_id:
+            words.append(next(unk_word_iter))
+        else:
+            words.append(id2word[ext_id])
+    return words
+
+
+def check_one2many_example(example, include_original):
+    '''
+    Integrity checks of a processed one2many example (of the full schema, or restored by restore_example)
+    '''
+    if include_original:
+        assert len(example['src']) == len(example['src_oov']) == len(example['src_str'])
+        assert len(example['oov_dict']) == len(example['oov_list'])
+        assert len(example['trg']) == len(example['trg_copy']) == len(example['trg_str'])
+    else:
+        assert len(example['src']) == len(example['src_oov'])
+        assert len(example['oov_dict']) == len(example['oov_list'])
+        assert len(example['trg']) == len(example['trg_copy'])
+
+    for t, tc in zip(example['trg'], example['trg_copy']):
+        assert len(t) == len(tc)
+
+
+def restore_example(example, id2word, unk_id, include_original=False, vocab_size=None):
+    '''
+    Rebuild the fields that the slim schema doesn't store: oov_dict, and src_str/trg_str if include_original.
+    Examples of the full schema (older datasets) are returned as is.
+    :param vocab_size: vocab_size of preprocessing, derived from the example if not given
+    '''
+    restore_str = include_original and 'src_str' not in example and 'src_unk_words' in example
+    if 'oov_dict' in example and not restore_str:
+        return example
+
+    example = dict(example)
+    base = vocab_size if vocab_size is not None else oov_base(example)
+    if 'oov_dict' not in example:
+        example['oov_dict'] = dict((w, base + i) for i, w in enumerate(example['oov_list']))
+    if restore_str:
+        example['src_str'] = restore_words(example['src'], example['src_oov'], example['oov_list'], base,
+                                           example['src_unk_words'], id2word, unk_id)
+        one2one = len(example['trg']) > 0 and not isinstance(example['trg'][0], list)
+        if one2one:
+            example['trg_str'] = restore_words(example['trg'], example['trg_copy'], example['oov_list'], base,
+                                               example['trg_unk_words'], id2word, unk_id)
+        else:
+            example['trg_str'] = [restore_words(t, tc, example['oov_list'], base, tu, id2word, unk_id)
+                                  for t, tc, tu in zip(example['trg'], example['trg_copy'], example['trg_unk_words'])]
+    return example
+
+
 def copy_martix(source, target):
     '''
     For reproduce Gu's method
@@ -619,59 +836,22 @@ def copy_martix(source, target):
 
 
 def build_vocab(tokenized_src_trgs_pairs, opt):
-    """Construct a vocabulary from tokenized lines."""
-    vocab = {}
-    for src_tokens, trgs_tokens in tokenized_src_trgs_pairs:
-        tokens = src_tokens + list(itertools.chain(*trgs_tokens))
-        for token in tokens:
-            if token not in vocab:
-                vocab[token] = 1
-            else:
-                vocab[token] += 1
-
-    # Discard start, end, pad and unk tokens if already present
-    if '<s>' in vocab:
-        del vocab['<s>']
-    if '<pad>' in vocab:
-        del vocab['<pad>']
-    if '</s>' in vocab:
-        del vocab['</s>']
-    if '<unk>' in vocab:
-        del vocab['<unk>']
-    if '<sep>' in vocab:
-        del vocab['<sep>']
-
-    word2id = {
-        '<pad>': 0,
-        '<s>': 1,
-        '</s>': 2,
-        '<unk>': 3,
-        '<sep>': 4,
-    }
-
-    id2word = {
-        0: '<pad>',
-        1: '<s>',
-        2: '</s>',
-        3: '<unk>',
-        4: '<sep>',
-    }
-
-    sorted_word2id = sorted(
-        vocab.items(),
-        key=lambda x: x[1],
-        reverse=True
-    )
-
-    sorted_words = [x[0] for x in sorted_word2id]
-
-    for ind, word in enumerate(sorted_words):
-        word2id[word] = ind + 5  # number of pre-defined tokens
-
-    for ind, word in enumerate(sorted_words):
-        id2word[ind + 5] = word  # here as well
-
-    return word2id, id2word, vocab
+    """Construct a vocabulary from tokenized lines.
+    Counting is map-reduced over opt.vocab_workers processes, words less frequent than opt.words_min_frequency are
+    discarded, and opt.vocab_max_entries > 0 bounds the memory of counting (approximate counts, see pykp.vocab)
+    :return: word2id, id2word, vocab (word -> count, without the special tokens) and whether the counts are approximate
+    """
+    counter, approximate = count_tokens_parallel(tokenized_src_trgs_pairs,
+                                                 num_workers=getattr(opt, 'vocab_workers', 1),
+                                                 max_entries=getattr(opt, 'vocab_max_entries', 0))
+    # start, end, pad, unk and sep tokens are discarded if already present, they take the first ids
+    words, counts = sorted_words(counter, min_freq=opt.words_min_frequency)
+
+    word2id = dict((w, i) for i, w in enumerate(words))
+    id2word = dict(enumerate(words))
+    vocab = dict(zip(words[len(SPECIAL_WORDS):], counts[len(SPECIAL_WORDS):]))
+
+    return word2id, id2word, vocab, approximate
 
 
 class One2OneKPDatasetOpenNMT(torchtext.data.Dataset):
@@ -855,12 +1035,36 @@ def generate_one2one_one2many_examples(tokenized_pairs, word2id, id2word, opt, i
     return one2one_examples, one2many_examples
 
 
+def export_formats(opt):
+    return {'pt': ['pt'], 'columnar': ['col'], 'both': ['pt', 'col']}[opt.export_format]
+
+
+def export_one2many_examples(one2many_examples, prefix, opt, metadata=None):
+    '''
+    Write one2many examples to <prefix>.pt and/or the columnar <prefix>.col, with the metadata index <prefix>.meta.npz
+    :param metadata: the metadata of the examples if already built, otherwise it's built from them
+    :return: the metadata
+    '''
+    if 'pt' in export_formats(opt):
+        torch.save(one2many_examples, open(prefix + '.pt', 'wb'))
+    if 'col' in export_formats(opt):
+        print("Dumping columnar one2many to disk: %s" % (prefix + '.col'))
+        export_columnar(one2many_examples, prefix + '.col',
+                        compression=opt.columnar_compression,
+                        attrs={'vocab_size': opt.vocab_size, 'max_unk_words': opt.max_unk_words})
+    if metadata is None:
+        metadata = build_metadata(one2many_examples)
+    save_metadata(metadata_path(prefix + '.pt'), metadata)
+    return metadata
+
+
 def process_and_export_dataset(tokenized_src_trg_pairs,
                                word2id, id2word,
                                opt, output_path,
                                dataset_name,
                                data_type=None,
-                               include_original=False):
+                               include_original=False,
+                               shard_boundaries=()):
     """
     :param tokenized_src_trg_pairs:
     :param word2id:
@@ -869,7 +1073,8 @@ def process_and_export_dataset(tokenized_src_trg_pairs,
     :param output_path:
     :param dataset_name:
     :param data_type: one of train, valid, test
-    :return:
+    :param shard_boundaries: indices of examples that must start a shard, e.g. the end of the _small subset
+    :return: the manifest if the one2many data are sharded (opt.num_shards > 1, training data only), otherwise None
     """
     assert data_type is not None
     assert data_type in ['train', 'valid', 'test']
@@ -894,8 +1099,30 @@ def process_and_export_dataset(tokenized_src_trg_pairs,
     one2many_exmaples = process_data_examples(
         tokenized_src_trg_pairs, word2id, id2word, opt, mode='one2many', include_original=include_original)
     print('#pairs of %s %s one2many = %d' % (dataset_name, data_type, len(one2many_exmaples)))
-    print("Dumping one2many %s %s to disk: %s" % (dataset_name, data_type, os.path.join(output_path, '%s.%s.one2many.pt' % (dataset_name, data_type))))
-    torch.save(one2many_exmaples, open(os.path.join(output_path, '%s.%s.one2many.pt' % (dataset_name, data_type)), 'wb'))
+    one2many_prefix = os.path.join(output_path, '%s.%s.one2many' % (dataset_name, data_type))
+    # only the training data is sharded, the loaders of validation/test sets need the global order
+    num_shards = opt.num_shards if data_type == 'train' else 0
+    manifest = None
+    if num_shards > 1:
+        # the shards are balanced by the costs of the metadata index, the examples are only sliced
+        metadata = build_metadata(one2many_exmaples)
+        num_tokens = example_costs(metadata)
+        shards = []
+        for shard_id, (start, end) in enumerate(split_by_tokens(num_tokens, num_shards, boundaries=shard_boundaries)):
+            prefix = shard_prefix(one2many_prefix, shard_id)
+            print("Dumping one2many %s %s shard %d to disk: %s, #(examples)=%d, #(tokens)=%d"
+                  % (dataset_name, data_type, shard_id, prefix, end - start, num_tokens[start: end].sum()))
+            export_one2many_examples(one2many_exmaples[start: end], prefix, opt,
+                                     metadata=dict((k, v[start: end]) for k, v in metadata.items()))
+            shards.append({'prefix': prefix,
+                           'formats': export_formats(opt),
+                           'num_examples': end - start,
+                           'num_tokens': int(num_tokens[start: end].sum())})
+        print("Dumping manifest of %d shards: %s" % (len(shards), manifest_path(one2many_prefix)))
+        manifest = write_manifest(manifest_path(one2many_prefix), shards)
+    else:
+        print("Dumping one2many %s %s to disk: %s" % (dataset_name, data_type, one2many_prefix + '.pt'))
+        metadata = export_one2many_examples(one2many_exmaples, one2many_prefix, opt)
     del one2many_exmaples
 
     print("Dumping done!")
@@ -903,15 +1130,7 @@ def process_and_export_dataset(tokenized_src_trg_pairs,
     '''
     Print dataset statistics
     '''
-    print("***************** %s %s : Source Length Statistics ******************" % (dataset_name, data_type.upper()))
-    len_counter = {}
-    for src_tokens, trgs_tokens in tokenized_src_trg_pairs:
-        len_count = len_counter.get(len(src_tokens), 0) + 1
-        len_counter[len(src_tokens)] = len_count
-    sorted_len = sorted(len_counter.items(), key=lambda x: x[0], reverse=True)
-
-    for len_, count in sorted_len:
-        print('%d,%d' % (len_, count))
+    print_metadata_statistics(metadata, title='%s %s' % (dataset_name, data_type.upper()))
 
     print("***************** %s %s : Target Length Statistics ******************" % (dataset_name, data_type.upper()))
     len_counter = {}
@@ -924,3 +1143,88 @@ def process_and_export_dataset(tokenized_src_trg_pairs,
 
     for len_, count in sorted_len:
         print('%d,%d' % (len_, count))
+
+    return manifest
+
+
+def append_and_export_dataset(tokenized_src_trg_pairs,
+                              word2id, id2word,
+                              opt, output_path,
+                              dataset_name,
+                              data_type=None,
+                              include_original=False):
+    """
+    Process new pairs with a frozen vocab and append them to a dataset exported by process_and_export_dataset.
+    A sharded split (with a manifest) gets new shards of about the size of the existing ones, otherwise the examples
+    are appended to the .pt/.col files. Metadata indexes are updated accordingly.
+    :param data_type: one of train, valid, test
+    :return: the number of one2many examples after appending
+    """
+    assert data_type in ['train', 'valid', 'test']
+    print("Appending %d pairs to %s %s in %s" % (len(tokenized_src_trg_pairs), dataset_name, data_type, output_path))
+    if len(tokenized_src_trg_pairs) == 0:
+        return None
+
+    one2one_path = os.path.join(output_path, '%s.%s.one2one.pt' % (dataset_name, data_type))
+    if os.path.exists(one2one_path):
+        one2one_examples = torch.load(one2one_path, 'rb')
+        one2one_examples.extend(process_data_examples(
+            tokenized_src_trg_pairs, word2id, id2word, opt, mode='one2one', include_original=include_original))
+        print("Dumping one2one %s %s to disk: %s, #(examples)=%d" % (dataset_name, data_type, one2one_path, len(one2one_examples)))
+        torch.save(one2one_examples, open(one2one_path, 'wb'))
+        del one2one_examples
+
+    new_examples = process_data_examples(
+        tokenized_src_trg_pairs, word2id, id2word, opt, mode='one2many', include_original=include_original)
+    one2many_prefix = os.path.join(output_path, '%s.%s.one2many' % (dataset_name, data_type))
+
+    if os.path.exists(manifest_path(one2many_prefix)):
+        manifest = load_manifest(manifest_path(one2many_prefix))
+        shards = manifest['shards']
+        new_metadata = build_metadata(new_examples)
+        num_tokens = example_costs(new_metadata)
+        # new shards are about as large as the existing ones
+        avg_shard_tokens = float(manifest['num_tokens']) / max(len(shards), 1)
+        num_new_shards = max(1, int(round(num_tokens.sum() / max(avg_shard_tokens, 1.0))))
+        shard_ids = [int(s['prefix'].rsplit('.shard', 1)[1]) for s in shards
+                     if s['prefix'].startswith(os.path.abspath(one2many_prefix) + '.shard')]
+        next_shard_id = max(shard_ids) + 1 if len(shard_ids) > 0 else 0
+        for shard_id, (start, end) in enumerate(split_by_tokens(num_tokens, num_new_shards), start=next_shard_id):
+            prefix = shard_prefix(one2many_prefix, shard_id)
+            print("Dumping one2many %s %s shard %d to disk: %s, #(examples)=%d, #(tokens)=%d"
+                  % (dataset_name, data_type, shard_id, prefix, end - start, num_tokens[start: end].sum()))
+            export_one2many_examples(new_examples[start: end], prefix, opt,
+                                     metadata=dict((k, v[start: end]) for k, v in new_metadata.items()))
+            shards.append({'prefix': prefix,
+                           'formats': export_formats(opt),
+                           'num_examples': end - start,
+                           'num_tokens': int(num_tokens[start: end].sum())})
+        manifest = write_manifest(manifest_path(one2many_prefix), shards)
+        print("Updated manifest: %s, #(shards)=%d, #(examples)=%d" % (manifest_path(one2many_prefix), len(shards), manifest['num_examples']))
+        return manifest['num_examples']
+
+    pt_path, columnar_path = one2many_prefix + '.pt', one2many_prefix + '.col'
+    if not os.path.exists(pt_path) and not is_columnar(columnar_path):
+        raise IOError('No processed %s %s dataset in %s' % (dataset_name, data_type, output_path))
+
+    # the metadata of the existing examples, before they change
+    dataset = KeyphraseDataset(columnar_path if is_columnar(columnar_path) else pt_path, word2id, id2word, lazy_load=True)
+    metadata = dataset.get_metadata()
+    dataset.offload_dataset()
+
+    if os.path.exists(pt_path):
+        one2many_examples = torch.load(pt_path, 'rb')
+        one2many_examples.extend(new_examples)
+        print("Dumping one2many %s %s to disk: %s, #(examples)=%d" % (dataset_name, data_type, pt_path, len(one2many_examples)))
+        torch.save(one2many_examples, open(pt_path, 'wb'))
+        num_examples = len(one2many_examples)
+        del one2many_examples
+    if is_columnar(columnar_path):
+        print("Appending to columnar one2many %s %s: %s" % (dataset_name, data_type, columnar_path))
+        num_examples = append_columnar(new_examples, columnar_path)
+
+    new_metadata = build_metadata(new_examples)
+    metadata = dict((k, np.concatenate([metadata[k], new_metadata[k]])) for k in metadata)
+    save_metadata(metadata_path(pt_path), metadata)
+    assert len(metadata['num_trgs']) == num_examples
+    return num_examples
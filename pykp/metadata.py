@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Per-split metadata index of processed one2many datasets.
+A small .npz file next to the dataset (<dataset>.<split>.one2many.meta.npz) that keeps a few integers per example,
+so that loaders, samplers, sharding and statistics don't have to deserialize the examples.
+"""
+import os
+
+import numpy as np
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+# number of targets, source length, length of the longest target, #(unique oov words in source), #(present targets)
+METADATA_FIELDS = ['num_trgs', 'src_len', 'max_trg_len', 'oov_count', 'present_trg_count']
+
+
+def metadata_path(data_path):
+    '''
+    x.one2many.pt and x.one2many.col share the same sidecar x.one2many.meta.npz
+    '''
+    for suffix in ['.pt', '.col']:
+        if data_path.endswith(suffix):
+            data_path = data_path[:-len(suffix)]
+            break
+    return data_path + '.meta.npz'
+
+
+def build_metadata(examples):
+    '''
+    :param examples: one2many examples, output of pykp.io.process_data_examples
+    :return: a dict of int32 arrays, one value per example
+    '''
+    metadata = dict((k, np.zeros(len(examples), dtype=np.int32)) for k in METADATA_FIELDS)
+    for i, e in enumerate(examples):
+        metadata['num_trgs'][i] = len(e['trg'])
+        metadata['src_len'][i] = len(e['src'])
+        metadata['max_trg_len'][i] = max([len(t) for t in e['trg']]) if len(e['trg']) > 0 else 0
+        metadata['oov_count'][i] = len(e['oov_list'])
+        # -1 means unknown, older datasets don't keep the presence flags
+        if 'present_trg_count' in e:
+            metadata['present_trg_count'][i] = e['present_trg_count']
+        else:
+            metadata['present_trg_count'][i] = sum(e['trg_present_flag']) if 'trg_present_flag' in e else -1
+    return metadata
+
+
+def build_metadata_from_columnar(reader):
+    '''
+    Derive the metadata from the offsets of a columnar dataset (pykp.columnar.ColumnarReader), without reading any token
+    '''
+    trg_offsets = reader.offsets('trg', 0)
+    trg_lens = reader.lengths('trg', 1)
+
+    metadata = {}
+    metadata['num_trgs'] = np.diff(trg_offsets).astype(np.int32)
+    metadata['src_len'] = reader.lengths('src').astype(np.int32)
+    # max over the targets of each example, examples without targets get 0
+    max_trg_len = np.zeros(len(reader), dtype=np.int32)
+    has_trg = metadata['num_trgs'] > 0
+    if len(trg_lens) > 0:
+        max_trg_len[has_trg] = np.maximum.reduceat(trg_lens, trg_offsets[:-1][has_trg])
+    metadata['max_trg_len'] = max_trg_len
+    metadata['oov_count'] = reader.lengths('oov_list').astype(np.int32)
+    metadata['present_trg_count'] = np.full(len(reader), -1, dtype=np.int32)
+    return metadata
+
+
+def save_metadata(path, metadata):
+    # write to a temporary file first, readers never see a half-written index
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **metadata)
+    os.replace(tmp_path, path)
+
+
+def load_metadata(path):
+    with np.load(path) as npz:
+        return dict((k, npz[k]) for k in npz.files)
+
+
+def example_costs(metadata):
+    '''
+    Rough cost of each example in tokens: the source is fed once per target in one2one mode, plus the targets themselves.
+    The shards of a split are balanced by these costs (see pykp.shards.split_by_tokens)
+    '''
+    num_trgs = metadata['num_trgs'].astype(np.int64)
+    return metadata['src_len'].astype(np.int64) * np.maximum(num_trgs, 1) + num_trgs * metadata['max_trg_len']
+
+
+def print_metadata_statistics(metadata, title=''):
+    print("***************** %s : Metadata Statistics ******************" % title)
+    print('#(examples)=%d' % len(metadata['num_trgs']))
+    for k in METADATA_FIELDS:
+        values = metadata[k]
+        if len(values) == 0 or np.any(values < 0):
+            continue
+        print('%s: sum=%d, avg=%.3f, min=%d, max=%d' % (k, values.sum(), values.mean(), values.min(), values.max()))
+
+    print("***************** %s : Source Length Statistics ******************" % title)
+    lens, counts = np.unique(metadata['src_len'], return_counts=True)
+    for len_, count in sorted(zip(lens, counts), key=lambda x: x[0], reverse=True):
+        print('%d,%d' % (len_, count))
@@ -198,6 +198,99 @@ def _modified_precision(candidate, references, n):
     return sum(clipped_counts.values()) / sum(counts.values())
 
 
+class BleuScorer(object):
+    """BLEU of many candidates against the same references, as bleu().
+
+    The maximum count of each n-gram over the references is computed once,
+    instead of once per candidate, and the score of each distinct candidate
+    is computed once.
+
+    :param references: reference sentences
+    :type references: list(list(str))
+    :param weights: weights for unigrams, bigrams, trigrams and so on
+    :type weights: list(float)
+
+    >>> weights = [0.25, 0.25, 0.25, 0.25]
+    >>> candidate1 = ['It', 'is', 'a', 'guide', 'to', 'action', 'which',
+    ...               'ensures', 'that', 'the', 'military', 'always',
+    ...               'obeys', 'the', 'commands', 'of', 'the', 'party']
+
+    >>> candidate2 = ['It', 'is', 'to', 'insure', 'the', 'troops',
+    ...               'forever', 'hearing', 'the', 'activity', 'guidebook',
+    ...               'that', 'party', 'direct']
+
+    >>> reference1 = ['It', 'is', 'a', 'guide', 'to', 'action', 'that',
+    ...               'ensures', 'that', 'the', 'military', 'will', 'forever',
+    ...               'heed', 'Party', 'commands']
+
+    >>> reference2 = ['It', 'is', 'the', 'guiding', 'principle', 'which',
+    ...               'guarantees', 'the', 'military', 'forces', 'always',
+    ...               'being', 'under', 'the', 'command', 'of', 'the',
+    ...               'Party']
+
+    >>> reference3 = ['It', 'is', 'the', 'practical', 'guide', 'for', 'the',
+    ...               'army', 'always', 'to', 'heed', 'the', 'directions',
+    ...               'of', 'the', 'party']
+
+    >>> scorer = BleuScorer([reference1, reference2, reference3], weights)
+    >>> scorer.score_all([candidate1, candidate2, candidate1])
+    [0.504..., 0, 0.504...]
+
+    >>> scorer.modified_precision(candidate1, n=1)
+    0.94...
+
+    >>> scorer.modified_precision(candidate2, n=2)
+    0.07...
+
+    >>> BleuScorer(
+    ...    ['the cat is on the mat'.split(), 'there is a cat on the mat'.split()],
+    ...    weights,
+    ... ).modified_precision('the the the the the the the'.split(), n=1)
+    0.28...
+
+    """
+
+    def __init__(self, references, weights):
+        self.weights = weights
+        # max_counts[n - 1]: the maximum count of each n-gram in any of the references
+        self.max_counts = []
+        for n in range(1, len(weights) + 1):
+            max_counts = {}
+            for reference in references:
+                for ngram, count in Counter(ngrams(reference, n)).items():
+                    if count > max_counts.get(ngram, 0):
+                        max_counts[ngram] = count
+            self.max_counts.append(max_counts)
+        self._scores = {}
+
+    def modified_precision(self, candidate, n):
+        """Modified n-gram precision of a candidate, as _modified_precision()."""
+        counts = Counter(ngrams(candidate, n))
+
+        if not counts:
+            return 0
+
+        max_counts = self.max_counts[n - 1]
+        clipped_count = sum(min(count, max_counts.get(ngram, 0)) for ngram, count in counts.items())
+
+        return clipped_count / sum(counts.values())
+
+    def score(self, candidate):
+        key = tuple(candidate)
+        if key not in self._scores:
+            p_ns = [self.modified_precision(key, i) for i, _ in enumerate(self.weights, start=1)]
+            try:
+                s = math.fsum(w * math.log(p_n) for w, p_n in zip(self.weights, p_ns))
+                self._scores[key] = math.exp(s)
+            except ValueError:
+                # some p_ns is 0
+                self._scores[key] = 0
+        return self._scores[key]
+
+    def score_all(self, candidates):
+        return [self.score(candidate) for candidate in candidates]
+
+
 def _brevity_penalty(candidate, references):
     """Calculate brevity penalty.
 
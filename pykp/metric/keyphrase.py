@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Keyphrase metrics of ranked predictions, shared by evaluate.py and pykp.post_evaluate.
+The matches of a set of documents form a (docs x predictions) matrix, truncated/padded to the largest cut-off k.
+Precision, recall, F-score, Bpref and MRR at every k are computed for all the documents at once with cumulative sums.
+MetricAccumulator adds documents one by one, and keeps running sums for the running averages.
+bootstrap_interval gives the confidence interval of the average of a per-document score, e.g. on a validation subset.
+"""
+import bisect
+
+import numpy as np
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+METRIC_NAMES = ['precision', 'recall', 'f_score', 'bpref', 'mrr', 'correct_number']
+
+
+def _safe_divide(a, b):
+    # 0 where the denominator is 0
+    a, b = np.broadcast_arrays(np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64))
+    out = np.zeros(a.shape, dtype=np.float64)
+    np.divide(a, b, out=out, where=b != 0)
+    return out
+
+
+def match_matrix(match_lists, max_k):
+    '''
+    :param match_lists: the match score (1/0, or a partial match in [0, 1]) of the predictions of each document
+    :return: (matches, num_predictions), matches is a (len(match_lists), max_k) matrix padded with zeros
+    '''
+    matches = np.zeros((len(match_lists), max_k), dtype=np.float64)
+    num_predictions = np.zeros(len(match_lists), dtype=np.int64)
+    for i, match_list in enumerate(match_lists):
+        match_list = np.asarray(match_list, dtype=np.float64)
+        num_predictions[i] = len(match_list)
+        matches[i, :min(len(match_list), max_k)] = match_list[:max_k]
+    return matches, num_predictions
+
+
+def compute_metrics(matches, num_predictions, num_targets, topk_range=(5, 10), precision_at_k=False):
+    '''
+    :param matches: (num_docs, max(topk_range)) matrix of match scores, see match_matrix
+    :param num_predictions: number of predictions of each document
+    :param num_targets: number of targets of each document
+    :param precision_at_k: divide the correct predictions by k (as post_evaluate), otherwise by the number of
+        predictions in the top k (as evaluate.py)
+    :return: a dict of per-document arrays, keys are '<metric>@<k>' of METRIC_NAMES.
+        Bpref and MRR only count the full matches (score 1)
+    '''
+    matches = np.asarray(matches, dtype=np.float64)
+    num_predictions = np.asarray(num_predictions)
+    num_targets = np.asarray(num_targets)
+    assert matches.shape[1] >= max(topk_range)
+
+    correct = np.cumsum(matches, axis=1)
+    hits = matches == 1
+    num_hits = np.cumsum(hits, axis=1)
+    # at a hit, the number of wrong predictions ranked above it
+    num_misses = np.cumsum(~hits, axis=1)
+    first_hit = np.where(hits.any(axis=1), hits.argmax(axis=1) + 1, 0)
+
+    scores = {}
+    for k in topk_range:
+        correct_k = correct[:, k - 1]
+        predicted_k = np.full(len(matches), k) if precision_at_k else np.minimum(num_predictions, k)
+        precision = _safe_divide(correct_k, predicted_k)
+        recall = _safe_divide(correct_k, num_targets)
+        scores['precision@%d' % k] = precision
+        scores['recall@%d' % k] = recall
+        scores['f_score@%d' % k] = _safe_divide(2 * precision * recall, precision + recall)
+        scores['bpref@%d' % k] = _safe_divide(np.sum(hits[:, :k] * (1. - num_misses[:, :k] / float(k)), axis=1),
+                                              num_hits[:, k - 1])
+        scores['mrr@%d' % k] = np.where((first_hit > 0) & (first_hit <= k), _safe_divide(1., first_hit), 0.)
+        scores['correct_number@%d' % k] = correct_k
+    return scores
+
+
+def bootstrap_interval(values, num_samples=1000, confidence=0.95, seed=9527):
+    '''
+    Percentile bootstrap interval of the average of per-document scores
+    :param values: the score of each document
+    :return: (average, lower bound, upper bound), all 0 without any document
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return 0., 0., 0.
+    rng = np.random.RandomState(seed)
+    # the averages of num_samples resamples of the documents, drawn in chunks to bound the memory
+    chunk_size = max(1, (1 << 22) // len(values))
+    averages = np.concatenate([values[rng.randint(0, len(values), (min(chunk_size, num_samples - start), len(values)))].mean(axis=1)
+                               for start in range(0, num_samples, chunk_size)])
+    alpha = (1. - confidence) / 2.
+    lower, upper = np.percentile(averages, [100. * alpha, 100. * (1. - alpha)])
+    return float(np.mean(values)), float(lower), float(upper)
+
+
+class MetricAccumulator(object):
+    """
+    Streaming accumulation of the metrics of documents. Added documents are computed in bulk at the next query.
+
+    Arguments:
+        topk_range (list of int): the cut-offs k
+        precision_at_k (bool): see compute_metrics
+    """
+
+    def __init__(self, topk_range=(5, 10), precision_at_k=False):
+        self.topk_range = list(topk_range)
+        self.precision_at_k = precision_at_k
+        self.max_k = max(self.topk_range)
+        self._pending = []
+        # per-document scores, one dict of arrays per flushed block, with the index of the first document of each block
+        self._blocks = []
+        self._block_starts = []
+        self._sums = {}
+        self._num_docs = 0
+
+    def __len__(self):
+        return self._num_docs + len(self._pending)
+
+    def add(self, match_list, num_targets):
+        '''
+        :return: the index of the document
+        '''
+        self._pending.append((match_list, num_targets))
+        return len(self) - 1
+
+    def extend(self, match_lists, num_targets_list):
+        for match_list, num_targets in zip(match_lists, num_targets_list):
+            self.add(match_list, num_targets)
+
+    def flush(self):
+        if len(self._pending) == 0:
+            return
+        match_lists, num_targets = zip(*self._pending)
+        matches, num_predictions = match_matrix(match_lists, self.max_k)
+        block = compute_metrics(matches, num_predictions, np.asarray(num_targets), self.topk_range, self.precision_at_k)
+        block['num_predictions'] = num_predictions
+        block['num_targets'] = np.asarray(num_targets, dtype=np.int64)
+        for name, values in block.items():
+            self._sums[name] = self._sums.get(name, 0.) + float(np.sum(values))
+        self._sums['docs_with_targets'] = self._sums.get('docs_with_targets', 0) + int(np.sum(block['num_targets'] > 0))
+
+        self._blocks.append(block)
+        self._block_starts.append(self._num_docs)
+        self._num_docs += len(self._pending)
+        self._pending = []
+
+    def scores(self):
+        '''
+        :return: a dict of per-document arrays of all the documents
+        '''
+        self.flush()
+        if len(self._blocks) > 1:
+            self._blocks = [dict((name, np.concatenate([b[name] for b in self._blocks])) for name in self._blocks[0])]
+            self._block_starts = [0]
+        return self._blocks[0] if len(self._blocks) > 0 else {}
+
+    def document(self, index):
+        '''
+        :return: a dict of the scores of one document
+        '''
+        self.flush()
+        block_id = bisect.bisect_right(self._block_starts, index) - 1
+        block = self._blocks[block_id]
+        return dict((name, float(values[index - self._block_starts[block_id]])) for name, values in block.items())
+
+    def total(self, name):
+        self.flush()
+        return self._sums.get(name, 0.)
+
+    def macro(self, name, docs_with_targets_only=False):
+        '''
+        Average of a per-document score over all the documents, or over the documents having at least one target
+        (documents without targets have 0 for every score)
+        '''
+        self.flush()
+        num_docs = self._sums.get('docs_with_targets', 0) if docs_with_targets_only else self._num_docs
+        return self._sums.get(name, 0.) / num_docs if num_docs > 0 else 0.
+
+    def micro(self, k):
+        '''
+        :return: (precision, recall, f_score) at k over the pooled predictions and targets of all the documents
+        '''
+        self.flush()
+        correct = self._sums.get('correct_number@%d' % k, 0.)
+        if self.precision_at_k:
+            predicted = k * self._num_docs
+        else:
+            predicted = float(np.sum(np.minimum(self.scores()['num_predictions'], k))) if self._num_docs > 0 else 0
+        precision = correct / predicted if predicted > 0 else 0.
+        recall = correct / self._sums['num_targets'] if self._sums.get('num_targets', 0) > 0 else 0.
+        f_score = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.
+        return precision, recall, f_score
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Phrase presence in a source text, shared by preprocessing (pykp.io), evaluate.py and pykp.post_evaluate.
+A source is indexed once per phrase length: a dict from every n-gram (tuple of tokens, or of token ids) to its first
+position, built in one pass over the source. Any number of phrases of that length is then answered by a dict lookup,
+instead of scanning the source for every phrase.
+"""
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+
+class NgramIndex(object):
+    """
+    First position of the n-grams of a token sequence, the index of each length n is built at its first query.
+
+    Arguments:
+        tokens (list): words or ids of the source
+    """
+
+    def __init__(self, tokens):
+        self.tokens = list(tokens)
+        self._positions = {}
+
+    def _ngram_positions(self, n):
+        if n not in self._positions:
+            ngrams = list(zip(*[self.tokens[k:] for k in range(n)]))
+            # later entries overwrite earlier ones, so the n-grams are inserted from the end to keep the first position
+            self._positions[n] = dict(zip(ngrams[::-1], range(len(ngrams) - 1, -1, -1)))
+        return self._positions[n]
+
+    def find(self, phrase):
+        '''
+        :return: the first position of phrase in the source, -1 if absent. An empty phrase is found at 0
+        '''
+        if len(phrase) == 0:
+            return 0
+        if len(phrase) > len(self.tokens):
+            return -1
+        return self._ngram_positions(len(phrase)).get(tuple(phrase), -1)
+
+    def find_all(self, phrases):
+        '''
+        :return: (present_flags, positions) of a list of phrases, empty phrases are absent
+        '''
+        positions = [self.find(p) if len(p) > 0 else -1 for p in phrases]
+        return [pos >= 0 for pos in positions], positions
+
+
+def match_flags(targets, predictions):
+    '''
+    :return: a list of flags, True for the predictions equal to any of the targets (sequences of tokens)
+    '''
+    target_set = set(tuple(t) for t in targets)
+    return [tuple(p) in target_set for p in predictions]
@@ -8,41 +8,25 @@ import sys
 
 from pykp import io
 from pykp.io import load_json_data
+from pykp.metric.keyphrase import MetricAccumulator
+from pykp.phrase_match import NgramIndex, match_flags
+from pykp.prediction_store import PredictionStore, is_prediction_store
 
 
-def check_if_present(source_tokens, targets_tokens):
-    target_present_flags = []
-    for target_tokens in targets_tokens:
-        # whether do filtering on groundtruth phrases.
-        present = False
-        for i in range(len(source_tokens) - len(target_tokens) + 1):
-            match = None
-            for j in range(len(target_tokens)):
-                if target_tokens[j] != source_tokens[i + j]:
-                    match = False
-                    break
-            if len(target_tokens) > 0 and j == len(target_tokens) - 1 and match == None:
-                present = True
-                break
-
-        target_present_flags.append(present)
+def check_if_present(source_tokens, targets_tokens, source_index=None):
+    '''
+    :param source_index: a NgramIndex of source_tokens, to share between calls
+    '''
+    if source_index is None:
+        source_index = NgramIndex(source_tokens)
+    # whether do filtering on groundtruth phrases, empty phrases are absent
+    target_present_flags, _ = source_index.find_all(targets_tokens)
     assert len(target_present_flags) == len(targets_tokens)
 
     return target_present_flags
 
 def get_match_flags(targets, predictions):
-    match_flags = np.asarray([0] * len(predictions), dtype='int32')
-    for pid, predict in enumerate(predictions):
-        for stemmed_target in targets:
-            if len(stemmed_target) == len(predict):
-                match_flag = True
-                for i, w in enumerate(predict):
-                    if predict[i] != stemmed_target[i]:
-                        match_flag = False
-                if match_flag:
-                    match_flags[pid] = 1
-                    break
-    return match_flags
+    return np.asarray(match_flags(targets, predictions), dtype='int32')
 
 def evaluate_(source_str_list, targets_str_list, prediction_str_list,
               model_name, dataset_name,
@@ -65,9 +49,9 @@ def evaluate_(source_str_list, targets_str_list, prediction_str_list,
     csv_writer = open(score_csv_path, 'a')
 
     print('Evaluating on %s@%s' % (model_name, dataset_name))
-    # Evaluation part
-    macro_metrics = []
-    macro_matches = []
+    # Evaluation part, the precision@k is over k predictions
+    topk_range = [5, 10]
+    accumulator = MetricAccumulator(topk_range, precision_at_k=True)
 
     total_source_length = 0
     length_groundtruth = []
@@ -126,8 +110,9 @@ def evaluate_(source_str_list, targets_str_list, prediction_str_list,
                 targets_tokens_to_match = [io.copyseq_tokenize(target.strip().lower()) for target in targets]
                 predictions_tokens_to_match = [io.copyseq_tokenize(prediction.strip().lower()) for prediction in predictions]
 
-            target_present_flags = check_if_present(source_tokens_to_match, targets_tokens_to_match)
-            prediction_present_flags = check_if_present(source_tokens_to_match, predictions_tokens_to_match)
+            source_index = NgramIndex(source_tokens_to_match)
+            target_present_flags = check_if_present(source_tokens_to_match, targets_tokens_to_match, source_index)
+            prediction_present_flags = check_if_present(source_tokens_to_match, predictions_tokens_to_match, source_index)
 
             if filter_criteria == 'present':
                 targets_valid_flags = target_present_flags
@@ -170,61 +155,8 @@ def evaluate_(source_str_list, targets_str_list, prediction_str_list,
         '''
         valid_predictions_match_flags = get_match_flags(stemmed_targets_for_evaluate, stemmed_predictions_for_evaluate)
         predictions_match_flags = get_match_flags(stemmed_targets_for_evaluate, stemmed_predictions_tokens)
-        '''
-        Compute metrics
-        '''
-        metric_dict = {}
-        for number_to_predict in [5, 10]:
-            metric_dict['target_number'] = len(targets_for_evaluate)
-            metric_dict['prediction_number'] = len(predictions_for_evaluate)
-            metric_dict['correct_number@%d' % number_to_predict] = sum(valid_predictions_match_flags[:number_to_predict])
-
-            # Precision
-            metric_dict['p@%d' % number_to_predict] = float(sum(valid_predictions_match_flags[:number_to_predict])) / float(
-                number_to_predict)
-
-            # Recall
-            if len(targets_for_evaluate) != 0:
-                metric_dict['r@%d' % number_to_predict] = float(sum(valid_predictions_match_flags[:number_to_predict])) \
-                                                          / float(len(targets_for_evaluate))
-            else:
-                metric_dict['r@%d' % number_to_predict] = 0
-
-            # F-score
-            if metric_dict['p@%d' % number_to_predict] + metric_dict['r@%d' % number_to_predict] != 0:
-                metric_dict['f1@%d' % number_to_predict] = 2 * metric_dict['p@%d' % number_to_predict] * metric_dict[
-                    'r@%d' % number_to_predict] / float(
-                    metric_dict['p@%d' % number_to_predict] + metric_dict['r@%d' % number_to_predict])
-            else:
-                metric_dict['f1@%d' % number_to_predict] = 0
-
-            # Bpref: binary preference measure
-            bpref = 0.
-            trunked_match = valid_predictions_match_flags[:number_to_predict].tolist()  # get the first K prediction to evaluate
-            match_indexes = np.nonzero(trunked_match)[0]
-
-            if len(match_indexes) > 0:
-                for mid, mindex in enumerate(match_indexes):
-                    bpref += 1. - float(mindex - mid) / float(
-                        number_to_predict)  # there're mindex elements, and mid elements are correct, before the (mindex+1)-th element
-                metric_dict['bpref@%d' % number_to_predict] = float(bpref) / float(len(match_indexes))
-            else:
-                metric_dict['bpref@%d' % number_to_predict] = 0
-
-            # MRR: mean reciprocal rank
-            rank_first = 0
-            try:
-                rank_first = trunked_match.index(1) + 1
-            except ValueError:
-                pass
-
-            if rank_first > 0:
-                metric_dict['mrr@%d' % number_to_predict] = float(1) / float(rank_first)
-            else:
-                metric_dict['mrr@%d' % number_to_predict] = 0
-
-        macro_metrics.append(metric_dict)
-        macro_matches.append(valid_predictions_match_flags)
+        # metrics are computed for all the documents at once after the loop
+        accumulator.add(valid_predictions_match_flags, len(targets_for_evaluate))
 
         '''
         Print information on each prediction
@@ -271,11 +203,6 @@ def evaluate_(source_str_list, targets_str_list, prediction_str_list,
         #     logger.info(k)
         # a += k
 
-        for number_to_predict in [5, 10]:
-            print_out += '@%d - Precision=%.4f, Recall=%.4f, F1=%.4f, Bpref=%.4f, MRR=%.4f' % (
-            number_to_predict, metric_dict['p@%d' % number_to_predict], metric_dict['r@%d' % number_to_predict],
-            metric_dict['f1@%d' % number_to_predict], metric_dict['bpref@%d' % number_to_predict], metric_dict['mrr@%d' % number_to_predict])
-
         # logger.info(print_out)
         # logger.info('*' * 100)
 
@@ -334,22 +261,22 @@ def evaluate_(source_str_list, targets_str_list, prediction_str_list,
     '''
     overall_score = {}
 
-    for k in [5, 10]:
-        correct_number = sum([m['correct_number@%d' % k] for m in macro_metrics])
-        overall_target_number = sum([m['target_number'] for m in macro_metrics])
-        overall_prediction_number = sum([m['prediction_number'] for m in macro_metrics])
+    for k in topk_range:
+        correct_number = int(accumulator.total('correct_number@%d' % k))
+        overall_target_number = int(accumulator.total('num_targets'))
+        overall_prediction_number = int(accumulator.total('num_predictions'))
 
         if real_test_size * k < overall_prediction_number:
             overall_prediction_number = real_test_size * k
 
-        overall_score['target_number'] = sum([m['target_number'] for m in macro_metrics])
-        overall_score['correct_number@%d' % k] = sum([m['correct_number@%d' % k] for m in macro_metrics])
+        overall_score['target_number'] = overall_target_number
+        overall_score['correct_number@%d' % k] = correct_number
         overall_score['prediction_number@%d' % k] = overall_prediction_number
 
-        # Compute the macro Measures, by averaging the macro-score of each prediction
-        overall_score['p@%d' % k] = float(sum([m['p@%d' % k] for m in macro_metrics])) / float(real_test_size)
-        overall_score['r@%d' % k] = float(sum([m['r@%d' % k] for m in macro_metrics])) / float(real_test_size)
-        overall_score['f1@%d' % k] = float(sum([m['f1@%d' % k] for m in macro_metrics])) / float(real_test_size)
+        # Compute the macro Measures, by averaging the macro-score of each prediction (documents with targets only)
+        overall_score['p@%d' % k] = accumulator.macro('precision@%d' % k, docs_with_targets_only=True)
+        overall_score['r@%d' % k] = accumulator.macro('recall@%d' % k, docs_with_targets_only=True)
+        overall_score['f1@%d' % k] = accumulator.macro('f_score@%d' % k, docs_with_targets_only=True)
 
         # Print basic statistics
         logger.info('%s@%s' % (model_name, dataset_name))
@@ -369,11 +296,15 @@ def evaluate_(source_str_list, targets_str_list, prediction_str_list,
         )
         logger.info(output_str)
 
+        # Print micro-average performance
+        micro_p, micro_r, micro_f1 = accumulator.micro(k)
+        logger.info('micro:\t\tP@%d=%f, R@%d=%f, F1@%d=%f' % (k, micro_p, k, micro_r, k, micro_f1))
+
         # Compute the binary preference measure (Bpref)
-        overall_score['bpref@%d' % k] = float(sum([m['bpref@%d' % k] for m in macro_metrics])) / float(real_test_size)
+        overall_score['bpref@%d' % k] = accumulator.macro('bpref@%d' % k, docs_with_targets_only=True)
 
         # Compute the mean reciprocal rank (MRR)
-        overall_score['mrr@%d' % k] = float(sum([m['mrr@%d' % k] for m in macro_metrics])) / float(real_test_size)
+        overall_score['mrr@%d' % k] = accumulator.macro('mrr@%d' % k, docs_with_targets_only=True)
 
         output_str = '\t\t\tBpref@%d=%f, MRR@%d=%f' % (
                     k, overall_score['bpref@%d' % k],
@@ -425,7 +356,24 @@ def init_logging(logfile):
     return logging
 
 
+def load_from_prediction_store(store_dir):
+    '''
+    Read the store written by evaluate_beam_search (pykp.prediction_store), in the order of the documents
+    :return: source_str_list, targets_str_list, prediction_str_list, as the inputs of evaluate_
+    '''
+    source_str_list, targets_str_list, prediction_str_list = [], [], []
+    for record in PredictionStore(store_dir):
+        source_str_list.append(' '.join(record['src_str']))
+        targets_str_list.append([' '.join(t) for t in record['trg_str']])
+        prediction_str_list.append([' '.join(p) for p in record['pred_str']])
+    return source_str_list, targets_str_list, prediction_str_list
+
+
 def load_predictions_from_file(prediction_dir, file_suffix='.txt'):
+    # a prediction store is read through its index instead of listing the files
+    if is_prediction_store(prediction_dir):
+        return load_from_prediction_store(prediction_dir)[2]
+
     predictions_str_dict = {}
 
     for pred_file_name in os.listdir(prediction_dir):
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Prediction store of one evaluation round of a dataset: one record (a json dict) per document, in a few sharded
+JSONL files instead of three small files per document.
+    <store_dir>/predictions-00000.jsonl[.gz]    records of the shard, appended in blocks
+    <store_dir>/index.npz                       doc id -> (shard, block offset, block length, line in block)
+Records are serialized and written by a background thread, in blocks of about block_size bytes. A compressed shard is
+a sequence of gzip members, one per block, so that a record is read by decompressing its block only.
+The index is checkpointed after every block. Records past the index (e.g. of a killed run) are indexed by a scan,
+which stops at the last complete record of a shard: a truncated tail is dropped.
+"""
+import gzip
+import json
+import os
+import threading
+import zlib
+
+import numpy as np
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+SHARD_PATTERN = 'predictions-%05d.jsonl'
+INDEX_NAME = 'index.npz'
+INDEX_FIELDS = ['doc_ids', 'shards', 'block_offsets', 'block_lengths', 'lines']
+
+
+def shard_path(store_dir, shard_id, compress):
+    return os.path.join(store_dir, SHARD_PATTERN % shard_id + ('.gz' if compress else ''))
+
+
+def list_shards(store_dir):
+    '''
+    :return: a sorted list of (shard_id, path, compressed)
+    '''
+    shards = []
+    for file_name in os.listdir(store_dir):
+        name = file_name[:-len('.gz')] if file_name.endswith('.gz') else file_name
+        if name.startswith('predictions-') and name.endswith('.jsonl'):
+            shards.append((int(name[len('predictions-'): -len('.jsonl')]), os.path.join(store_dir, file_name), file_name.endswith('.gz')))
+    return sorted(shards)
+
+
+def is_prediction_store(path):
+    return os.path.isdir(path) and (os.path.exists(os.path.join(path, INDEX_NAME)) or len(list_shards(path)) > 0)
+
+
+def _save_index(store_dir, index):
+    path = os.path.join(store_dir, INDEX_NAME)
+    # write to a temporary file first, readers never see a half-written index
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **index)
+    os.replace(tmp_path, path)
+
+
+def _empty_index():
+    return {'doc_ids': np.zeros(0, dtype=np.int64), 'shards': np.zeros(0, dtype=np.int32),
+            'block_offsets': np.zeros(0, dtype=np.int64), 'block_lengths': np.zeros(0, dtype=np.int64),
+            'lines': np.zeros(0, dtype=np.int32)}
+
+
+def _concat_index(index, entries):
+    if len(entries) == 0:
+        return index
+    columns = list(zip(*entries))
+    return dict((k, np.concatenate([index[k], np.asarray(c, dtype=index[k].dtype)])) for k, c in zip(INDEX_FIELDS, columns))
+
+
+def scan_shard(path, compressed, offset=0):
+    '''
+    Index the records of a shard from a block offset, up to its last complete block
+    :return: a list of (doc_id, block_offset, block_length, line) of the shard
+    '''
+    with open(path, 'rb') as shard_file:
+        shard_file.seek(offset)
+        data = shard_file.read()
+    entries = []
+    start = offset
+    offset = 0
+    while offset < len(data):
+        if compressed:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                block = decompressor.decompress(data[offset:])
+            except zlib.error:
+                break
+            # a gzip member cut by a killed writer
+            if not decompressor.eof:
+                break
+            length = len(data) - offset - len(decompressor.unused_data)
+        else:
+            # each line is a block of its own, a line without its newline was cut by a killed writer
+            end = data.find(b'\n', offset)
+            if end < 0:
+                break
+            length = end + 1 - offset
+            block = data[offset: offset + length]
+        try:
+            block_entries = [(json.loads(line.decode('utf-8'))['doc_id'], start + offset, length, line_id)
+                             for line_id, line in enumerate(block.splitlines()) if line.strip()]
+        except (ValueError, KeyError):
+            break
+        entries.extend(block_entries)
+        offset += length
+    return entries
+
+
+def build_index(store_dir, index=None):
+    '''
+    Index the records of a store that are not in index yet, by a scan of the shards past the indexed blocks
+    '''
+    if index is None:
+        index = _empty_index()
+    # end of the indexed blocks of each shard
+    indexed_ends = {}
+    for shard_id, offset, length in zip(index['shards'].tolist(), index['block_offsets'].tolist(), index['block_lengths'].tolist()):
+        indexed_ends[shard_id] = max(indexed_ends.get(shard_id, 0), offset + length)
+    entries = []
+    for shard_id, path, compressed in list_shards(store_dir):
+        if indexed_ends.get(shard_id, 0) >= os.path.getsize(path):
+            continue
+        entries.extend((doc_id, shard_id, offset, length, line)
+                       for doc_id, offset, length, line in scan_shard(path, compressed, indexed_ends.get(shard_id, 0)))
+    return _concat_index(index, entries)
+
+
+def load_index(store_dir):
+    '''
+    :return: the index of a store, with the records written after its last checkpoint
+    '''
+    index_path = os.path.join(store_dir, INDEX_NAME)
+    index = None
+    if os.path.exists(index_path):
+        with np.load(index_path) as npz:
+            index = dict((k, npz[k]) for k in INDEX_FIELDS)
+    return build_index(store_dir, index)
+
+
+class PredictionStoreWriter(object):
+    """
+    Append records to a prediction store with a background writer thread. Records of an existing store are kept,
+    new records go to new shards.
+
+    Arguments:
+        store_dir (str): directory of the store, created if needed
+        shard_size (int): number of records per shard
+        compress (bool): gzip the shards
+        block_size (int): bytes of serialized records buffered before a write
+        max_pending (int): number of records waiting for the writer thread before write() blocks
+    """
+
+    def __init__(self, store_dir, shard_size=10000, compress=False, block_size=1 << 20, max_pending=1024):
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        self.store_dir = store_dir
+        self.shard_size = shard_size
+        self.compress = compress
+        self.block_size = block_size
+
+        self.index = load_index(store_dir)
+        shards = list_shards(store_dir)
+        self.shard_id = shards[-1][0] + 1 if len(shards) > 0 else 0
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._write_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, doc_id, record):
+        '''
+        :param record: a json-serializable dict, it must not be modified afterwards
+        '''
+        if self._error is not None:
+            raise self._error
+        self._queue.put((doc_id, record))
+
+    def _write_loop(self):
+        shard_file, shard_records = None, 0
+        block, block_docs, block_bytes = [], [], 0
+        try:
+            while True:
+                item = self._queue.get()
+                if item is not None:
+                    doc_id, record = item
+                    record = dict(record, doc_id=doc_id)
+                    line = (json.dumps(record) + '\n').encode('utf-8')
+                    block.append(line)
+                    block_docs.append(doc_id)
+                    block_bytes += len(line)
+                    shard_records += 1
+
+                # a block ends at the block size, at the end of a shard and at the end of the store
+                if len(block) > 0 and (item is None or block_bytes >= self.block_size or shard_records >= self.shard_size):
+                    if shard_file is None:
+                        shard_file = open(shard_path(self.store_dir, self.shard_id, self.compress), 'ab')
+                    data = b''.join(block)
+                    if self.compress:
+                        data = gzip.compress(data, compresslevel=6)
+                    offset = shard_file.tell()
+                    shard_file.write(data)
+                    shard_file.flush()
+                    # checkpoint the index, the records of a killed run are found without a scan of the whole store
+                    self.index = _concat_index(self.index, [(d, self.shard_id, offset, len(data), i) for i, d in enumerate(block_docs)])
+                    _save_index(self.store_dir, self.index)
+                    block, block_docs, block_bytes = [], [], 0
+
+                if shard_file is not None and (item is None or shard_records >= self.shard_size):
+                    shard_file.close()
+                    shard_file, shard_records = None, 0
+                    self.shard_id += 1
+                if item is None:
+                    break
+        except Exception as e:
+            self._error = e
+            # keep consuming, so that write() and close() don't block
+            while self._queue.get() is not None:
+                pass
+        finally:
+            if shard_file is not None:
+                shard_file.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        _save_index(self.store_dir, self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PredictionStore(object):
+    """
+    Indexed reader of a prediction store, the last decoded block is kept for sequential reads
+
+    Arguments:
+        store_dir (str): directory of the store
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index = load_index(store_dir)
+        self.shards = dict((shard_id, (path, compressed)) for shard_id, path, compressed in list_shards(store_dir))
+        # a document written twice is read from its last record
+        self.rows = dict((int(d), r) for r, d in enumerate(self.index['doc_ids'].tolist()))
+        self._block_key = None
+        self._block_lines = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.rows
+
+    def doc_ids(self):
+        return sorted(self.rows)
+
+    def _read_block(self, shard_id, offset, length):
+        if self._block_key != (shard_id, offset):
+            path, compressed = self.shards[shard_id]
+            with open(path, 'rb') as shard_file:
+                shard_file.seek(offset)
+                data = shard_file.read(length)
+            if compressed:
+                data = gzip.decompress(data)
+            self._block_key = (shard_id, offset)
+            self._block_lines = data.splitlines()
+        return self._block_lines
+
+    def get(self, doc_id):
+        row = self.rows[doc_id]
+        lines = self._read_block(int(self.index['shards'][row]), int(self.index['block_offsets'][row]),
+                                 int(self.index['block_lengths'][row]))
+        return json.loads(lines[int(self.index['lines'][row])].decode('utf-8'))
+
+    def __iter__(self):
+        '''
+        Records in the order of doc ids
+        '''
+        for doc_id in self.doc_ids():
+            yield self.get(doc_id)
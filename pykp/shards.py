@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Sharded one2many datasets.
+A split is written as N shards <dataset>.<split>.one2many.shard<k>.pt|.col of similar numbers of tokens, each with its
+metadata index (see pykp.metadata), and a manifest <dataset>.<split>.one2many.manifest.json listing them.
+A manifest may point to shards in another directory (paths are relative to the manifest), so a subset of shards
+(e.g. the _small debug split, the shards of the first 20000 examples) is just another manifest.
+"""
+import glob
+import json
+import os
+import re
+
+import numpy as np
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+MANIFEST_SUFFIX = '.manifest.json'
+
+
+def manifest_path(prefix):
+    '''
+    :param prefix: path of the split without extension, e.g. data/kp20k/kp20k.train.one2many
+    '''
+    return prefix + MANIFEST_SUFFIX
+
+
+def shard_prefix(prefix, shard_id):
+    return '%s.shard%d' % (prefix, shard_id)
+
+
+def split_by_tokens(num_tokens, num_shards, boundaries=()):
+    '''
+    Split a sequence of examples into contiguous shards of about the same cumulative number of tokens
+    :param num_tokens: number of tokens of each example, e.g. pykp.metadata.example_costs
+    :param boundaries: indices of examples that must start a shard, the shard across each of them is split in two
+    :return: a list of (start, end) of the non-empty shards
+    '''
+    num_tokens = np.asarray(num_tokens, dtype=np.int64)
+    if len(num_tokens) == 0:
+        return []
+    cum_tokens = np.cumsum(num_tokens)
+    # the k-th shard ends with the example whose cumulative count crosses k/N of the total
+    targets = cum_tokens[-1] * np.arange(1, num_shards) / float(num_shards)
+    bounds = [0] + (np.searchsorted(cum_tokens, targets) + 1).tolist() + list(boundaries) + [len(num_tokens)]
+    bounds = sorted(set(min(b, len(num_tokens)) for b in bounds))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def write_manifest(path, shards):
+    '''
+    :param shards: a list of dicts {'prefix': shard path without extension, 'formats': ['pt', 'col'], 'num_examples', 'num_tokens'}
+    :return: the manifest, with the prefixes as given (they are stored relative to the manifest)
+    '''
+    manifest = {'num_shards': len(shards),
+                'num_examples': sum([s['num_examples'] for s in shards]),
+                'num_tokens': sum([s['num_tokens'] for s in shards]),
+                'shards': [dict(s) for s in shards]}
+
+    root = os.path.dirname(os.path.abspath(path))
+    stored_manifest = dict(manifest)
+    stored_manifest['shards'] = [dict(s, prefix=os.path.relpath(os.path.abspath(s['prefix']), root)) for s in shards]
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(stored_manifest, manifest_file, indent=2)
+    os.replace(tmp_path, path)
+    return manifest
+
+
+def load_manifest(path):
+    '''
+    Shard prefixes of the returned manifest are resolved to paths usable from the current directory
+    '''
+    with open(path, 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    root = os.path.dirname(os.path.abspath(path))
+    for shard in manifest['shards']:
+        shard['prefix'] = os.path.normpath(os.path.join(root, shard['prefix']))
+    return manifest
+
+
+def subset_manifest(manifest, shard_ids=None, max_examples=None):
+    '''
+    Shards of a manifest, either the given ones or the first ones holding at least max_examples examples
+    '''
+    shards = manifest['shards']
+    if shard_ids is not None:
+        shards = [shards[i] for i in shard_ids]
+    if max_examples is not None:
+        num_examples = np.cumsum([s['num_examples'] for s in shards])
+        shards = shards[: int(np.searchsorted(num_examples, max_examples)) + 1]
+    return shards
+
+
+def shard_data_path(shard):
+    '''
+    Path of a shard in a manifest, the columnar version is preferred
+    '''
+    return shard['prefix'] + ('.col' if 'col' in shard['formats'] else '.pt')
+
+
+def list_shards(prefix, shard_ids=None):
+    '''
+    Paths of the shards of a split, from its manifest if there is one, otherwise from the files
+    <prefix>.shard<k>.pt|.col sorted by k (the columnar version is preferred if both exist)
+    :param shard_ids: only return these shards (indices in the list of shards)
+    '''
+    if os.path.exists(manifest_path(prefix)):
+        return [shard_data_path(s) for s in subset_manifest(load_manifest(manifest_path(prefix)), shard_ids)]
+
+    shards = {}
+    for path in glob.glob(glob.escape(prefix) + '.shard*'):
+        match = re.match(r'^\.shard(\d+)\.(pt|col)$', path[len(prefix):])
+        if match is None:
+            continue
+        shard_id, ext = int(match.group(1)), match.group(2)
+        if shard_id not in shards or ext == 'col':
+            shards[shard_id] = path
+    paths = [shards[k] for k in sorted(shards)]
+    if shard_ids is not None:
+        paths = [paths[i] for i in shard_ids]
+    return paths
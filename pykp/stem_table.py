@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Stems of the vocab words, computed once per vocab instead of at every evaluation.
+The table maps every word id < vocab_size to a stem id, and is saved next to the vocab (<dataset>.vocab.stems.npz).
+Words outside the table (oov words, or ids >= vocab_size) are stemmed through a bounded LRU cache.
+
+stem_key(word) is the stem id of a word, or the stem string itself if this stem is not the stem of any vocab word,
+so that two words have the same key iff they have the same stem (as evaluate.stem_word_list). Phrases are then
+compared as tuples of keys, mostly integers.
+"""
+import collections
+import os
+
+import numpy as np
+from nltk.stem.porter import PorterStemmer
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+STEMS_SUFFIX = '.stems.npz'
+
+stemmer = PorterStemmer()
+
+
+def stem_word(word):
+    # the same normalization as evaluate.stem_word_list
+    return stemmer.stem(word.strip().lower())
+
+
+class StemTable(object):
+    """
+    Arguments:
+        word2id: the vocab (dict or pykp.vocab mapping)
+        stem_ids (np.ndarray): stem id of each word id < len(stem_ids)
+        stems (list of str): the stem of each stem id
+        cache_size (int): number of oov words whose stem is cached
+    """
+
+    def __init__(self, word2id, stem_ids, stems, cache_size=100000):
+        self.word2id = word2id
+        self.stem_ids = stem_ids
+        self.stems = stems
+        self.stem2id = dict((s, i) for i, s in enumerate(stems))
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+
+    @classmethod
+    def build(cls, word2id, id2word, vocab_size, cache_size=100000):
+        stem_ids = np.zeros(min(vocab_size, len(id2word)), dtype=np.int32)
+        stem2id = {}
+        for i in range(len(stem_ids)):
+            stem_ids[i] = stem2id.setdefault(stem_word(id2word[i]), len(stem2id))
+        stems = [s for s, _ in sorted(stem2id.items(), key=lambda x: x[1])]
+        return cls(word2id, stem_ids, stems, cache_size=cache_size)
+
+    def save(self, path):
+        encoded = [s.encode('utf-8') for s in self.stems]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(s) for s in encoded])
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, stem_ids=self.stem_ids, stem_offsets=offsets,
+                 stem_bytes=np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, word2id, cache_size=100000):
+        with np.load(path) as npz:
+            stem_ids, offsets, data = npz['stem_ids'], npz['stem_offsets'], npz['stem_bytes'].tobytes()
+        stems = [data[offsets[i]: offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+        return cls(word2id, stem_ids, stems, cache_size=cache_size)
+
+    def _stem_oov(self, word):
+        if word in self._cache:
+            self._cache.move_to_end(word)
+            return self._cache[word]
+        stem = stem_word(word)
+        key = self.stem2id.get(stem, stem)
+        self._cache[word] = key
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return key
+
+    def stem_key(self, word):
+        word_id = self.word2id.get(word)
+        if word_id is not None and word_id < len(self.stem_ids):
+            return int(self.stem_ids[word_id])
+        return self._stem_oov(word)
+
+    def stem_keys(self, words):
+        return tuple(self.stem_key(w) for w in words)
+
+
+def stem_table_path(vocab_path):
+    for suffix in ['.vocab.pt', '.vocab.bin']:
+        if vocab_path.endswith(suffix):
+            return vocab_path[:-len(suffix)] + '.vocab' + STEMS_SUFFIX
+    return vocab_path + STEMS_SUFFIX
+
+
+def load_stem_table(vocab_path, word2id, id2word, vocab_size):
+    '''
+    Load the stem table of a vocab, or build it (and save it if possible) if it's missing, older than the vocab, or
+    built for a smaller vocab_size
+    '''
+    path = stem_table_path(vocab_path)
+    if os.path.exists(path) and (not os.path.exists(vocab_path) or os.path.getmtime(path) >= os.path.getmtime(vocab_path)):
+        table = StemTable.load(path, word2id)
+        if len(table.stem_ids) >= min(vocab_size, len(id2word)):
+            return table
+
+    table = StemTable.build(word2id, id2word, vocab_size)
+    try:
+        table.save(path)
+    except (IOError, OSError):
+        pass
+    return table
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming training over a sharded one2many dataset, for corpora that don't fit in memory as one list (e.g. MAG).
+Shards are ordinary processed datasets (.pt or columnar .col, see pykp.io.KeyphraseDataset), listed by
+pykp.shards.list_shards, read one after another.
+At each epoch the shards are permuted with (seed + epoch), examples go through a bounded shuffle buffer, and are
+grouped into one2many batches with the same limits as pykp.dataloader.One2ManyBatchSampler.
+With several workers, each worker reads its own shards (or every num_workers-th example of each shard if there are
+fewer shards than workers), so no example is read twice in an epoch.
+"""
+import sys
+
+import numpy as np
+import torch
+import torch.multiprocessing as multiprocessing
+
+if sys.version_info[0] == 2:
+    import Queue as queue
+else:
+    import queue
+
+from pykp.dataloader import ExceptionWrapper, estimate_num_batches, pin_memory_batch, split_one2many_batches
+from pykp.io import KeyphraseDataset
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+# torch.utils.data.IterableDataset only exists in recent versions of PyTorch
+_IterableDataset = getattr(torch.utils.data, 'IterableDataset', object)
+
+
+class StreamingKeyphraseDataset(_IterableDataset):
+    """
+    Iterates over the examples of a list of shards, see the module docstring.
+
+    Arguments:
+        shard_paths (list of str): paths of the shards
+        word2id, id2word: vocab, passed to KeyphraseDataset
+        shuffle_buffer_size (int): number of examples in the shuffle buffer, 0 or 1 means no shuffling
+        shuffle_shards (bool): permute the shards at every epoch
+        seed (int): the permutations of epoch i are drawn with seed + i
+    """
+
+    def __init__(self, shard_paths, word2id, id2word, include_original=False,
+                 shuffle_buffer_size=10000, shuffle_shards=True, seed=9527):
+        self.shard_paths         = list(shard_paths)
+        self.word2id             = word2id
+        self.id2word             = id2word
+        self.include_original    = include_original
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.shuffle_shards      = shuffle_shards
+        self.seed                = seed
+        self.epoch               = 0
+        self._num_trgs           = None
+
+        if len(self.shard_paths) == 0:
+            raise ValueError('No shard is given')
+
+        # used for collate_fn_one2many, never loads any example
+        self.collate_dataset     = KeyphraseDataset(self.shard_paths[0], word2id=word2id, id2word=id2word,
+                                                    type='one2many', include_original=include_original, lazy_load=True)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def open_shard(self, shard_path):
+        return KeyphraseDataset(shard_path, word2id=self.word2id, id2word=self.id2word, type='one2many',
+                                include_original=self.include_original, lazy_load=True)
+
+    def get_num_trgs(self):
+        '''
+        Number of targets of each example, shard after shard (read from the metadata index of each shard)
+        '''
+        if self._num_trgs is None:
+            self._num_trgs = np.concatenate([self.open_shard(p).get_num_trgs() for p in self.shard_paths])
+        return self._num_trgs
+
+    def __len__(self):
+        return len(self.get_num_trgs())
+
+    def collate_fn_one2many(self, batches):
+        return self.collate_dataset.collate_fn_one2many(batches)
+
+    def _worker_shards(self, worker_id, num_workers):
+        '''
+        :return: a list of (shard_path, stride, offset): the worker reads the examples offset, offset + stride, ...
+        '''
+        shard_paths = self.shard_paths
+        if self.shuffle_shards:
+            rng = np.random.RandomState(self.seed + self.epoch)
+            shard_paths = [shard_paths[i] for i in rng.permutation(len(shard_paths))]
+        if len(shard_paths) >= num_workers:
+            return [(p, 1, 0) for p in shard_paths[worker_id::num_workers]]
+        return [(p, num_workers, worker_id) for p in shard_paths]
+
+    def _iter_shards(self, worker_id, num_workers):
+        for shard_path, stride, offset in self._worker_shards(worker_id, num_workers):
+            shard = self.open_shard(shard_path)
+            for i in range(offset, len(shard), stride):
+                yield shard[i]
+            shard.offload_dataset()
+
+    def iter_examples(self, worker_id=0, num_workers=1):
+        '''
+        Examples of one worker, shuffled through a buffer of shuffle_buffer_size examples
+        '''
+        examples = self._iter_shards(worker_id, num_workers)
+        if self.shuffle_buffer_size <= 1:
+            for e in examples:
+                yield e
+            return
+
+        # every worker has its own random stream
+        rng = np.random.RandomState((self.seed + self.epoch) * 1000 + worker_id)
+        buffer = []
+        for e in examples:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(e)
+                continue
+            j = rng.randint(len(buffer))
+            yield buffer[j]
+            buffer[j] = e
+        for j in rng.permutation(len(buffer)):
+            yield buffer[j]
+
+    def __iter__(self):
+        worker_id, num_workers = 0, 1
+        # with torch.utils.data.DataLoader of recent versions, split the shards between its workers
+        get_worker_info = getattr(torch.utils.data, 'get_worker_info', None)
+        if get_worker_info is not None and get_worker_info() is not None:
+            worker_id, num_workers = get_worker_info().id, get_worker_info().num_workers
+        return self.iter_examples(worker_id, num_workers)
+
+
+def _streaming_worker_loop(dataset, data_queue, done_event, collate_fn, worker_id, num_workers,
+                           max_batch_example, max_batch_pair):
+    torch.set_num_threads(1)
+    try:
+        for batch in split_one2many_batches(dataset.iter_examples(worker_id, num_workers), lambda e: len(e['trg']),
+                                            max_batch_example, max_batch_pair):
+            data_queue.put(collate_fn(batch))
+    except Exception:
+        data_queue.put(ExceptionWrapper(sys.exc_info()))
+    data_queue.put(None)
+    # tensors are shared through file descriptors, keep the worker alive until the consumer has received them all
+    done_event.wait()
+
+
+class StreamingDataLoader(object):
+    """
+    Yields collated one2many batches of a StreamingKeyphraseDataset. With num_workers > 0, each worker streams its
+    own part of the dataset and the batches are yielded in the order they are ready.
+    __len__ is an estimation (from the number of targets of each example), the number of batches depends on the order.
+    """
+
+    def __init__(self, dataset, max_batch_example=5, max_batch_pair=1, num_workers=0, collate_fn=None, pin_memory=False):
+        self.dataset            = dataset
+        self.num_trgs           = dataset.get_num_trgs()
+        self.batch_size         = max_batch_pair
+        self.max_example_number = max_batch_example
+        self.max_batch_pair     = max_batch_pair
+        self.num_workers        = num_workers
+        self.collate_fn         = collate_fn if collate_fn is not None else dataset.collate_fn_one2many
+        self.pin_memory         = pin_memory
+
+    def set_epoch(self, epoch):
+        self.dataset.set_epoch(epoch)
+
+    def one2one_number(self):
+        return int(sum(self.num_trgs))
+
+    def __len__(self):
+        return estimate_num_batches(self.num_trgs, self.max_example_number, self.max_batch_pair)
+
+    def __iter__(self):
+        if self.num_workers == 0:
+            for batch in split_one2many_batches(self.dataset.iter_examples(), lambda e: len(e['trg']),
+                                                self.max_example_number, self.max_batch_pair):
+                batch = self.collate_fn(batch)
+                yield pin_memory_batch(batch) if self.pin_memory else batch
+            return
+
+        data_queue = multiprocessing.Queue(maxsize=2 * self.num_workers)
+        done_event = multiprocessing.Event()
+        workers = [multiprocessing.Process(target=_streaming_worker_loop,
+                                           args=(self.dataset, data_queue, done_event, self.collate_fn, i, self.num_workers,
+                                                 self.max_example_number, self.max_batch_pair))
+                   for i in range(self.num_workers)]
+        for w in workers:
+            w.daemon = True  # ensure that the worker exits on process exit
+            w.start()
+
+        try:
+            num_done = 0
+            while num_done < self.num_workers:
+                try:
+                    batch = data_queue.get(timeout=5.0)
+                except queue.Empty:
+                    if any(w.exitcode not in [None, 0] for w in workers):
+                        raise RuntimeError('DataLoader worker exited unexpectedly')
+                    continue
+                if batch is None:
+                    num_done += 1
+                    continue
+                if isinstance(batch, ExceptionWrapper):
+                    raise batch.exc_type(batch.exc_msg)
+                yield pin_memory_batch(batch) if self.pin_memory else batch
+        finally:
+            # also reached when the consumer stops early or on errors
+            done_event.set()
+            for w in workers:
+                w.join(timeout=1.0)
+                if w.is_alive():
+                    w.terminate()
+                w.join()
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+Vocabulary construction and a compact, memory-mappable vocabulary file.
+
+Counting is a map-reduce over chunks (or shards) of tokenized (src, trgs) pairs: each chunk is counted on its own,
+possibly in a worker process, and the Counters are merged in order, so the result (and the word ids, which break
+ties of frequency by first appearance) is the same as a sequential count.
+For corpora whose set of distinct tokens doesn't fit in memory, max_entries bounds the size of the counters:
+whenever a counter gets larger, the tokens seen at most k times are dropped and k is increased (as word2vec's
+ReduceVocab), which undercounts rare tokens only.
+
+The file (<dataset>.vocab.bin) holds the words in id order:
+
+    8 bytes     magic 'KPVOCAB1'
+    8 bytes     length of the json header (uint64, little-endian)
+    header      json {'num_words', 'num_bytes', 'total_count', 'min_freq', 'approximate'}, padded to 8 bytes
+    int64       offsets of the utf-8 bytes of each word, num_words + 1
+    int64       count of each word, num_words (0 for the special tokens)
+    int64       ids sorted by the utf-8 bytes of their word (for lookups by binary search), num_words
+    uint8       utf-8 bytes of the words, num_bytes
+
+Loading maps the file in memory and builds no dict, word2id/id2word are read-only mappings over them.
+"""
+import collections
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+import json
+import mmap
+import multiprocessing
+import os
+import struct
+
+import numpy as np
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+MAGIC = b'KPVOCAB1'
+VOCAB_SUFFIX = '.vocab.bin'
+LEGACY_VOCAB_SUFFIX = '.vocab.pt'
+
+# the special tokens take the first ids, in this order (see pykp.io)
+SPECIAL_WORDS = ['<pad>', '<s>', '</s>', '<unk>', '<sep>']
+
+
+def _prune(counter, max_entries, min_reduce):
+    '''
+    Drop the tokens seen at most min_reduce times until the counter has at most max_entries entries
+    :return: the next min_reduce
+    '''
+    while len(counter) > max_entries:
+        for token in [t for t, c in counter.items() if c <= min_reduce]:
+            del counter[token]
+        min_reduce += 1
+    return min_reduce
+
+
+def count_tokens(tokenized_src_trgs_pairs, max_entries=0):
+    '''
+    Count the tokens of the sources and targets, streaming over any iterable of pairs
+    :param max_entries: if > 0, approximate counting with at most about max_entries distinct tokens in memory
+    :return: (counter, approximate)
+    '''
+    counter = collections.Counter()
+    min_reduce = 1
+    for src_tokens, trgs_tokens in tokenized_src_trgs_pairs:
+        counter.update(src_tokens)
+        for trg_tokens in trgs_tokens:
+            counter.update(trg_tokens)
+        if max_entries > 0 and len(counter) > max_entries:
+            min_reduce = _prune(counter, max_entries, min_reduce)
+    return counter, min_reduce > 1
+
+
+# the pairs are inherited by the forked workers, only the chunk bounds are sent to them
+_pairs_to_count = None
+
+
+def _count_chunk(args):
+    start, end, max_entries = args
+    return count_tokens(_pairs_to_count[start: end], max_entries)
+
+
+def merge_counts(chunk_counts, max_entries=0):
+    '''
+    Reduce the (counter, approximate) of chunks, in the order of the chunks
+    '''
+    counter = collections.Counter()
+    approximate = False
+    min_reduce = 1
+    for chunk_counter, chunk_approximate in chunk_counts:
+        counter.update(chunk_counter)
+        approximate |= chunk_approximate
+        if max_entries > 0 and len(counter) > max_entries:
+            min_reduce = _prune(counter, max_entries, min_reduce)
+    return counter, approximate or min_reduce > 1
+
+
+def count_tokens_parallel(tokenized_src_trgs_pairs, num_workers=1, chunk_size=20000, max_entries=0):
+    '''
+    Map-reduce count_tokens over chunks of a list of pairs (counts of separate shards can be reduced with merge_counts)
+    '''
+    global _pairs_to_count
+
+    if num_workers <= 1 or len(tokenized_src_trgs_pairs) <= chunk_size:
+        return count_tokens(tokenized_src_trgs_pairs, max_entries)
+
+    chunks = [(start, min(start + chunk_size, len(tokenized_src_trgs_pairs)), max_entries)
+              for start in range(0, len(tokenized_src_trgs_pairs), chunk_size)]
+    _pairs_to_count = tokenized_src_trgs_pairs
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        # imap keeps the order of the chunks, so the merged counter keeps the order of first appearance
+        return merge_counts(pool.imap(_count_chunk, chunks), max_entries)
+    finally:
+        pool.close()
+        pool.join()
+        _pairs_to_count = None
+
+
+def sorted_words(counter, min_freq=0):
+    '''
+    The special tokens followed by the words by decreasing frequency (ties by order of first appearance)
+    :return: (words, counts)
+    '''
+    words = [(w, c) for w, c in counter.items() if w not in SPECIAL_WORDS and c >= min_freq]
+    words = sorted(words, key=lambda x: x[1], reverse=True)
+    return SPECIAL_WORDS + [w for w, _ in words], [0] * len(SPECIAL_WORDS) + [c for _, c in words]
+
+
+def save_vocab(path, words, counts, min_freq=0, approximate=False):
+    '''
+    :param words: the words in id order, starting with the special tokens
+    '''
+    encoded = [w.encode('utf-8') for w in words]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(w) for w in encoded])
+    counts = np.asarray(counts, dtype=np.int64)
+    # stable sort, ties can't happen since the words are unique
+    sorted_ids = np.asarray(sorted(range(len(encoded)), key=lambda i: encoded[i]), dtype=np.int64)
+
+    header = json.dumps({'num_words': len(encoded), 'num_bytes': int(offsets[-1]), 'total_count': int(counts.sum()),
+                         'min_freq': min_freq, 'approximate': bool(approximate)}).encode('utf-8')
+    header += b' ' * (-len(header) % 8)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as vocab_file:
+        vocab_file.write(MAGIC)
+        vocab_file.write(struct.pack('<Q', len(header)))
+        vocab_file.write(header)
+        vocab_file.write(offsets.tobytes())
+        vocab_file.write(counts.tobytes())
+        vocab_file.write(sorted_ids.tobytes())
+        vocab_file.write(b''.join(encoded))
+    os.replace(tmp_path, path)
+
+
+def is_compact_vocab(path):
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as vocab_file:
+        return vocab_file.read(len(MAGIC)) == MAGIC
+
+
+def resolve_vocab_path(vocab_path):
+    '''
+    x.vocab.pt and x.vocab.bin are the same vocab, use whichever exists (the compact one is preferred)
+    '''
+    for suffix in [LEGACY_VOCAB_SUFFIX, VOCAB_SUFFIX]:
+        if vocab_path.endswith(suffix):
+            prefix = vocab_path[:-len(suffix)]
+            for candidate in [prefix + VOCAB_SUFFIX, prefix + LEGACY_VOCAB_SUFFIX]:
+                if os.path.exists(candidate):
+                    return candidate
+    return vocab_path
+
+
+class _Word2Id(Mapping):
+    '''
+    word -> id, binary search over the words sorted by bytes. The ids of the last cache_size words found are kept in an
+    LRU cache, misses (oov words) are not cached
+    '''
+
+    def __init__(self, vocab, cache_size=100000):
+        self.vocab = vocab
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+
+    def _find(self, word):
+        key = word.encode('utf-8')
+        sorted_ids = self.vocab._sorted_ids_view
+        lo, hi = 0, len(sorted_ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key = self.vocab.word_bytes(sorted_ids[mid])
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                return sorted_ids[mid]
+        return None
+
+    def __getitem__(self, word):
+        if word in self._cache:
+            self._cache.move_to_end(word)
+            return self._cache[word]
+        word_id = self._find(word)
+        if word_id is None:
+            raise KeyError(word)
+        self._cache[word] = word_id
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return word_id
+
+    def __contains__(self, word):
+        try:
+            self[word]
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        return (self.vocab.word(i) for i in range(len(self.vocab)))
+
+    def __len__(self):
+        return len(self.vocab)
+
+
+class _Id2Word(Mapping):
+    '''
+    id -> word
+    '''
+
+    def __init__(self, vocab):
+        self.vocab = vocab
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self.vocab):
+            raise KeyError(i)
+        return self.vocab.word(int(i))
+
+    def __iter__(self):
+        return iter(range(len(self.vocab)))
+
+    def __len__(self):
+        return len(self.vocab)
+
+
+class Vocab(object):
+    """
+    A memory-mapped vocab file, see the module docstring.
+    len(vocab) is the number of ids (special tokens included), vocab.counts[i] the frequency of the word of id i.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as vocab_file:
+            if vocab_file.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a compact vocab file' % path)
+            header_len = struct.unpack('<Q', vocab_file.read(8))[0]
+            self.meta = json.loads(vocab_file.read(header_len).decode('utf-8'))
+            self._mmap = mmap.mmap(vocab_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        num_words, offset = self.meta['num_words'], len(MAGIC) + 8 + header_len
+        self.offsets = np.frombuffer(self._mmap, dtype=np.int64, count=num_words + 1, offset=offset)
+        offset += 8 * (num_words + 1)
+        self.counts = np.frombuffer(self._mmap, dtype=np.int64, count=num_words, offset=offset)
+        offset += 8 * num_words
+        self.sorted_ids = np.frombuffer(self._mmap, dtype=np.int64, count=num_words, offset=offset)
+        offset += 8 * num_words
+        self._data_offset = offset
+
+        # scalar reads of numpy arrays are slow, lookups go through memoryviews of the same pages
+        self._offsets_view = memoryview(self.offsets).cast('B').cast('q')
+        self._sorted_ids_view = memoryview(self.sorted_ids).cast('B').cast('q')
+
+        self.word2id = _Word2Id(self)
+        self.id2word = _Id2Word(self)
+
+    def __getstate__(self):
+        # the mapping is reopened by the unpickling process (e.g. DataLoader workers)
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def __len__(self):
+        return self.meta['num_words']
+
+    def word_bytes(self, i):
+        return self._mmap[self._data_offset + self._offsets_view[i]: self._data_offset + self._offsets_view[i + 1]]
+
+    def word(self, i):
+        return self.word_bytes(i).decode('utf-8')
+
+    def to_dicts(self):
+        '''
+        :return: (word2id, id2word, vocab) as plain dicts, as in the pickled vocab of pykp.io.build_vocab
+        '''
+        words = [self.word(i) for i in range(len(self))]
+        word2id = dict((w, i) for i, w in enumerate(words))
+        id2word = dict(enumerate(words))
+        vocab = dict((w, int(c)) for w, c in zip(words[len(SPECIAL_WORDS):], self.counts[len(SPECIAL_WORDS):]))
+        return word2id, id2word, vocab
+
+
+def load_vocab(vocab_path):
+    '''
+    Load a vocab saved by preprocess.py, compact (.vocab.bin) or pickled (.vocab.pt)
+    :return: (word2id, id2word, vocab)
+    '''
+    vocab_path = resolve_vocab_path(vocab_path)
+    if is_compact_vocab(vocab_path):
+        vocab = Vocab(vocab_path)
+        return vocab.word2id, vocab.id2word, vocab
+
+    import torch
+    return torch.load(vocab_path, 'rb')
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Pretrained word vectors (GloVe/word2vec/fastText text format) for -pre_word_vecs_enc/-pre_word_vecs_dec.
+A text file is converted once into two files next to it (or under cache_prefix), read with numpy.memmap afterwards:
+    <path>.vocab.bin      the words, in the compact vocab format of pykp.vocab
+    <path>.vectors.npy    float32 matrix, one row per word
+Filling an embedding only reads the rows of the words of the model vocab.
+Usage (conversion only):
+    python -m pykp.word_vectors -input glove.6B.100d.txt
+"""
+import argparse
+import codecs
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+
+from pykp.vocab import Vocab, save_vocab
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+WORDS_SUFFIX = '.vocab.bin'
+VECTORS_SUFFIX = '.vectors.npy'
+
+
+def text_vectors_shape(text_path):
+    '''
+    Number of vectors and dimension of a text file, skipping the "<count> <dim>" header of word2vec/fastText files
+    :return: (num_vectors, dim, has_header)
+    '''
+    num_lines, dim, has_header = 0, None, False
+    with codecs.open(text_path, 'r', 'utf-8', errors='replace') as text_file:
+        first_line = text_file.readline()
+        fields = first_line.rstrip().split(' ')
+        if len(fields) == 2 and all(f.isdigit() for f in fields):
+            has_header, dim = True, int(fields[1])
+        else:
+            dim, num_lines = len(fields) - 1, 1
+        for _ in text_file:
+            num_lines += 1
+    return num_lines, dim, has_header
+
+
+def convert_text_vectors(text_path, cache_prefix=None):
+    '''
+    Convert a text vector file into the binary format, duplicated words keep their first vector and lines of a wrong
+    dimension are skipped
+    :return: the prefix of the binary files
+    '''
+    prefix = cache_prefix if cache_prefix is not None else text_path
+    num_lines, dim, has_header = text_vectors_shape(text_path)
+    logging.info('Converting %d word vectors of dim=%d from %s to %s' % (num_lines, dim, text_path, prefix + VECTORS_SUFFIX))
+
+    tmp_vectors_path = prefix + '.tmp' + VECTORS_SUFFIX
+    vectors = np.lib.format.open_memmap(tmp_vectors_path, mode='w+', dtype=np.float32, shape=(num_lines, dim))
+    words, seen = [], set()
+    with codecs.open(text_path, 'r', 'utf-8', errors='replace') as text_file:
+        if has_header:
+            text_file.readline()
+        for line in text_file:
+            fields = line.rstrip().split(' ')
+            if len(fields) <= dim:
+                continue
+            word = ' '.join(fields[: len(fields) - dim])
+            if word in seen:
+                continue
+            seen.add(word)
+            vectors[len(words)] = np.asarray(fields[len(fields) - dim:], dtype=np.float32)
+            words.append(word)
+    vectors.flush()
+    del vectors
+
+    # shrink the matrix to the kept rows, rewriting the header only
+    kept = np.load(tmp_vectors_path, mmap_mode='r')[: len(words)]
+    np.save(prefix + VECTORS_SUFFIX, kept)
+    del kept
+    os.remove(tmp_vectors_path)
+    save_vocab(prefix + WORDS_SUFFIX, words, [0] * len(words))
+    logging.info('Converted %d word vectors (%d duplicated or malformed lines skipped)' % (len(words), num_lines - len(words)))
+    return prefix
+
+
+class WordVectors(object):
+    """
+    Memory-mapped word vectors: words is a pykp.vocab.Vocab, vectors a (len(words), dim) float32 numpy.memmap
+    """
+
+    def __init__(self, prefix):
+        self.words = Vocab(prefix + WORDS_SUFFIX)
+        self.vectors = np.load(prefix + VECTORS_SUFFIX, mmap_mode='r')
+        assert len(self.words) == len(self.vectors)
+
+    @property
+    def dim(self):
+        return self.vectors.shape[1]
+
+    def __len__(self):
+        return len(self.words)
+
+
+def load_word_vectors(path, cache_prefix=None):
+    '''
+    :param path: a text vector file (converted at the first call), or the prefix of converted files
+    '''
+    prefix = cache_prefix if cache_prefix is not None else path
+    converted = os.path.exists(prefix + WORDS_SUFFIX) and os.path.exists(prefix + VECTORS_SUFFIX)
+    if converted and os.path.isfile(path) and os.path.getmtime(path) > os.path.getmtime(prefix + WORDS_SUFFIX):
+        converted = False
+    if not converted:
+        convert_text_vectors(path, cache_prefix=prefix)
+    return WordVectors(prefix)
+
+
+def fill_embedding(weight, id2word, vocab_size, word_vectors):
+    '''
+    Copy the pretrained vectors of the words of ids [0, vocab_size) into weight (an embedding matrix), the rows of
+    the other words are left as they are
+    :return: the number of rows filled
+    '''
+    if weight.size(1) != word_vectors.dim:
+        raise ValueError('The pretrained vectors have dim=%d, the embedding has dim=%d (-word_vec_size)'
+                         % (word_vectors.dim, weight.size(1)))
+    model_ids, vector_ids = [], []
+    for i in range(min(vocab_size, len(id2word))):
+        vector_id = word_vectors.words.word2id.get(id2word[i])
+        if vector_id is not None:
+            model_ids.append(i)
+            vector_ids.append(vector_id)
+    if len(model_ids) == 0:
+        return 0
+
+    # sorted indices keep the reads of the memmap sequential
+    order = np.argsort(vector_ids)
+    rows = np.asarray(word_vectors.vectors[np.asarray(vector_ids)[order]])
+    index = torch.from_numpy(np.asarray(model_ids, dtype=np.int64)[order]).to(weight.device)
+    weight.index_copy_(0, index, torch.from_numpy(rows).type_as(weight))
+    return len(model_ids)
+
+
+def load_pretrained_embedding(model, opt, load_vectors=True):
+    '''
+    Initialize model.embedding from -pre_word_vecs_enc/-pre_word_vecs_dec and freeze it with -fix_word_vecs_enc/dec.
+    The encoder and the decoder share one embedding: if both paths are given, the decoder vectors are loaded last.
+    :param load_vectors: False to only freeze the embedding (e.g. when it's restored from a checkpoint)
+    '''
+    paths = [p for p in [opt.pre_word_vecs_enc, opt.pre_word_vecs_dec] if p] if load_vectors else []
+    for path in sorted(set(paths), key=paths.index):
+        start_time = time.time()
+        word_vectors = load_word_vectors(path)
+        num_filled = fill_embedding(model.embedding.weight.data, opt.id2word, opt.vocab_size, word_vectors)
+        logging.info('Loaded pretrained word vectors from %s in %.2f seconds: %d/%d words of the vocab covered (%.2f%%)'
+                     % (path, time.time() - start_time, num_filled, opt.vocab_size,
+                        100.0 * num_filled / max(opt.vocab_size, 1)))
+
+    if opt.fix_word_vecs_enc or opt.fix_word_vecs_dec:
+        logging.info('Word embeddings are fixed')
+        model.embedding.weight.requires_grad = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pykp.word_vectors', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-input', required=True, help='Path to a text word vector file')
+    parser.add_argument('-output_prefix', default=None, help='Prefix of the binary files, the input path by default')
+    opt = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    start_time = time.time()
+    prefix = convert_text_vectors(opt.input, cache_prefix=opt.output_prefix)
+    word_vectors = WordVectors(prefix)
+    logging.info('%d vectors of dim=%d written to %s in %.2f seconds' % (len(word_vectors), word_vectors.dim, prefix, time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Score the predictions of an evaluation round again with other filters, without the model and the beam search.
+evaluate_beam_search saves every decoded document in a prediction store (<title>_predictions/, see
+pykp.prediction_store), with the ranked predictions and their scores. Each filter configuration is scored from it:
+    presence            present: targets and predictions found in the source (as -must_appear_in_src)
+                        absent: targets and predictions not found in the source
+                        all: no filter on presence
+    num_oneword_seq     number of one-word predictions kept (-1 keeps all of them, as evaluate_beam_search)
+and the metrics are reported at every k of -topk. Documents without target after the filter are not scored.
+    python rescore.py -store exp/kp20k/pred/valid_predictions -presence present all absent -num_oneword_seq -1 1
+"""
+import argparse
+import json
+import logging
+
+import numpy as np
+
+from evaluate import get_match_result, if_present_duplicate_phrases, post_process_predseqs, set_stem_table, stem_key_list
+from pykp.metric.keyphrase import MetricAccumulator
+from pykp.phrase_match import NgramIndex
+from pykp.prediction_store import PredictionStore
+from pykp.stem_table import StemTable
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+logger = logging.getLogger()
+
+PRESENCE_FILTERS = ['present', 'absent', 'all']
+
+
+def filter_targets(src_index, trg_str_seqs, presence):
+    '''
+    :return: the indices of the targets kept by the presence filter, stem-duplicated targets count as absent
+    '''
+    if presence == 'all':
+        return list(range(len(trg_str_seqs)))
+    present_flags, _ = if_present_duplicate_phrases(None, trg_str_seqs, src_index=src_index)
+    if presence == 'present':
+        return [i for i, is_present in enumerate(present_flags) if is_present]
+    # absent targets, once each after stemming
+    kept, phrase_set = [], set()
+    for i, (trg_str, is_present) in enumerate(zip(trg_str_seqs, present_flags)):
+        trg_keys = stem_key_list(trg_str)
+        if not is_present and src_index.find(trg_keys) < 0 and trg_keys not in phrase_set:
+            kept.append(i)
+        phrase_set.add(trg_keys)
+    return kept
+
+
+def filter_predictions(src_index, pred_str_seqs, pred_scores, valid_flags, presence):
+    '''
+    :return: (predictions, scores) that are valid and kept by the presence filter, in their rank order
+    '''
+    kept = set(filter_targets(src_index, pred_str_seqs, presence))
+    pairs = [(p, s) for i, (p, s, is_valid) in enumerate(zip(pred_str_seqs, pred_scores, valid_flags)) if is_valid and i in kept]
+    return [p for p, _ in pairs], [s for _, s in pairs]
+
+
+def rescore(records, presence_filters, oneword_limits, topk_range):
+    '''
+    :param records: records of a prediction store (src_str, trg_str, pred_str, pred_score, valid_flag)
+    :return: a dict of MetricAccumulator (exact, soft) of each configuration (presence, num_oneword_seq)
+    '''
+    configs = [(presence, num_oneword_seq) for presence in presence_filters for num_oneword_seq in oneword_limits]
+    accumulators = dict((config, {'exact': MetricAccumulator(topk_range), 'soft': MetricAccumulator(topk_range)}) for config in configs)
+
+    for record in records:
+        src_str, trg_str_seqs = record['src_str'], record['trg_str']
+        # the stemmed source is indexed once for all the filters
+        src_index = NgramIndex(stem_key_list(src_str))
+        for presence in presence_filters:
+            trg_ids = filter_targets(src_index, trg_str_seqs, presence)
+            if presence != 'all' and len(trg_ids) == 0:
+                continue
+            filtered_trg_str_seqs = [trg_str_seqs[i] for i in trg_ids]
+            filtered_trg_keys = [stem_key_list(t) for t in filtered_trg_str_seqs]
+            pred_str_seqs, pred_scores = filter_predictions(src_index, record['pred_str'], record['pred_score'],
+                                                            record['valid_flag'], presence)
+            for num_oneword_seq in oneword_limits:
+                _, filtered_pred_str_seqs, _ = post_process_predseqs((pred_str_seqs, pred_str_seqs, pred_scores), num_oneword_seq)
+                match_list_exact = get_match_result(true_seqs=filtered_trg_str_seqs, pred_seqs=filtered_pred_str_seqs, type='exact', true_keys=filtered_trg_keys)
+                match_list_soft = get_match_result(true_seqs=filtered_trg_str_seqs, pred_seqs=filtered_pred_str_seqs, type='partial', true_keys=filtered_trg_keys)
+                accumulators[(presence, num_oneword_seq)]['exact'].add(match_list_exact, len(filtered_trg_str_seqs))
+                accumulators[(presence, num_oneword_seq)]['soft'].add(match_list_soft, len(filtered_trg_str_seqs))
+    return accumulators
+
+
+def score_report(accumulators, topk_range):
+    '''
+    :return: a dict of the scores of each configuration, with the same names as the score_dict of evaluate_beam_search
+    '''
+    report = {}
+    for (presence, num_oneword_seq), config_accumulators in sorted(accumulators.items()):
+        scores = {'#(docs)': len(config_accumulators['exact'])}
+        for match_type, accumulator in sorted(config_accumulators.items()):
+            for topk in topk_range:
+                for name in ['precision', 'recall', 'f_score']:
+                    scores['%s@%d_%s' % (name, topk, match_type)] = accumulator.macro('%s@%d' % (name, topk))
+                micro_precision, micro_recall, micro_f_score = accumulator.micro(topk)
+                scores['micro_precision@%d_%s' % (topk, match_type)] = micro_precision
+                scores['micro_recall@%d_%s' % (topk, match_type)] = micro_recall
+                scores['micro_f_score@%d_%s' % (topk, match_type)] = micro_f_score
+        report['%s#oneword=%d' % (presence, num_oneword_seq)] = scores
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='rescore.py',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-store', required=True,
+                        help='The prediction store of an evaluation round (<title>_predictions/)')
+    parser.add_argument('-presence', type=str, nargs='+', default=PRESENCE_FILTERS, choices=PRESENCE_FILTERS,
+                        help='Filters of the targets and the predictions on their presence in the source')
+    parser.add_argument('-num_oneword_seq', type=int, nargs='+', default=[-1, 1],
+                        help='Numbers of one-word predictions to keep, -1 keeps all of them')
+    parser.add_argument('-topk', type=int, nargs='+', default=[5, 10],
+                        help='Cut-offs of the metrics')
+    parser.add_argument('-output', default=None,
+                        help='Path to save the scores of all the configurations (json)')
+    opt = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    # no vocab here, every word is stemmed once through the cache of an empty table
+    set_stem_table(StemTable({}, np.zeros(0, dtype=np.int32), [], cache_size=1 << 22))
+
+    store = PredictionStore(opt.store)
+    logger.info('Rescoring %d documents of %s' % (len(store), opt.store))
+    accumulators = rescore(store, opt.presence, opt.num_oneword_seq, opt.topk)
+    report = score_report(accumulators, opt.topk)
+
+    for config_name, scores in sorted(report.items()):
+        logger.info('%s, #(docs)=%d' % (config_name, scores['#(docs)']))
+        for topk in opt.topk:
+            for match_type in ['exact', 'soft']:
+                logger.info('\t%s@%d: P=%.4f, R=%.4f, F1=%.4f (micro F1=%.4f)' % (
+                    match_type, topk, scores['precision@%d_%s' % (topk, match_type)],
+                    scores['recall@%d_%s' % (topk, match_type)], scores['f_score@%d_%s' % (topk, match_type)],
+                    scores['micro_f_score@%d_%s' % (topk, match_type)]))
+
+    if opt.output is not None:
+        with open(opt.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,8 +2,11 @@
 """
 Python File Template 
 """
+import itertools
 import json
+import multiprocessing
 import os
+import re
 
 import logging
 import numpy as np
@@ -14,16 +17,28 @@ import copy
 import torch
 
 from beam_search import SequenceGenerator
-from evaluate import evaluate_beam_search, get_match_result, self_redundancy
-from pykp.dataloader import KeyphraseDataLoader
+from evaluate import evaluate_beam_search, get_bleu_result, get_match_result, self_redundancy
+from pykp.dataloader import KeyphraseDataLoader, WorkerPool, BatchCache, BucketBatchSampler, stratified_subset
+from pykp.shards import list_shards, manifest_path
+from pykp.streaming import StreamingKeyphraseDataset, StreamingDataLoader
 from utils import Progbar, plot_learning_curve_and_write_csv
 
 from config import init_logging, init_opt
 import pykp
-from pykp.io import KeyphraseDataset
+import pykp.vocab
+from pykp.io import KeyphraseDataset, resolve_dataset_path
 from pykp.model import Seq2SeqLSTMAttention, Seq2SeqLSTMAttentionCascading
+from pykp.stem_table import load_stem_table
+from pykp.vocab import resolve_vocab_path
+from pykp.word_vectors import load_pretrained_embedding
 
 import time
+import traceback
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
 
 
 logging.basicConfig(level=logging.INFO)
@@ -183,9 +198,8 @@ def train_rl_0(one2many_batch, model, optimizer, generator, opt):
         trg_seqs = [[opt.id2word[x] if x < opt.vocab_size else oov[x - opt.vocab_size] for x in seq] for seq in trg_copy]
         # trg_seqs            =  [seq + [pykp.IO.EOS_WORD] * (opt.max_sent_length - len(seq)) for seq in trg_seqs]
 
-        # local rewards (bleu)
-        bleu_baselines = get_match_result(true_seqs=trg_seqs, pred_seqs=baseline_str_seqs, type='bleu')
-        bleu_samples = get_match_result(true_seqs=trg_seqs, pred_seqs=sampled_str_seqs, type='bleu')
+        # local rewards (bleu), the targets are counted once for the baselines and the samples
+        bleu_baselines, bleu_samples = get_bleu_result(trg_seqs, [baseline_str_seqs, sampled_str_seqs])
 
         # global rewards
         match_baselines = get_match_result(true_seqs=trg_seqs, pred_seqs=baseline_str_seqs, type='exact')
@@ -413,6 +427,21 @@ def brief_report(epoch, batch_i, one2one_batch, loss_ml, decoder_log_probs, opt)
             ' [HAS COPY]' + str(trg_i) if has_copy else ''))
 
 
+def with_last_flag(iterable):
+    '''
+    Yield (item, is_last_item) by looking one item ahead
+    '''
+    iterator = iter(iterable)
+    try:
+        item = next(iterator)
+    except StopIteration:
+        return
+    for next_item in iterator:
+        yield item, False
+        item = next_item
+    yield item, True
+
+
 def train_model(model, optimizer_ml, optimizer_rl, criterion, train_data_loader, valid_data_loaders, test_data_loaders, opt):
     generator = SequenceGenerator(model,
                                   eos_id=opt.word2id[pykp.io.EOS_WORD],
@@ -448,187 +477,482 @@ def train_model(model, optimizer_ml, optimizer_rl, criterion, train_data_loader,
     if opt.train_rl:
         reward_cache = RewardCache(2000)
 
-    # if False:  # opt.train_from:
-    #     state_path = opt.train_from.replace('.model', '.state')
-    #     logger.info('Loading training state from: %s' % state_path)
-    #     if os.path.exists(state_path):
-    #         (epoch, total_batch, best_loss, stop_increasing, checkpoint_names, train_ml_history_losses, train_rl_history_losses, valid_history_scores,
-    #          test_history_losses) = torch.load(open(state_path, 'rb'))
-    #         opt.start_epoch = epoch
-
-    for epoch in range(opt.start_epoch, opt.epochs):
-        if early_stop_flag:
-            break
+    # resume the training state saved with the checkpoint, the epoch is resumed after its last trained batch
+    resume_batch = 0
+    if opt.train_from:
+        state_path = opt.train_from.replace('.model', '.state')
+        if os.path.exists(state_path):
+            logger.info('Loading training state from: %s' % state_path)
+            state = torch.load(open(state_path, 'rb'))
+            (epoch, total_batch, best_loss, stop_increasing, checkpoint_names, train_ml_history_losses, train_rl_history_losses, valid_history_scores,
+             test_history_scores) = state[:9]
+            # older states have no sampler state, nor batch_i (it's in the name of the file)
+            sampler_state = state[9] if len(state) > 9 else {'epoch': epoch, 'seed': opt.seed}
+            if len(state) > 10:
+                batch_i = state[10]
+            else:
+                match = re.search(r'\.batch=(\d+)\.', os.path.basename(state_path))
+                batch_i = int(match.group(1)) if match is not None else -1
+            opt.start_epoch = epoch
+            resume_batch = batch_i + 1
+            # the seed of the sampler, the permutation of each epoch is drawn from seed + epoch
+            batch_sampler = getattr(train_data_loader, 'batch_sampler', None)
+            if hasattr(batch_sampler, 'load_state_dict'):
+                batch_sampler.load_state_dict(sampler_state)
+            logger.info('Resume training from epoch=%d, batch=%d, total_batch=%d, sampler state=%s' % (epoch, resume_batch, total_batch, str(sampler_state)))
+
+    def take_train_losses():
+        '''
+        :return: (ML losses, RL rewards) of the batches since the last round of validation, the lists are restarted
+        '''
+        nonlocal train_ml_losses, train_rl_losses
+        train_losses = (train_ml_losses, train_rl_losses)
+        train_ml_losses, train_rl_losses = [], []
+        return train_losses
+
+    def report_validation_round(epoch, batch_i, total_batch, sampler_state, train_losses, valid_score_dict, test_score_dict, snapshot_path=None):
+        '''
+        Merge the scores of a round of validation into the history, plot the learning curves and save the checkpoint
+        :param train_losses: (ML losses, RL rewards) of the batches before the round, taken by take_train_losses()
+            when the round starts, so that an asynchronous round is plotted with the losses of its own parameters
+        :param snapshot_path: the parameters evaluated by the asynchronous validation (-async_valid), saved as the
+            checkpoint instead of the current parameters of the model
+        :return: whether to stop training
+        '''
+        nonlocal best_loss, stop_increasing
+        '''
+        Merge scores of current round into history_score
+        '''
+        for dataset_name, score_dict in valid_score_dict.items():
+            # each history_loss is a dict, specific to a dataset
+            # key is score name and value is a list, each element is a list of scores (e.g. f1_score) of all examples
+            valid_history_score = valid_history_scores.get(dataset_name, {})
+            for score_name, score_values in score_dict.items():
+                history_score_values = valid_history_score.get(score_name, [])
+                history_score_values.append(score_values)
+                valid_history_score[score_name] = history_score_values
+            valid_history_scores[dataset_name] = valid_history_score
+
+        for dataset_name, score_dict in test_score_dict.items():
+            test_history_score = test_history_scores.get(dataset_name, {})
+            for score_name, score_values in score_dict.items():
+                history_score_values = test_history_score.get(score_name, [])
+                history_score_values.append(score_values)
+                test_history_score[score_name] = history_score_values
+            test_history_scores[dataset_name] = test_history_score
+
+        if opt.train_ml:
+            train_ml_history_losses.append(train_losses[0])
+        if opt.train_rl:
+            train_rl_history_losses.append(train_losses[1])
+        '''
+        Iterate each dataset (including a merged 'all_datasets') and plot learning curves
+        '''
+        for dataset_name in opt.test_dataset_names + ['all_datasets']:
+            valid_history_score = valid_history_scores[dataset_name]
+            test_history_score = test_history_scores[dataset_name]
+            curve_names = []
+            scores_for_plot = []
+            if opt.train_ml:
+                scores_for_plot += [train_ml_history_losses]
+                curve_names += ['Training ML Error']
 
-        progbar = Progbar(logger=logger, title='Training', target=len(train_data_loader), batch_size=train_data_loader.batch_size,
-                          total_examples=len(train_data_loader.dataset))
+            if opt.train_rl:
+                scores_for_plot += [train_rl_history_losses]
+                curve_names += ['Training RL Reward']
 
-        for batch_i, batch in enumerate(train_data_loader):
-            model.train()
-            total_batch += 1
-            one2many_batch, one2one_batch = batch
-            report_loss = []
+            scores_for_plot += [valid_history_score[name] for name in opt.report_score_names]
+            curve_names += ['Valid-' + name for name in opt.report_score_names]
+            scores_for_plot += [test_history_score[name] for name in opt.report_score_names]
+            curve_names += ['Test-' + name for name in opt.report_score_names]
 
-            # Training
-            if opt.train_ml:
-                loss_ml, decoder_log_probs = train_ml(one2one_batch, model, optimizer_ml, criterion, opt)
+            scores_for_plot = [np.asarray(s) for s in scores_for_plot]
+            '''
+            Plot the learning curve
+            '''
+            plot_learning_curve_and_write_csv(scores=scores_for_plot,
+                                              curve_names=curve_names,
+                                              checkpoint_names=checkpoint_names,
+                                              title='Training Validation & Test of %s' % dataset_name,
+                                              save_path=opt.plot_path + '/[epoch=%d,batch=%d,total_batch=%d].%s.learning_curve' % (epoch, batch_i, total_batch, dataset_name))
+
+        '''
+        determine if early stop training (whether f-score increased, previously is if valid error decreased)
+        opt.report_score_names[0] is 'f_score@5_exact'
+        '''
+        valid_loss = np.average(valid_history_scores['all_datasets'][opt.report_score_names[0]][-1])
+        is_best_loss = valid_loss > best_loss
+        rate_of_change = float(valid_loss - best_loss) / float(best_loss) if float(best_loss) > 0 else 0.0
+
+        # valid error doesn't increase
+        if rate_of_change <= 0:
+            stop_increasing += 1
+        else:
+            stop_increasing = 0
 
-                # len(decoder_log_probs) == 0 if encountered OOM
-                if len(decoder_log_probs) == 0:
-                    continue
+        if is_best_loss:
+            logging.info('Validation: update best loss (%.4f --> %.4f), rate of change (ROC)=%.2f' % (
+                best_loss, valid_loss, rate_of_change * 100))
+        else:
+            logging.info('Validation: best loss is not updated for %d times (%.4f --> %.4f), rate of change (ROC)=%.2f' % (
+                stop_increasing, best_loss, valid_loss, rate_of_change * 100))
+
+        logging.info('Current test loss (over %d datasets): %s\n' % (len(opt.test_dataset_names), str(opt.test_dataset_names)))
+        for report_score_name in opt.report_score_names:
+            test_loss = np.average(test_history_scores['all_datasets'][report_score_name][-1])
+            logging.info('\t\t %s = %.4f' % (report_score_name, test_loss))
+
+        best_loss = max(valid_loss, best_loss)
+
+        '''
+        Save checkpoints, only store the ones that make better validation performances
+        '''
+        checkpoint_names.append('epoch=%d-batch=%d-total_batch=%d' % (epoch, batch_i, total_batch))
+
+        if total_batch > 1 and (total_batch % opt.save_model_every == 0 or is_best_loss):  # epoch >= opt.start_checkpoint_at and
+            # Save the checkpoint
+            logging.info('Saving checkpoint to: %s' % os.path.join(opt.model_path, '%s.epoch=%d.batch=%d.total_batch=%d.error=%f' % (opt.exp, epoch, batch_i, total_batch, valid_loss) + '.model'))
+            if snapshot_path is not None:
+                os.replace(snapshot_path, os.path.join(opt.model_path, '%s.epoch=%d.batch=%d.total_batch=%d' % (opt.exp, epoch, batch_i, total_batch) + '.model'))
+                snapshot_path = None
+            else:
+                torch.save(
+                    model.state_dict(),
+                    open(os.path.join(opt.model_path, '%s.epoch=%d.batch=%d.total_batch=%d' % (opt.exp, epoch, batch_i, total_batch) + '.model'), 'wb')
+                )
+            torch.save(
+                (epoch, total_batch, best_loss, stop_increasing, checkpoint_names, train_ml_history_losses, train_rl_history_losses, valid_history_scores, test_history_scores,
+                 sampler_state, batch_i),
+                open(os.path.join(opt.model_path, '%s.epoch=%d.batch=%d.total_batch=%d' % (opt.exp, epoch, batch_i, total_batch) + '.state'), 'wb')
+            )
+        if snapshot_path is not None:
+            os.remove(snapshot_path)
 
-                train_ml_losses.append(loss_ml)
-                report_loss.append(('train_ml_loss', loss_ml))
-                report_loss.append(('PPL', loss_ml))
+        if stop_increasing >= opt.early_stop_tolerance:
+            logging.info('Have not increased for %d epoches, early stop training' % stop_increasing)
+            return True
+        return False
 
-                # Brief report
-                if batch_i % opt.report_every == 0:
-                    brief_report(epoch, batch_i, one2one_batch, loss_ml, decoder_log_probs, opt)
+    # with -async_valid, the rounds of validation are evaluated by another process on snapshots of the parameters
+    async_validator = AsyncValidator(opt) if opt.async_valid else None
 
-            # do not apply rl in 0th epoch, need to get a resonable model before that.
-            if opt.train_rl:
-                if epoch >= opt.rl_start_epoch:
-                    loss_rl = train_rl(one2many_batch, model, optimizer_rl, generator, opt, reward_cache)
-                else:
-                    loss_rl = 0.0
-                train_rl_losses.append(loss_rl)
-                report_loss.append(('train_rl_loss', loss_rl))
+    try:
+        for epoch in range(opt.start_epoch, opt.epochs):
+            if early_stop_flag:
+                break
+
+            # draw the permutation (or reshuffle the length buckets, or the shards of streaming) of this epoch from seed + epoch
+            batch_sampler = getattr(train_data_loader, 'batch_sampler', None)
+            if hasattr(train_data_loader, 'set_epoch'):
+                train_data_loader.set_epoch(epoch)
+            elif hasattr(batch_sampler, 'set_epoch'):
+                batch_sampler.set_epoch(epoch)
+            # (seed, epoch) of the batch sampler, saved with the training state to reproduce the order of batches
+            sampler_state = batch_sampler.state_dict() if hasattr(batch_sampler, 'state_dict') else {'epoch': epoch, 'seed': opt.seed}
+
+            progbar = Progbar(logger=logger, title='Training', target=len(train_data_loader), batch_size=train_data_loader.batch_size,
+                              total_examples=len(train_data_loader.dataset))
+
+            # throughput since the last report: (#real tokens, #padded tokens, start time)
+            real_tokens, padded_tokens, report_start_time = 0, 0, time.time()
+
+            # the batches trained before the checkpoint of a resumed training are skipped, without being loaded if possible
+            start_batch = resume_batch if epoch == opt.start_epoch else 0
+            if start_batch == 0:
+                batches = train_data_loader
+            elif hasattr(train_data_loader, 'iter_from'):
+                batches = train_data_loader.iter_from(start_batch)
+            else:
+                batches = itertools.islice(iter(train_data_loader), start_batch, None)
+
+            # the number of batches of a streaming loader is only an estimation, so the last batch is detected by look-ahead
+            for batch_i, (batch, is_last_batch) in enumerate(with_last_flag(batches), start=start_batch):
+                model.train()
+                total_batch += 1
+                one2many_batch, one2one_batch = batch
+                report_loss = []
+
+                src_o2m, src_o2m_len, trg_o2m = one2many_batch[0], one2many_batch[1], one2many_batch[2]
+                trg_lens = [len(t) for trgs in trg_o2m for t in trgs]
+                real_tokens += sum(src_o2m_len) + sum(trg_lens)
+                padded_tokens += src_o2m.size(0) * src_o2m.size(1) + (max(trg_lens) * len(trg_lens) if len(trg_lens) > 0 else 0)
+
+                # Training
+                if opt.train_ml:
+                    loss_ml, decoder_log_probs = train_ml(one2one_batch, model, optimizer_ml, criterion, opt)
 
-            progbar.update(epoch, batch_i, report_loss)
+                    # len(decoder_log_probs) == 0 if encountered OOM
+                    if len(decoder_log_probs) == 0:
+                        continue
 
-            '''
-            Validate and save checkpoint
-            '''
-            if (opt.run_valid_every == -1 and batch_i == len(train_data_loader) - 1) or\
-               (opt.run_valid_every > -1 and total_batch > 1 and total_batch % opt.run_valid_every == 0):
-                logger.info('*' * 50)
-                logger.info('Run validing and testing @Epoch=%d,#(Total batch)=%d' % (epoch, total_batch))
-
-                # return a dict, key is the dataset name and value is a score dict
-                valid_score_dict =  evaluate.evaluate_multiple_datasets(generator, valid_data_loaders, opt,
-                                                                        epoch=epoch,
-                                                                        title='valid.epoch=%d.total_batch=%d' % (epoch, total_batch),
-                                                                        predict_save_path=opt.pred_path + '/epoch%d_batch%d_total_batch%d/' % (epoch, batch_i, total_batch))
-                test_score_dict = evaluate.evaluate_multiple_datasets(generator, test_data_loaders, opt,
-                                                                      epoch=epoch,
-                                                                      title='test.epoch=%d.total_batch=%d' % (epoch, total_batch),
-                                                                      predict_save_path=opt.pred_path + '/epoch%d_batch%d_total_batch%d/' % (epoch, batch_i, total_batch))
+                    train_ml_losses.append(loss_ml)
+                    report_loss.append(('train_ml_loss', loss_ml))
+                    report_loss.append(('PPL', loss_ml))
 
-                '''
-                Merge scores of current round into history_score
-                '''
-                for dataset_name, score_dict in valid_score_dict.items():
-                    # each history_loss is a dict, specific to a dataset
-                    # key is score name and value is a list, each element is a list of scores (e.g. f1_score) of all examples
-                    valid_history_score = valid_history_scores.get(dataset_name, {})
-                    for score_name, score_values in score_dict.items():
-                        history_score_values = valid_history_score.get(score_name, [])
-                        history_score_values.append(score_values)
-                        valid_history_score[score_name] = history_score_values
-                    valid_history_scores[dataset_name] = valid_history_score
-
-                for dataset_name, score_dict in test_score_dict.items():
-                    test_history_score = test_history_scores.get(dataset_name, {})
-                    for score_name, score_values in score_dict.items():
-                        history_score_values = test_history_score.get(score_name, [])
-                        history_score_values.append(score_values)
-                        test_history_score[score_name] = history_score_values
-                    test_history_scores[dataset_name] = test_history_score
+                    # Brief report
+                    if batch_i % opt.report_every == 0:
+                        brief_report(epoch, batch_i, one2one_batch, loss_ml, decoder_log_probs, opt)
 
-                if opt.train_ml:
-                    train_ml_history_losses.append(copy.copy(train_ml_losses))
-                    train_ml_losses = []
+                # do not apply rl in 0th epoch, need to get a resonable model before that.
                 if opt.train_rl:
-                    train_rl_history_losses.append(copy.copy(train_rl_losses))
-                    train_rl_losses = []
-                '''
-                Iterate each dataset (including a merged 'all_datasets') and plot learning curves
-                '''
-                for dataset_name in opt.test_dataset_names + ['all_datasets']:
-                    valid_history_score = valid_history_scores[dataset_name]
-                    test_history_score = test_history_scores[dataset_name]
-                    curve_names = []
-                    scores_for_plot = []
-                    if opt.train_ml:
-                        scores_for_plot += [train_ml_history_losses]
-                        curve_names += ['Training ML Error']
-
-                    if opt.train_rl:
-                        scores_for_plot += [train_rl_history_losses]
-                        curve_names += ['Training RL Reward']
-
-                    scores_for_plot += [valid_history_score[name] for name in opt.report_score_names]
-                    curve_names += ['Valid-' + name for name in opt.report_score_names]
-                    scores_for_plot += [test_history_score[name] for name in opt.report_score_names]
-                    curve_names += ['Test-' + name for name in opt.report_score_names]
-
-                    scores_for_plot = [np.asarray(s) for s in scores_for_plot]
-                    '''
-                    Plot the learning curve
-                    '''
-                    plot_learning_curve_and_write_csv(scores=scores_for_plot,
-                                                      curve_names=curve_names,
-                                                      checkpoint_names=checkpoint_names,
-                                                      title='Training Validation & Test of %s' % dataset_name,
-                                                      save_path=opt.plot_path + '/[epoch=%d,batch=%d,total_batch=%d].%s.learning_curve' % (epoch, batch_i, total_batch, dataset_name))
+                    if epoch >= opt.rl_start_epoch:
+                        loss_rl = train_rl(one2many_batch, model, optimizer_rl, generator, opt, reward_cache)
+                    else:
+                        loss_rl = 0.0
+                    train_rl_losses.append(loss_rl)
+                    report_loss.append(('train_rl_loss', loss_rl))
+
+                progbar.update(epoch, batch_i, report_loss)
+
+                if batch_i > 0 and batch_i % opt.report_every == 0:
+                    elapsed_time = max(time.time() - report_start_time, 1e-6)
+                    logger.info('Throughput: %.1f real tokens/s, %.1f padded tokens/s, padding waste=%.2f%%' %
+                                (real_tokens / elapsed_time, padded_tokens / elapsed_time,
+                                 100.0 * (padded_tokens - real_tokens) / max(padded_tokens, 1)))
+                    real_tokens, padded_tokens, report_start_time = 0, 0, time.time()
 
                 '''
-                determine if early stop training (whether f-score increased, previously is if valid error decreased)
-                opt.report_score_names[0] is 'f_score@5_exact'
+                Validate and save checkpoint
                 '''
-                valid_loss = np.average(valid_history_scores['all_datasets'][opt.report_score_names[0]][-1])
-                is_best_loss = valid_loss > best_loss
-                rate_of_change = float(valid_loss - best_loss) / float(best_loss) if float(best_loss) > 0 else 0.0
-
-                # valid error doesn't increase
-                if rate_of_change <= 0:
-                    stop_increasing += 1
-                else:
-                    stop_increasing = 0
-
-                if is_best_loss:
-                    logging.info('Validation: update best loss (%.4f --> %.4f), rate of change (ROC)=%.2f' % (
-                        best_loss, valid_loss, rate_of_change * 100))
-                else:
-                    logging.info('Validation: best loss is not updated for %d times (%.4f --> %.4f), rate of change (ROC)=%.2f' % (
-                        stop_increasing, best_loss, valid_loss, rate_of_change * 100))
-
-                logging.info('Current test loss (over %d datasets): %s\n' % (len(opt.test_dataset_names), str(opt.test_dataset_names)))
-                for report_score_name in opt.report_score_names:
-                    test_loss = np.average(test_history_scores['all_datasets'][report_score_name][-1])
-                    logging.info('\t\t %s = %.4f' % (report_score_name, test_loss))
-
-                best_loss = max(valid_loss, best_loss)
+                # results of the asynchronous validation come back while training, one round behind
+                if async_validator is not None:
+                    for result in async_validator.poll():
+                        if report_validation_round(*result):
+                            early_stop_flag = True
+                    if early_stop_flag:
+                        break
+
+                if (opt.run_valid_every == -1 and is_last_batch) or\
+                   (opt.run_valid_every > -1 and total_batch > 1 and total_batch % opt.run_valid_every == 0):
+                    logger.info('*' * 50)
+                    logger.info('Run validing and testing @Epoch=%d,#(Total batch)=%d' % (epoch, total_batch))
+
+                    if async_validator is not None:
+                        # wait for the previous round, at most one round is evaluated while training
+                        for result in async_validator.poll(wait=True):
+                            if report_validation_round(*result):
+                                early_stop_flag = True
+                        if early_stop_flag:
+                            break
+                        async_validator.submit(model, epoch, batch_i, total_batch, sampler_state, take_train_losses())
+                        logging.info('*' * 50)
+                        continue
+
+                    # return a dict, key is the dataset name and value is a score dict
+                    valid_score_dict =  evaluate.evaluate_multiple_datasets(generator, valid_data_loaders, opt,
+                                                                            epoch=epoch,
+                                                                            title='valid.epoch=%d.total_batch=%d' % (epoch, total_batch),
+                                                                            predict_save_path=opt.pred_path + '/epoch%d_batch%d_total_batch%d/' % (epoch, batch_i, total_batch),
+                                                                            budgeted=True)
+                    test_score_dict = evaluate.evaluate_multiple_datasets(generator, test_data_loaders, opt,
+                                                                          epoch=epoch,
+                                                                          title='test.epoch=%d.total_batch=%d' % (epoch, total_batch),
+                                                                          predict_save_path=opt.pred_path + '/epoch%d_batch%d_total_batch%d/' % (epoch, batch_i, total_batch),
+                                                                          budgeted=True)
+
+                    if report_validation_round(epoch, batch_i, total_batch, sampler_state, take_train_losses(), valid_score_dict, test_score_dict):
+                        early_stop_flag = True
+                        break
+
+                    logging.info('*' * 50)
+
+        # the last round of the asynchronous validation
+        if async_validator is not None:
+            for result in async_validator.poll(wait=True):
+                report_validation_round(*result)
+    finally:
+        # the validation process is not a daemon (it starts its own workers), it is stopped even if training fails
+        if async_validator is not None:
+            async_validator.close()
+
+
+class AsyncValidator(object):
+    """
+    Validation of snapshots of the model in a separate process (-async_valid), while the training goes on.
+    The process loads the valid and test datasets and builds the model once, then evaluates every snapshot (a state_dict
+    saved in opt.model_path) it receives, and sends back the score dicts of the round.
+    The process is not a daemon, so that it can start the workers of its loaders, it is stopped by close().
 
-                '''
-                Save checkpoints, only store the ones that make better validation performances
-                '''
-                checkpoint_names.append('epoch=%d-batch=%d-total_batch=%d' % (epoch, batch_i, total_batch))
-
-                if total_batch > 1 and (total_batch % opt.save_model_every == 0 or is_best_loss):  # epoch >= opt.start_checkpoint_at and
-                    # Save the checkpoint
-                    logging.info('Saving checkpoint to: %s' % os.path.join(opt.model_path, '%s.epoch=%d.batch=%d.total_batch=%d.error=%f' % (opt.exp, epoch, batch_i, total_batch, valid_loss) + '.model'))
-                    torch.save(
-                        model.state_dict(),
-                        open(os.path.join(opt.model_path, '%s.epoch=%d.batch=%d.total_batch=%d' % (opt.exp, epoch, batch_i, total_batch) + '.model'), 'wb')
-                    )
-                    torch.save(
-                        (epoch, total_batch, best_loss, stop_increasing, checkpoint_names, train_ml_history_losses, train_rl_history_losses, valid_history_scores, test_history_scores),
-                        open(os.path.join(opt.model_path, '%s.epoch=%d.batch=%d.total_batch=%d' % (opt.exp, epoch, batch_i, total_batch) + '.state'), 'wb')
-                    )
-
-                if stop_increasing >= opt.early_stop_tolerance:
-                    logging.info('Have not increased for %d epoches, early stop training' % stop_increasing)
-                    early_stop_flag = True
+    Arguments:
+        opt: the options of training, the datasets are loaded from them
+    """
+
+    def __init__(self, opt):
+        self.opt = opt
+        # spawned rather than forked, the training process may hold a CUDA context
+        context = multiprocessing.get_context('spawn')
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.pending = 0
+        self.process = context.Process(target=async_validation_loop, args=(opt, self.requests, self.results))
+        self.process.start()
+
+    def submit(self, model, epoch, batch_i, total_batch, sampler_state, train_losses):
+        '''
+        :param train_losses: the training losses before the round, sent back with its scores
+        '''
+        snapshot_path = os.path.join(self.opt.model_path, '%s.snapshot.total_batch=%d.model' % (self.opt.exp, total_batch))
+        state_dict = dict((k, v.cpu()) for k, v in model.state_dict().items())
+        torch.save(state_dict, open(snapshot_path, 'wb'))
+        self.requests.put((epoch, batch_i, total_batch, sampler_state, train_losses, snapshot_path))
+        self.pending += 1
+
+    def poll(self, wait=False):
+        '''
+        :param wait: wait for all the submitted rounds, otherwise only take the rounds already evaluated
+        :return: a list of (epoch, batch_i, total_batch, sampler_state, train_losses, valid_score_dict, test_score_dict, snapshot_path)
+        '''
+        results = []
+        while self.pending > 0:
+            try:
+                result = self.results.get(timeout=5.0) if wait else self.results.get_nowait()
+            except queue.Empty:
+                if not wait:
                     break
+                if not self.process.is_alive():
+                    raise RuntimeError('The validation process died (exit code %s)' % str(self.process.exitcode))
+                continue
+            self.pending -= 1
+            if isinstance(result, str):
+                raise RuntimeError('The validation process failed:\n%s' % result)
+            results.append(result)
+        return results
+
+    def close(self):
+        '''
+        Stop the process after the rounds already submitted, it shuts down its workers on its way out
+        '''
+        if self.process.is_alive():
+            self.requests.put(None)
+        self.process.join()
+
+
+def async_validation_loop(opt, requests, results):
+    '''
+    The loop of the validation process of AsyncValidator, a failure is sent back as its traceback
+    '''
+    try:
+        init_logging(logger_name='train.py', log_file=os.path.join(opt.exp_path, 'async_valid.log'), redirect_to_stdout=False)
+        valid_data_loaders, _, _, _ = load_vocab_and_datasets_for_testing(dataset_names=opt.test_dataset_names, type='valid', opt=opt)
+        test_data_loaders, _, _, _ = load_vocab_and_datasets_for_testing(dataset_names=opt.test_dataset_names, type='test', opt=opt)
+        valid_data_loaders = budgeted_data_loaders(valid_data_loaders, opt)
+        test_data_loaders = budgeted_data_loaders(test_data_loaders, opt)
+
+        model = Seq2SeqLSTMAttentionCascading(opt) if opt.cascading_model else Seq2SeqLSTMAttention(opt)
+        if torch.cuda.is_available():
+            model = model.cuda()
+        generator = SequenceGenerator(model,
+                                      eos_id=opt.word2id[pykp.io.EOS_WORD],
+                                      beam_size=opt.beam_size,
+                                      max_sequence_length=opt.max_sent_length
+                                      )
+
+        while True:
+            request = requests.get()
+            if request is None:
+                break
+            epoch, batch_i, total_batch, sampler_state, train_losses, snapshot_path = request
+            model.load_state_dict(torch.load(open(snapshot_path, 'rb'), map_location=lambda storage, loc: storage))
+            model.eval()
+
+            valid_score_dict = evaluate.evaluate_multiple_datasets(generator, valid_data_loaders, opt,
+                                                                   epoch=epoch,
+                                                                   title='valid.epoch=%d.total_batch=%d' % (epoch, total_batch),
+                                                                   predict_save_path=opt.pred_path + '/epoch%d_batch%d_total_batch%d/' % (epoch, batch_i, total_batch),
+                                                                   budgeted=True)
+            test_score_dict = evaluate.evaluate_multiple_datasets(generator, test_data_loaders, opt,
+                                                                  epoch=epoch,
+                                                                  title='test.epoch=%d.total_batch=%d' % (epoch, total_batch),
+                                                                  predict_save_path=opt.pred_path + '/epoch%d_batch%d_total_batch%d/' % (epoch, batch_i, total_batch),
+                                                                  budgeted=True)
+            results.put((epoch, batch_i, total_batch, sampler_state, train_losses, valid_score_dict, test_score_dict, snapshot_path))
+    except Exception:
+        results.put(traceback.format_exc())
+    finally:
+        if worker_pool is not None:
+            worker_pool.shutdown()
+
+
+def has_validation_budget(opt):
+    return opt.valid_budget_docs > 0 or opt.valid_budget_seconds > 0 or opt.valid_ci_width > 0
+
+
+def budgeted_data_loaders(data_loaders, opt):
+    '''
+    Loaders for the validation during training on a budget: over fixed subsets of -valid_budget_docs documents of the
+    datasets, stratified by source length, or over all the documents without -valid_budget_docs. The batches are
+    shuffled once (with opt.seed), so that a validation stopped early by -valid_budget_seconds or -valid_ci_width is
+    still over documents of all the lengths, rather than over the shortest ones of the length-sorted loaders
+    '''
+    if not has_validation_budget(opt):
+        return data_loaders
+
+    budgeted_loaders = []
+    for dataset_name, data_loader in zip(opt.test_dataset_names, data_loaders):
+        dataset = data_loader.dataset
+        metadata = dataset.get_metadata()
+        if opt.valid_budget_docs > 0:
+            subset = stratified_subset(metadata['src_len'], opt.valid_budget_docs, seed=opt.seed)
+        else:
+            subset = np.arange(len(dataset))
+        batch_sampler = BucketBatchSampler(metadata, max_batch_example=opt.beam_search_batch_example,
+                                           max_batch_pair=opt.beam_search_batch_size, max_batch_tokens=opt.max_batch_tokens,
+                                           bucket_width=opt.bucket_width, shuffle=True, seed=opt.seed, indices=subset)
+        budgeted_loaders.append(KeyphraseDataLoader(dataset=dataset,
+                                                    collate_fn=dataset.collate_fn_one2many,
+                                                    batch_sampler=batch_sampler,
+                                                    num_workers=opt.batch_workers,
+                                                    pin_memory=torch.cuda.is_available(),
+                                                    report_worker_memory=opt.report_worker_memory,
+                                                    worker_pool=get_worker_pool(opt),
+                                                    batch_cache=get_batch_cache(opt)))
+        logger.info('Validation subset of %s: #(docs)=%d/%d, #(batch)=%d' % (dataset_name, len(subset), len(dataset), len(batch_sampler)))
+    return budgeted_loaders
+
+
+def evaluate_full_datasets(model, valid_data_loaders, test_data_loaders, opt):
+    '''
+    Evaluate the model of the end of training on the full datasets, after a training validated on a budget
+    '''
+    generator = SequenceGenerator(model,
+                                  eos_id=opt.word2id[pykp.io.EOS_WORD],
+                                  beam_size=opt.beam_size,
+                                  max_sequence_length=opt.max_sent_length
+                                  )
+    logging.info('======================  Evaluating the full datasets  =========================')
+    for title, data_loaders in [('valid', valid_data_loaders), ('test', test_data_loaders)]:
+        evaluate.evaluate_multiple_datasets(generator, data_loaders, opt, title='%s.final' % title,
+                                            predict_save_path=opt.pred_path + '/final/')
 
-                logging.info('*' * 50)
+
+worker_pool = None
+
+
+def get_worker_pool(opt):
+    '''
+    The pool of batch workers shared by all the loaders if -persistent_workers, otherwise each loader starts its own workers
+    '''
+    global worker_pool
+    if not opt.persistent_workers or opt.batch_workers == 0:
+        return None
+    if worker_pool is None:
+        worker_pool = WorkerPool(opt.batch_workers, report_memory=opt.report_worker_memory)
+    return worker_pool
+
+
+def get_batch_cache(opt):
+    '''
+    A cache of collated batches for an evaluation loader if -cache_eval_batches
+    '''
+    if not opt.cache_eval_batches:
+        return None
+    return BatchCache(max_memory_mb=opt.eval_cache_memory, cache_dir=opt.eval_cache_dir)
 
 
 def load_data_vocab_for_training(opt, load_train=True):
 
     logging.info("Loading vocab from disk: %s" % (opt.vocab_path))
-    word2id, id2word, vocab = torch.load(opt.vocab_path, 'rb')
+    word2id, id2word, vocab = pykp.vocab.load_vocab(opt.vocab_path)
     pin_memory = torch.cuda.is_available()
 
     # one2one data loader
@@ -636,22 +960,49 @@ def load_data_vocab_for_training(opt, load_train=True):
 
     logging.info('======================  Dataset  =========================')
     # one2many data loader
-    if load_train:
-        train_data_path = opt.data_path_prefix + '.train.one2many.pt'
+    # a sharded training set without a monolithic file (e.g. the _small subset of shards) can only be streamed
+    train_prefix = opt.data_path_prefix + '.train.one2many'
+    only_shards = os.path.exists(manifest_path(train_prefix)) and not os.path.exists(resolve_dataset_path(train_prefix + '.pt'))
+    if load_train and (opt.streaming or only_shards or opt.train_shard_ids is not None):
+        train_shard_paths = list_shards(train_prefix, shard_ids=opt.train_shard_ids)
+        logging.info('Streaming the training data from %d shards' % len(train_shard_paths))
+        train_one2many_dataset = StreamingKeyphraseDataset(train_shard_paths,
+                                                           word2id=word2id,
+                                                           id2word=id2word,
+                                                           shuffle_buffer_size=opt.shuffle_buffer_size,
+                                                           seed=opt.seed)
+        train_one2many_loader = StreamingDataLoader(dataset=train_one2many_dataset,
+                                                    num_workers=opt.batch_workers,
+                                                    max_batch_example=1024,
+                                                    max_batch_pair=opt.batch_size,
+                                                    pin_memory=pin_memory)
+        logging.info('#(train data size: #(one2many pair)=%d, #(one2one pair)=%d, #(batch)~=%d' % (len(train_one2many_dataset), train_one2many_loader.one2one_number(), len(train_one2many_loader)))
+    elif load_train:
+        train_data_path = resolve_dataset_path(opt.data_path_prefix + '.train.one2many.pt')
         train_one2many_dataset = KeyphraseDataset(train_data_path,
                                                   word2id=word2id,
                                                   id2word=id2word,
                                                   type='one2many',
                                                   lazy_load=False)
+        if opt.share_dataset_memory and opt.batch_workers > 0:
+            train_one2many_dataset.share_memory(opt.vocab_size)
         train_one2many_loader = KeyphraseDataLoader(dataset=train_one2many_dataset,
                                                     collate_fn=train_one2many_dataset.collate_fn_one2many,
                                                     num_workers=opt.batch_workers,
                                                     max_batch_example=1024,
                                                     max_batch_pair=opt.batch_size,
                                                     pin_memory=pin_memory,
-                                                    shuffle=True)
+                                                    shuffle=True,
+                                                    bucket_sampling=opt.bucket_sampling,
+                                                    bucket_width=opt.bucket_width,
+                                                    max_batch_tokens=opt.max_batch_tokens,
+                                                    seed=opt.seed,
+                                                    report_worker_memory=opt.report_worker_memory,
+                                                    worker_pool=get_worker_pool(opt))
 
         logging.info('#(train data size: #(one2many pair)=%d, #(one2one pair)=%d, #(batch)=%d, #(average examples/batch)=%.3f' % (len(train_one2many_loader.dataset), train_one2many_loader.one2one_number(), len(train_one2many_loader), train_one2many_loader.one2one_number() / len(train_one2many_loader)))
+        real_tokens, padded_tokens = train_one2many_loader.padding_statistics()
+        logging.info('#(train tokens): real=%d, padded=%d, padding waste=%.2f%% (bucket_sampling=%s)' % (real_tokens, padded_tokens, 100.0 * (padded_tokens - real_tokens) / max(padded_tokens, 1), opt.bucket_sampling))
     else:
         train_one2many_loader = None
 
@@ -662,8 +1013,8 @@ def load_data_vocab_for_training(opt, load_train=True):
     # valid_one2many = valid_one2many[:2000]
     # test_one2many = test_one2many[:2000]
 
-    valid_dataset_path = opt.data_path_prefix + '.valid.one2many.pt'
-    test_dataset_path = opt.data_path_prefix + '.test.one2many.pt'
+    valid_dataset_path = resolve_dataset_path(opt.data_path_prefix + '.valid.one2many.pt')
+    test_dataset_path = resolve_dataset_path(opt.data_path_prefix + '.test.one2many.pt')
     valid_one2many_dataset = KeyphraseDataset(valid_dataset_path,
                                               word2id=word2id,
                                               id2word=id2word,
@@ -693,14 +1044,26 @@ def load_data_vocab_for_training(opt, load_train=True):
                                                 max_batch_example=opt.beam_search_batch_example,
                                                 max_batch_pair=opt.beam_search_batch_size,
                                                 pin_memory=pin_memory,
-                                                shuffle=False)
+                                                shuffle=False,
+                                                bucket_sampling=opt.bucket_sampling,
+                                                bucket_width=opt.bucket_width,
+                                                max_batch_tokens=opt.max_batch_tokens,
+                                                report_worker_memory=opt.report_worker_memory,
+                                                worker_pool=get_worker_pool(opt),
+                                                batch_cache=get_batch_cache(opt))
     test_one2many_loader = KeyphraseDataLoader(dataset=test_one2many_dataset,
                                                collate_fn=test_one2many_dataset.collate_fn_one2many,
                                                num_workers=opt.batch_workers,
                                                max_batch_example=opt.beam_search_batch_example,
                                                max_batch_pair=opt.beam_search_batch_size,
                                                pin_memory=pin_memory,
-                                               shuffle=False)
+                                               shuffle=False,
+                                               bucket_sampling=opt.bucket_sampling,
+                                               bucket_width=opt.bucket_width,
+                                               max_batch_tokens=opt.max_batch_tokens,
+                                               report_worker_memory=opt.report_worker_memory,
+                                               worker_pool=get_worker_pool(opt),
+                                               batch_cache=get_batch_cache(opt))
 
     opt.word2id = word2id
     opt.id2word = id2word
@@ -715,10 +1078,20 @@ def load_data_vocab_for_training(opt, load_train=True):
         logging.info('size of vocab is smaller than setting, reset it to %d' % len(vocab))
         opt.vocab_size = len(vocab)
     logging.info('#(vocab used)=%d' % opt.vocab_size)
+    init_stem_table(word2id, id2word, opt)
 
     return train_one2many_loader, valid_one2many_loader, test_one2many_loader, word2id, id2word, vocab
 
 
+def init_stem_table(word2id, id2word, opt):
+    '''
+    Stems of the vocab words used by evaluation, built at the first run and saved next to the vocab
+    '''
+    start_time = time.time()
+    evaluate.set_stem_table(load_stem_table(resolve_vocab_path(opt.vocab_path), word2id, id2word, opt.vocab_size))
+    logging.info('Stem table of the vocab loaded in %.2f seconds' % (time.time() - start_time))
+
+
 def load_vocab_and_datasets_for_testing(dataset_names, type, opt):
     '''
     Load additional datasets from disk
@@ -732,7 +1105,7 @@ def load_vocab_and_datasets_for_testing(dataset_names, type, opt):
     assert type == 'test' or type == 'valid'
 
     logger.info("Loading vocab from disk: %s" % (opt.vocab_path))
-    word2id, id2word, vocab = torch.load(opt.vocab_path, 'rb')
+    word2id, id2word, vocab = pykp.vocab.load_vocab(opt.vocab_path)
     logger.info('#(vocab)=%d' % len(vocab))
 
     pin_memory = torch.cuda.is_available()
@@ -748,6 +1121,7 @@ def load_vocab_and_datasets_for_testing(dataset_names, type, opt):
             dataset_path = os.path.join(opt.test_dataset_root_path, dataset_name, dataset_name + '.train.one2many.pt')
         else:
             raise Exception('Unsupported dataset: %s, type=%s' % (dataset_name, type))
+        dataset_path = resolve_dataset_path(dataset_path)
 
         one2many_dataset = KeyphraseDataset(dataset_path,
                                             word2id=word2id,
@@ -761,7 +1135,13 @@ def load_vocab_and_datasets_for_testing(dataset_names, type, opt):
                                               max_batch_example=opt.beam_search_batch_example,
                                               max_batch_pair=opt.beam_search_batch_size,
                                               pin_memory=pin_memory,
-                                              shuffle=False)
+                                              shuffle=False,
+                                              bucket_sampling=opt.bucket_sampling,
+                                              bucket_width=opt.bucket_width,
+                                              max_batch_tokens=opt.max_batch_tokens,
+                                              report_worker_memory=opt.report_worker_memory,
+                                              worker_pool=get_worker_pool(opt),
+                                              batch_cache=get_batch_cache(opt))
 
         one2many_loaders.append(one2many_loader)
 
@@ -771,6 +1151,8 @@ def load_vocab_and_datasets_for_testing(dataset_names, type, opt):
                      len(one2many_loader)))
         logger.info('*' * 50)
 
+    init_stem_table(word2id, id2word, opt)
+
     return one2many_loaders, word2id, id2word, vocab
 
 
@@ -823,6 +1205,9 @@ def init_model(opt):
             logging.info('Train a normal Seq2Seq model')
         model = Seq2SeqLSTMAttention(opt)
 
+    # pretrained vectors only initialize a new model, a checkpoint has its own embedding
+    load_pretrained_embedding(model, opt, load_vectors=not opt.train_from)
+
     if opt.train_from:
         logging.info("loading previous checkpoint from %s" % opt.train_from)
         # train_from_model_dir = opt.train_from[:opt.train_from.rfind('model/') + 6]
@@ -879,10 +1264,16 @@ def main():
         test_data_loaders, _, _, _ = load_vocab_and_datasets_for_testing(dataset_names=opt.test_dataset_names, type='test', opt=opt)
         model = init_model(opt)
         optimizer_ml, optimizer_rl, criterion = init_optimizer_criterion(model, opt)
-        train_model(model, optimizer_ml, optimizer_rl, criterion, train_data_loader, valid_data_loaders, test_data_loaders, opt)
+        train_model(model, optimizer_ml, optimizer_rl, criterion, train_data_loader,
+                    budgeted_data_loaders(valid_data_loaders, opt), budgeted_data_loaders(test_data_loaders, opt), opt)
+        if has_validation_budget(opt):
+            evaluate_full_datasets(model, valid_data_loaders, test_data_loaders, opt)
     except Exception as e:
         logging.error(e, exc_info=True)
         raise
+    finally:
+        if worker_pool is not None:
+            worker_pool.shutdown()
 
 
 if __name__ == '__main__':
@@ -24,13 +24,16 @@ import torch.nn as nn
 from torch import cuda
 
 from beam_search import SequenceGenerator
+import evaluate
 from evaluate import evaluate_beam_search
 from pykp.dataloader import KeyphraseDataLoader
 from utils import Progbar, plot_learning_curve_and_write_csv
 
 import pykp
+import pykp.vocab
 from pykp.io import KeyphraseDataset
 from pykp.model import Seq2SeqLSTMAttention, Seq2SeqLSTMAttentionCopy
+from pykp.stem_table import load_stem_table
 
 import time
 
@@ -336,7 +339,7 @@ def train_model(model, optimizer, criterion, train_data_loader, valid_data_loade
 def load_data_vocab(opt, load_train=True):
 
     logging.info("Loading vocab from disk: %s" % (opt.vocab))
-    word2id, id2word, vocab = torch.load(opt.vocab, 'wb')
+    word2id, id2word, vocab = pykp.vocab.load_vocab(opt.vocab)
 
     # one2one data loader
     logging.info("Loading train and validate data from '%s'" % opt.data)
@@ -386,6 +389,7 @@ def load_data_vocab(opt, load_train=True):
     opt.word2id = word2id
     opt.id2word = id2word
     opt.vocab   = vocab
+    evaluate.set_stem_table(load_stem_table(pykp.vocab.resolve_vocab_path(opt.vocab), word2id, id2word, opt.vocab_size))
 
     logging.info('#(valid data size: #(one2many pair)=%d, #(one2one pair)=%d, #(batch)=%d' % (len(valid_one2many_loader.dataset), valid_one2many_loader.one2one_number(), len(valid_one2many_loader)))
     logging.info('#(test data size:  #(one2many pair)=%d, #(one2one pair)=%d, #(batch)=%d' % (len(test_one2many_loader.dataset), test_one2many_loader.one2one_number(), len(test_one2many_loader)))